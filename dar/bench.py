@@ -0,0 +1,349 @@
+"""Micro benchmarks.
+
+Run with `python -m dar.bench`.
+"""
+from bisect import bisect_left
+from collections import OrderedDict
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+from .client import RemoteDB
+from .db import DB
+from .doc import canonical, new_rev, Document, Revision, HASHERS
+from .log import LogDB
+from .repl import FanoutRepl, Repl
+from .server import Server
+from .shard import ShardedDB
+from .view import View
+from .sqlite import SqliteDB
+
+
+def bench_put_depth(depths=(10, 100, 1000, 10000), number=1000):
+    """Latency of `Document.put` on top of histories of different depth.
+
+    Should stay flat as the depth grows.
+    """
+    for depth in depths:
+        doc = Document()
+        rev = None
+        for i in range(depth):
+            rev, _ = doc.put(i, rev)
+
+        state = {'rev': rev}
+
+        def put():
+            state['rev'], _ = doc.put('value', state['rev'])
+
+        t = timeit.timeit(put, number=number)
+        print('put at depth {:>6}: {:8.2f} us'.format(depth, t / number * 1e6))
+
+
+def bench_put_conflicts(sizes=(10, 100, 1000, 10000), number=1000):
+    """Latency of `Document.put` into documents with many conflicts."""
+    for size in sizes:
+        doc = Document()
+        root, _ = doc.put('root')
+        for i in range(size):
+            doc.put(i, root)
+
+        state = {'rev': doc.winner}
+
+        def put():
+            state['rev'], _ = doc.put('value', state['rev'])
+
+        t = timeit.timeit(put, number=number)
+        print('put with {:>6} leafs: {:8.2f} us'.format(size, t / number * 1e6))
+
+
+def bench_put_bulk(count=10000, batch_size=1000):
+    """Bulk ingest throughput of the storages."""
+    source = DB('source')
+    for i in range(count):
+        source.put({'number': i})
+    results = source.get_bulk(
+        ((c.uid, c.rev) for c in source.changes_get()), revs=True)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        dbs = (
+            DB('memory'),
+            SqliteDB('sqlite', os.path.join(tmp, 'sqlite')),
+            LogDB('log', os.path.join(tmp, 'log')),
+        )
+        for db in dbs:
+            t = time.time()
+            for i in range(0, count, batch_size):
+                db.put_bulk(results[i:i + batch_size])
+            t = time.time() - t
+            print('put_bulk into {:>6}: {:8.0f} docs/s'.format(db.name, count / t))
+
+        path = os.path.join(tmp, 'log')
+        dbs[2].close()
+        t = time.time()
+        LogDB('log', path)
+        print('open log with {} docs: {:8.2f} ms'.format(count, (time.time() - t) * 1e3))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_new_rev(number=100):
+    """Throughput of `new_rev` on large documents, with the old way of
+    hashing `str` of the value for comparison.
+    """
+    values = {
+        'nested': dict(
+            ('key%d' % i, {'name': u'value %d' % i, 'tags': range(20), 'flag': i % 2 == 0})
+            for i in range(1000)),
+        'flat': dict(('key%d' % i, i * 0.5) for i in range(10000)),
+        'text': {'body': u'lorem ipsum ' * 100000},
+    }
+    rev = '1-' + 'a' * 32
+
+    def legacy(value, rev):
+        return hashlib.md5(str(rev) + str(value)).hexdigest()
+
+    makers = [('str md5', legacy)] + [
+        ('json ' + name, lambda value, rev, hasher=hasher: new_rev(value, rev, hasher=hasher))
+        for name, hasher in sorted(HASHERS.items())
+    ]
+    for kind, value in sorted(values.items()):
+        size = len(canonical(value))
+        for name, make in makers:
+            t = timeit.timeit(lambda: make(value, rev), number=number) / number
+            print('new_rev {:>6} {:>12}: {:8.0f} revs/s {:8.1f} MB/s'.format(
+                kind, name, 1 / t, size / t / 1e6))
+
+
+def deep_sizeof(obj, seen=None):
+    """Bytes taken by an object and everything it refers to, once each."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    slots = getattr(type(obj), '__slots__', None)
+    if slots is not None:
+        # `__dict__` of a slotted object is created on the first access
+        size += sum(deep_sizeof(getattr(obj, name), seen) for name in slots if hasattr(obj, name))
+    elif hasattr(obj, '__dict__'):
+        size += deep_sizeof(obj.__dict__, seen)
+    return size
+
+
+def bench_memory(count=10000, depths=(1, 10, 100)):
+    """Bytes per revision of `Document` against a plain `OrderedDict` of
+    `Revision` tuples, the layout documents had before.
+
+    Bodies are not counted.
+    """
+    for depth in depths:
+        docs = []
+        for i in range(count // depth):
+            doc = Document()
+            rev = None
+            for j in range(depth):
+                rev, _ = doc.put(None, rev)
+            docs.append(doc)
+
+        plain = [
+            OrderedDict(
+                (rev, Revision(None, r.deleted, r.parent, r.generation, r.stub))
+                for rev, r in doc.iteritems()
+            )
+            for doc in docs
+        ]
+
+        before = deep_sizeof(plain, {id(None)}) / float(count)
+        after = deep_sizeof(docs, {id(None)}) / float(count)
+        print('memory at depth {:>4}: {:6.0f} -> {:4.0f} bytes/rev'.format(depth, before, after))
+
+
+def bench_repl_http(count=2000, depths=(1, 100)):
+    """Replication throughput in process and over HTTP, with requests
+    pipelined or sent one at a time, fetching with `_bulk_get` or GETs.
+    """
+    source = DB('source')
+    for i in range(count):
+        source.put({'number': i, 'text': 'x' * 100})
+
+    server = Server(('127.0.0.1', 0), {'source': source})
+    server.start()
+
+    def remote_repl(target, depth, bulk_get):
+        remote = RemoteDB(server.url + '/source', pipeline_depth=depth)
+        remote.bulk_get = bulk_get
+        return Repl(remote, RemoteDB(server.url + '/' + target.name, pipeline_depth=depth))
+
+    try:
+        runs = [('in process', lambda target: Repl(source, target))]
+        for depth in depths:
+            runs.append((
+                'http depth {}'.format(depth),
+                lambda target, depth=depth: remote_repl(target, depth, False),
+            ))
+        runs.append(('http _bulk_get', lambda target: remote_repl(target, depths[-1], None)))
+
+        for i, (name, make_repl) in enumerate(runs):
+            target = DB('target{}'.format(i))
+            server.dbs[target.name] = target
+            repl = make_repl(target)
+            t = time.time()
+            repl.replicate()
+            t = time.time() - t
+            print('replicate {:>14}: {:8.0f} docs/s'.format(name, count / t))
+            for db in (repl.source, repl.target):
+                if isinstance(db, RemoteDB):
+                    db.close()
+    finally:
+        server.stop()
+
+
+def bench_fanout(count=2000, fanouts=(1, 4, 16)):
+    """Replication to several targets over HTTP, a `Repl` per target
+    against one `FanoutRepl`, with the load of the source: the changes
+    it read and the revisions it gave.
+    """
+    source = DB('source')
+    for i in range(count):
+        source.put({'number': i, 'text': 'x' * 100})
+
+    load = {'changes': 0, 'revs': 0}
+    changes_get, get_bulk = source.changes_get, source.get_bulk
+
+    def counting_changes_get(*args, **kwargs):
+        for change in changes_get(*args, **kwargs):
+            load['changes'] += 1
+            yield change
+
+    def counting_get_bulk(pairs, *args, **kwargs):
+        load['revs'] += len(pairs)
+        return get_bulk(pairs, *args, **kwargs)
+
+    source.changes_get, source.get_bulk = counting_changes_get, counting_get_bulk
+
+    server = Server(('127.0.0.1', 0), {'source': source})
+    server.start()
+    remotes = [RemoteDB(server.url + '/source')]
+    try:
+        for n in fanouts:
+            for name in ('repls', 'fanout'):
+                targets = []
+                for i in range(n):
+                    server.dbs['target{}'.format(i)] = DB('target{}'.format(i))
+                    targets.append(RemoteDB(server.url + '/target{}'.format(i)))
+                remotes.extend(targets)
+                load.update(changes=0, revs=0)
+
+                t = time.time()
+                if name == 'fanout':
+                    FanoutRepl(remotes[0], targets).replicate()
+                else:
+                    for target in targets:
+                        Repl(remotes[0], target).replicate()
+                t = time.time() - t
+                print('{:>2} targets {:>6}: {:8.0f} docs/s, source read {:6d} changes, {:6d} revs'.format(
+                    n, name, count * n / t, load['changes'], load['revs']))
+    finally:
+        for remote in remotes:
+            remote.close()
+        server.stop()
+
+
+def bench_sharded(count=20000, shards=(1, 2, 4), batch_size=1000):
+    """Bulk writes and replication of a DB against sharded databases
+    with a worker process per shard.
+    """
+    source = DB('source')
+    for i in range(count):
+        source.put({'number': i, 'text': 'x' * 100})
+    results = [
+        result._replace(revs=[result.rev])
+        for result in source.get_bulk([(uid, source.storage[uid].winner) for uid in source.storage])
+    ]
+
+    runs = [('DB', lambda: DB('target'))]
+    runs.extend(
+        ('{} shards'.format(n), lambda n=n: ShardedDB('target', n)) for n in shards)
+    for name, make_db in runs:
+        db = make_db()
+        try:
+            t = time.time()
+            for i in range(0, count, batch_size):
+                db.put_bulk(results[i:i + batch_size])
+            t = time.time() - t
+            print('put_bulk {:>9}: {:8.0f} docs/s'.format(name, count / t))
+
+            target = DB('copy')
+            t = time.time()
+            Repl(db, target, batch_size).replicate()
+            t = time.time() - t
+            print('replicate {:>8}: {:8.0f} docs/s'.format(name, count / t))
+        finally:
+            if isinstance(db, ShardedDB):
+                db.close()
+
+
+def bench_view(count=100000, number=1000):
+    """Key queries of a view against scanning the documents."""
+    db = DB('view')
+    for i in range(count):
+        db.put({'number': i % 1000})
+
+    def by_number(result):
+        yield result.value['number'], None
+
+    view = View(db, 'by_number', by_number)
+    t = time.time()
+    view.update()
+    print('view build of {} docs: {:8.0f} docs/s'.format(count, count / (time.time() - t)))
+
+    t = timeit.timeit(lambda: view.query(key=500, stale=True), number=number) / number
+    print('view query: {:10.3f} ms'.format(t * 1e3))
+
+    def scan():
+        return [uid for uid in db.storage if db.get(uid).value['number'] == 500]
+
+    t = timeit.timeit(scan, number=1)
+    print('full scan:  {:10.3f} ms'.format(t * 1e3))
+
+
+def bench_all_docs(count=200000, page=100, number=1000):
+    """A page of documents by uid against sorting all the uids."""
+    db = DB('all_docs')
+    for i in range(count):
+        db.put(i)
+    startkey = db.uid()
+
+    t = timeit.timeit(lambda: list(db.all_docs(startkey, limit=page)), number=number) / number
+    print('all_docs page of {}: {:10.3f} ms'.format(page, t * 1e3))
+
+    def sort():
+        uids = sorted(db.storage)
+        return uids[bisect_left(uids, startkey):][:page]
+
+    t = timeit.timeit(sort, number=1)
+    print('sorting the uids:    {:10.3f} ms'.format(t * 1e3))
+
+
+if __name__ == '__main__':
+    bench_new_rev()
+    bench_memory()
+    bench_put_depth()
+    bench_put_conflicts()
+    bench_put_bulk()
+    bench_repl_http()
+    bench_fanout()
+    bench_sharded()
+    bench_view()
+    bench_all_docs()
@@ -0,0 +1,451 @@
+"""`DB` of another node, used over the CouchDB HTTP API.
+
+`RemoteDB` has the methods `Repl` calls, so a replication can pull from
+or push to a server as if it was a local database.
+"""
+from collections import defaultdict
+from urllib import quote, urlencode
+from urlparse import urlparse
+import base64
+import httplib
+import json
+import socket
+import threading
+import time
+import uuid
+import zlib
+
+from .db import Change, Result
+from .exceptions import DataError, NotFoundError, RemoteError
+from .server import json_to_result, result_to_json
+
+GZIP = 16 + zlib.MAX_WBITS  # zlib window bits of the gzip format
+
+
+def gzip_compress(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP)
+    return compressor.compress(data) + compressor.flush()
+
+
+def gzip_decompress(data):
+    return zlib.decompress(data, GZIP)
+
+
+class Connection(object):
+    """Keep-alive HTTP connection which can send requests without waiting
+    for the responses, `httplib` reads them back in order.
+    """
+
+    def __init__(self, host, port, timeout):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.closed = False
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def receive(self, method):
+        """Status and decoded JSON body of the next response, a list of
+        the lines for NDJSON.
+        """
+        response = httplib.HTTPResponse(self.sock, method=method)
+        response.begin()
+        data = response.read()
+        if response.will_close:
+            self.close()
+
+        if response.getheader('content-encoding') == 'gzip':
+            data = gzip_decompress(data)
+        if response.getheader('content-type', '').startswith('application/x-ndjson'):
+            return response.status, [json.loads(line) for line in data.splitlines() if line]
+        return response.status, json.loads(data) if data else None
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.sock.close()
+
+
+class RemoteDB(object):
+    """Database at `url` like `http://host:5984/name`.
+
+    Requests go through a pool of keep-alive connections. Revisions are
+    fetched with `_bulk_get`, or document GETs when the server does not
+    have it. Batches of requests are pipelined,
+    bodies of `compress_size` bytes and more are gzipped. A request
+    failed on the network or with a 5xx status is retried `retries`
+    times, waiting `backoff` seconds doubled on each attempt.
+    """
+
+    def __init__(self, url, pool_size=4, timeout=60, retries=3, backoff=0.1,
+                 chunk_size=1000, pipeline_depth=100, compress_size=1024, blobs_size=16):
+        self.name = url.rstrip('/')
+        url = urlparse(self.name)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.path = url.path
+
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.chunk_size = chunk_size  # documents in a `_bulk_docs` or `_revs_diff`
+        self.pipeline_depth = pipeline_depth  # requests sent without waiting
+        self.compress_size = compress_size
+        self.blobs_size = blobs_size  # attachment bodies in a request
+
+        self.pool = []  # idle connections
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self._watcher = None  # connection polling changes for subscribers
+        self.bulk_get = None  # whether the server has `_bulk_get`, `None` until known
+
+    def close(self):
+        with self.lock:
+            pool, self.pool = self.pool, []
+        for conn in pool:
+            conn.close()
+
+    def get(self, uid, rev=None, revs=False):
+        status, body = self._request('GET', self._doc_path(uid, rev))
+        return self._get_result(status, body, revs)
+
+    def get_bulk(self, pairs, revs=False):
+        """Get many revisions at once.
+
+        Like `DB.get_bulk` a missing revision gives a `NotFoundError`.
+        """
+        pairs = list(pairs)
+        if self.bulk_get is not False:
+            res = self._bulk_get(pairs, revs)
+            if res is not None:
+                return res
+
+        responses = self._pipeline([('GET', self._doc_path(uid, rev), None) for uid, rev in pairs])
+
+        res = []
+        for status, body in responses:
+            try:
+                res.append(self._get_result(status, body, revs))
+            except NotFoundError as e:
+                res.append(e)
+        return res
+
+    def put(self, value, uid=None, rev=None):
+        uid = uid or self.uid()
+        body = result_to_json(Result(uid, rev, value, False, None))
+        if rev is None:
+            del body['_rev']
+
+        status, body = self._request('PUT', self._path(quote(uid, '')), body)
+        self._check(status, body)
+        return Result(uid, body['rev'], value, False, rev)
+
+    def put_bulk(self, results):
+        """Bulk adding of revisions, `_bulk_docs` with `new_edits:false`."""
+        results = list(results)
+        chunks = [results[i:i + self.chunk_size] for i in range(0, len(results), self.chunk_size)]
+        responses = self._pipeline([
+            ('POST', self._path('_bulk_docs'), {
+                'docs': [result_to_json(result) for result in chunk],
+                'new_edits': False,
+            })
+            for chunk in chunks
+        ])
+
+        errors = {}
+        for status, body in responses:
+            self._check(status, body)
+            for error in body:
+                errors[error['id'], error['rev']] = DataError(error.get('reason'))
+        return [errors.get((result.uid, result.rev), result) for result in results]
+
+    def remove(self, uid, rev):
+        path = self._path(quote(uid, '')) + '?' + urlencode({'rev': rev})
+        status, body = self._request('DELETE', path)
+        self._check(status, body)
+        return Result(uid, body['rev'], None, True, rev)
+
+    def changes_get(self, since=0, style='all_docs'):
+        return self._changes('GET', {'since': since, 'style': style})
+
+    def changes_get_filtered(self, since=0, style='all_docs', filter=None, params=None):
+        """Changes filtered by the server, the params are sent in the
+        body so a selector or a long list of doc_ids fits.
+        """
+        query = {'since': since, 'style': style, 'filter': filter}
+        return self._changes('POST', query, params or {})
+
+    def _changes(self, method, query, params=None):
+        """Pages of `_changes`, `chunk_size` results each. A `last_seq`
+        past the last result, of a filtered feed, ends the feed as
+        `Change(None, None, last_seq)` like the feeds of `DB`.
+        """
+        query = dict(query, limit=self.chunk_size)
+        while True:
+            path = self._path('_changes') + '?' + urlencode(query)
+            status, body = self._request(method, path, params)
+            self._check(status, body)
+
+            listed = query['since']
+            for result in body['results']:
+                for change in result['changes']:
+                    yield Change(result['id'], change['rev'], result['seq'])
+                listed = result['seq']
+
+            query['since'] = body['last_seq']
+            if len(body['results']) < self.chunk_size:
+                if body['last_seq'] != listed:
+                    yield Change(None, None, body['last_seq'])
+                return
+
+    def changes_get_size(self):
+        return self._info()['doc_count']
+
+    def changes_get_seq(self):
+        return self._info()['update_seq']
+
+    def seq_min(self, seqs):
+        return min(seqs)
+
+    def change_newer(self, change, since):
+        return change.seq > since
+
+    def changes_get_diff(self, grouped):
+        items = list(grouped.iteritems())
+        responses = self._pipeline([
+            ('POST', self._path('_revs_diff'), dict(items[i:i + self.chunk_size]))
+            for i in range(0, len(items), self.chunk_size)
+        ])
+
+        res = defaultdict(list)
+        for status, body in responses:
+            self._check(status, body)
+            for uid, diff in body.iteritems():
+                res[uid].extend(diff['missing'])
+        return res
+
+    def changes_subscribe(self, callback):
+        """Call `callback(uid, seq)` on changes, noticed by a long poll."""
+        since = self.changes_get_seq()
+        with self.lock:
+            self.subscribers.append(callback)
+            if self._watcher is None:
+                self._watcher = Connection(self.host, self.port, None)
+                thread = threading.Thread(target=self._watch, args=(self._watcher, since))
+                thread.daemon = True
+                thread.start()
+
+    def changes_unsubscribe(self, callback):
+        with self.lock:
+            self.subscribers.remove(callback)
+            if not self.subscribers and self._watcher is not None:
+                self._watcher.close()
+                self._watcher = None
+
+    def blobs_get(self, digests):
+        digests = list(digests)
+        responses = self._pipeline([
+            ('POST', self._path('_blobs_get'), {'digests': digests[i:i + self.blobs_size]})
+            for i in range(0, len(digests), self.blobs_size)
+        ])
+
+        res = {}
+        for status, body in responses:
+            self._check(status, body)
+            for digest, data in body['blobs'].iteritems():
+                res[digest] = base64.b64decode(data)
+        return res
+
+    def blobs_put(self, blobs):
+        items = [(digest, base64.b64encode(data)) for digest, data in blobs.iteritems()]
+        responses = self._pipeline([
+            ('POST', self._path('_blobs'), {'blobs': dict(items[i:i + self.blobs_size])})
+            for i in range(0, len(items), self.blobs_size)
+        ])
+        for status, body in responses:
+            self._check(status, body)
+
+    def blobs_get_diff(self, digests):
+        digests = list(digests)
+        responses = self._pipeline([
+            ('POST', self._path('_blobs_diff'), {'digests': digests[i:i + self.chunk_size]})
+            for i in range(0, len(digests), self.chunk_size)
+        ])
+
+        res = []
+        for status, body in responses:
+            self._check(status, body)
+            res.extend(body['missing'])
+        return res
+
+    def local_put(self, uid, value):
+        body = result_to_json(Result('_local/' + uid, None, value, False, None))
+        del body['_rev']
+        status, body = self._request('PUT', self._path('_local', quote(uid, '')), body)
+        self._check(status, body)
+
+    def local_get(self, uid, default=0):
+        status, body = self._request('GET', self._path('_local', quote(uid, '')))
+        if status == 404:
+            return default
+        self._check(status, body)
+        return json_to_result(body).value
+
+    def uid(self):
+        return str(uuid.uuid4())
+
+    def _watch(self, conn, since, poll_timeout=30000):
+        try:
+            while not conn.closed:
+                path = self._path('_changes') + '?' + urlencode(
+                    {'feed': 'longpoll', 'since': since, 'timeout': poll_timeout})
+                conn.send(self._encode('GET', path, None))
+                status, body = conn.receive('GET')
+                self._check(status, body)
+
+                with self.lock:
+                    subscribers = list(self.subscribers) if not conn.closed else []
+                for result in body['results']:
+                    for callback in subscribers:
+                        callback(result['id'], result['seq'])
+                since = body['last_seq']
+        except (socket.error, httplib.HTTPException, RemoteError):
+            pass  # closed by `changes_unsubscribe` or the server went away
+        finally:
+            conn.close()
+
+    def _bulk_get(self, pairs, revs):
+        """`get_bulk` over `_bulk_get`, `None` if the server lacks it."""
+        path = self._path('_bulk_get') + '?revs=true'
+        responses = self._pipeline([
+            ('POST', path, {'docs': [
+                {'id': uid, 'rev': rev} if rev is not None else {'id': uid}
+                for uid, rev in pairs[i:i + self.chunk_size]
+            ]})
+            for i in range(0, len(pairs), self.chunk_size)
+        ], 'application/x-ndjson, application/json')
+
+        if self.bulk_get is None:
+            # older CouchDB takes `_bulk_get` for a document ID
+            status, _ = responses[0] if responses else (200, None)
+            if status in (400, 404, 405, 501):
+                self.bulk_get = False
+                return None
+            if responses:
+                self.bulk_get = True
+
+        res = []
+        for status, body in responses:
+            self._check(status, body)
+            if isinstance(body, dict):  # the CouchDB JSON format
+                body = [item for result in body['results'] for item in result['docs']]
+            for item in body:
+                if 'ok' in item:
+                    result = json_to_result(item['ok'])
+                    res.append(result if revs else result._replace(revs=None))
+                else:
+                    res.append(NotFoundError(item['error'].get('reason') or 'missing'))
+        return res
+
+    def _info(self):
+        status, body = self._request('GET', self._path())
+        self._check(status, body)
+        return body
+
+    def _get_result(self, status, body, revs):
+        self._check(status, body)
+        result = json_to_result(body)
+        return result if revs else result._replace(revs=None)
+
+    def _check(self, status, body):
+        if status < 300:
+            return
+        reason = body.get('reason') if isinstance(body, dict) else None
+        if status == 404:
+            raise NotFoundError(reason or 'missing')
+        if status in (400, 409, 412):
+            raise DataError(reason)
+        raise RemoteError(status, body)
+
+    def _path(self, *parts):
+        return '/'.join((self.path,) + parts)
+
+    def _doc_path(self, uid, rev):
+        # the history is always asked for, it gives the parent
+        query = {'revs': 'true'}
+        if rev is not None:
+            query['rev'] = rev
+        return self._path(quote(uid, '')) + '?' + urlencode(query)
+
+    def _encode(self, method, path, body, accept='application/json'):
+        headers = [
+            '{} {} HTTP/1.1'.format(method, path),
+            'Host: {}:{}'.format(self.host, self.port),
+            'Accept: ' + accept,
+            'Accept-Encoding: gzip',
+        ]
+        data = ''
+        if body is not None:
+            data = json.dumps(body)
+            headers.append('Content-Type: application/json')
+            if len(data) >= self.compress_size:
+                data = gzip_compress(data)
+                headers.append('Content-Encoding: gzip')
+        headers.append('Content-Length: {}'.format(len(data)))
+        return '\r\n'.join(headers) + '\r\n\r\n' + data
+
+    def _request(self, method, path, body=None):
+        return self._pipeline([(method, path, body)])[0]
+
+    def _pipeline(self, requests, accept='application/json'):
+        """Send `(method, path, body)` requests, give `(status, body)` of each.
+
+        Up to `pipeline_depth` requests are sent before reading their
+        responses. On a failure the requests without a response are sent
+        again over a new connection.
+        """
+        responses = []
+        failures = 0
+        while len(responses) < len(requests):
+            pending = requests[len(responses):len(responses) + self.pipeline_depth]
+            conn = None
+            try:
+                conn = self._acquire()
+                conn.send(''.join(self._encode(*request, accept=accept) for request in pending))
+                for method, _, _ in pending:
+                    status, body = conn.receive(method)
+                    if status >= 500:
+                        raise RemoteError(status, body)
+                    responses.append((status, body))
+            except (socket.error, httplib.HTTPException, RemoteError) as e:
+                if conn is not None:
+                    conn.close()
+                failures += 1
+                if failures > self.retries:
+                    if isinstance(e, RemoteError):
+                        raise
+                    method, path, _ = requests[len(responses)]
+                    raise RemoteError(None, '{} {}: {!r}'.format(method, path, e))
+                time.sleep(self.backoff * 2 ** (failures - 1))
+            finally:
+                if conn is not None:
+                    self._release(conn)
+        return responses
+
+    def _acquire(self):
+        with self.lock:
+            if self.pool:
+                return self.pool.pop()
+        return Connection(self.host, self.port, self.timeout)
+
+    def _release(self, conn):
+        with self.lock:
+            if not conn.closed and len(self.pool) < self.pool_size:
+                self.pool.append(conn)
+                return
+        conn.close()
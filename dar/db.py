@@ -1,34 +1,128 @@
 from collections import defaultdict, OrderedDict, namedtuple
-from itertools import islice
+from contextlib import contextmanager
 from functools import partial
+from itertools import groupby
+import base64
+import hashlib
+import threading
 import uuid
 
-from .doc import Document, Revision
+from .doc import get_hasher, rev_generation, Revision
 from .exceptions import DataError, NotFoundError
+from .selector import compile_selector
+from .storage import ConflictIndex, IdIndex, Storage
 
-Result = namedtuple('Result', 'uid rev value deleted parent')
+Result = namedtuple('Result', 'uid rev value deleted parent revs')
+Result.__new__.__defaults__ = (None,)
 Res = partial(Result, deleted=False)
+Change = namedtuple('Change', 'uid rev seq')
+DocRow = namedtuple('DocRow', 'uid rev doc')
+
+
+def intern_uid(uid):
+    """One shared copy of a uid for the storage and the changes log."""
+    if isinstance(uid, unicode):
+        try:
+            uid = uid.encode('ascii')
+        except UnicodeEncodeError:
+            return uid
+    return intern(uid) if isinstance(uid, str) else uid
+
+
+def blob_digest(data):
+    """Content address of an attachment body, the `digest` of CouchDB."""
+    return 'md5-' + base64.b64encode(hashlib.md5(data).digest())
+
+
+def attachment_digests(value):
+    """Digests of the attachments referenced by a document value."""
+    if isinstance(value, dict):
+        for stub in (value.get('_attachments') or {}).itervalues():
+            if isinstance(stub, dict) and 'digest' in stub:
+                yield stub['digest']
+
+
+def filter_doc(result):
+    """Document a filter selector is matched against, like in CouchDB."""
+    doc = dict(result.value) if isinstance(result.value, dict) else {}
+    doc['_id'] = result.uid
+    doc['_rev'] = result.rev
+    if result.deleted:
+        doc['_deleted'] = True
+    return doc
+
+
+def group_changes(changes):
+    """Group changes feed entries by document uid, leaving out the
+    last seq a filtered feed ends with.
+    """
+    res = defaultdict(list)
+    for change in changes:
+        if change.uid is not None:
+            res[change.uid].append(change.rev)
+    return res
 
 
 class DB(object):
-    def __init__(self, name):
+    """In-memory database, safe to share between threads.
+
+    Writers of a document hold the lock of its stripe, one of `stripes`
+    locks picked by the uid, so writes of different documents do not
+    wait for each other. The changes log, `ids` and `blobs` are updated
+    holding `lock` for a moment, always taken after the stripe. Reads of
+    a document hold its stripe too, a `Document` is never seen halfway
+    through an update. `changes_get` reads a snapshot of the log.
+    """
+
+    def __init__(self, name, hasher='md5', stripes=64):
         self.name = name
-        self.storage = defaultdict(Document)
-        self.changes = OrderedDict()
+        self.hasher = get_hasher(hasher)  # makes IDs of new revisions
+        self.storage = Storage()
+        self.ids = IdIndex()  # sorted uids, for `all_docs`
+        self.conflicted = ConflictIndex()  # documents with open conflicts, for `conflicts_get`
+        self.changes = OrderedDict()  # uid -> seq of its latest change
+        self.changes_seq = {}  # seq -> uid
+        self.seq = 0  # last assigned sequence number
         self.local = {}  # local storage
+        self.blobs = {}  # attachment bodies by digest, stored once
+        self.subscribers = []  # callbacks notified by `changes_put`
+        self.revs_limit = 1000  # revisions kept by `compact` for each leaf
+        self.filters = {}  # name -> `func(result, params)` for `changes_get_filtered`
+
+        self.lock = threading.RLock()  # the changes log and the indexes
+        self.stripes = [threading.RLock() for _ in xrange(stripes)]  # documents by uid
+        self.snapshots = []  # last seqs of the feeds being read
+        self.retired = {}  # seq -> (uid, seq it moved to), kept for the snapshots
+
+    def stripe(self, uid):
+        """Lock of the document `uid`."""
+        return self.stripes[hash(uid) % len(self.stripes)]
+
+    @contextmanager
+    def exclusive(self):
+        """Hold all the locks, nothing else runs meanwhile."""
+        for stripe in self.stripes:
+            stripe.acquire()
+        try:
+            with self.lock:
+                yield
+        finally:
+            for stripe in reversed(self.stripes):
+                stripe.release()
 
     def put(self, value, uid=None, rev=None):
-        if uid is None:
-            uid = self.uid()
-
-        document = self.storage[uid]
+        uid = intern_uid(self.uid() if uid is None else uid)
+        with self.stripe(uid):
+            document = self.storage[uid]
 
-        if not len(document) and rev is not None:
-            raise DataError('passing rev for new doc')
+            if not len(document) and rev is not None:
+                raise DataError('passing rev for new doc')
 
-        new_rev, _ = document.put(value, rev)
+            value = self.attachments_put(value, rev_generation(rev) + 1 if rev else 1)
+            new_rev, _ = document.put(value, rev, self.hasher)
 
-        self.changes_put(uid, new_rev)
+            self.storage.add(uid, document)
+            self.changes_put(uid)
 
         return Result(uid, new_rev, value, False, rev)
 
@@ -36,7 +130,8 @@ class DB(object):
         """Bulk adding of revisions.
 
         Similar to http://wiki.apache.org/couchdb/HTTP_Bulk_Document_API
-        in `"new_edits":false`
+        in `"new_edits":false`. Ancestors listed in `revs` of a result
+        and missing here are added as stubs without a body.
 
         Params:
             `results` list of `Result` tuples
@@ -45,65 +140,394 @@ class DB(object):
 
     def _put_existing(self, result):
         rev = result.rev
-        revision = Revision(
-            value=result.value,
-            deleted=result.deleted,
-            parent=result.parent
-        )
-
-        document = self.storage[result.uid]
-        try:
-            document.put_existing(rev, revision)
-        except DataError as e:
-            return e
-        self.changes_put(result.uid, rev)
+        uid = intern_uid(result.uid)
+        with self.stripe(uid):
+            document = self.storage[uid]
+            if rev in document:
+                return result
+
+            try:
+                revision = Revision(
+                    value=self.attachments_put(result.value, rev_generation(rev)),
+                    deleted=result.deleted,
+                    parent=result.parent
+                )
+                document.put_existing(rev, revision, result.revs)
+            except DataError as e:
+                return e
+            self.storage.add(uid, document)
+            self.changes_put(uid)
         return result
 
-    def get(self, uid, rev=None):
-        if uid not in self.storage:
-            raise NotFoundError
+    def get(self, uid, rev=None, revs=False):
+        """Get the winner or the given revision of a document.
 
-        document = self.storage[uid]
-        rev, revision = document.get(rev)
+        With `revs` the result carries the revision history, similar to
+        `?revs=true` of CouchDB.
+        """
+        with self.stripe(uid):
+            if uid not in self.storage:
+                raise NotFoundError
 
-        if revision.deleted:
-            raise NotFoundError
+            document = self.storage[uid]
+            deleted_ok = rev is not None
+            rev, revision = document.get(rev)
 
-        return Result(uid, rev, revision.value, revision.deleted, revision.parent)
+            # a deleted revision is only returned when asked for explicitly
+            if revision.deleted and not deleted_ok:
+                raise NotFoundError
 
-    def remove(self, uid, rev):
-        if uid not in self.storage:
-            raise NotFoundError
+            if revision.stub:
+                raise NotFoundError('missing')
 
-        document = self.storage[uid]
+            return Result(
+                uid, rev, revision.value, revision.deleted, revision.parent,
+                document.revs(rev, self.revs_limit) if revs else None
+            )
+
+    def get_bulk(self, pairs, revs=False):
+        """Get many revisions at once.
+
+        Similar to `_bulk_get` of Couchbase Sync Gateway.
+
+        Params:
+            `pairs` list of `(uid, rev)` tuples
 
-        new_rev, revision = document.remove(rev)
+        Returns a list of `Result` tuples, a missing revision gives
+        a `NotFoundError` at its position instead.
+        """
+        res = []
+        for uid, rev in pairs:
+            try:
+                res.append(self.get(uid, rev, revs))
+            except NotFoundError as e:
+                res.append(e)
+        return res
 
-        self.changes_put(uid, new_rev)
+    def remove(self, uid, rev):
+        uid = intern_uid(uid)
+        with self.stripe(uid):
+            if uid not in self.storage:
+                raise NotFoundError
+
+            document = self.storage[uid]
+            new_rev, revision = document.remove(rev, self.hasher)
+            self.changes_put(uid)
 
         return Result(uid, new_rev, revision.value, revision.deleted, revision.parent)
 
-    def changes_put(self, uid, rev):
-        self.changes[(uid, rev)] = None
+    def all_docs(self, startkey=None, endkey=None, limit=None, skip=0, descending=False,
+                 include_docs=False, inclusive_end=True):
+        """Documents in the order of their uids, like `_all_docs` of CouchDB.
 
-    def changes_get(self, since=0):
-        return islice(self.changes.iterkeys(), since, None)
+        Gives `DocRow` tuples of the documents from `startkey` to `endkey`
+        as they are read, with the `Result` of the winner in `doc` if
+        `include_docs`. Deleted documents are left out. A page costs the
+        log of the number of documents plus its size.
+        """
+        rows = self.ids.range(startkey, endkey, inclusive_end, descending, skip, limit)
+        for uid, rev in rows:
+            yield DocRow(uid, rev, self.get(uid, rev) if include_docs else None)
+
+    def compact(self):
+        """Drop bodies of non-leaf revisions and stem the revision trees.
+
+        Similar to `_compact` of CouchDB, the history of each leaf is cut
+        to `revs_limit` revisions. The changes log is not touched.
+        Attachment bodies no longer referenced are dropped, including one
+        stored by `blobs_put` for a revision which is not written yet. It
+        runs alone, holding all the locks.
+        """
+        with self.exclusive():
+            referenced = set()
+            for uid in list(self.storage):
+                document = self.storage[uid]
+                if document.compact(self.revs_limit):
+                    self.compact_put(uid)
+                for revision in document.itervalues():
+                    if revision.value is not None:
+                        referenced.update(attachment_digests(self.load_value(revision.value)))
+
+            for digest in [digest for digest in self.blobs if digest not in referenced]:
+                del self.blobs[digest]
+
+    def compact_put(self, uid):
+        """Store a compacted document, nothing to do in memory."""
+
+    def load_value(self, value):
+        """Value of a stored revision, engines may keep it unloaded."""
+        return value
+
+    def attachment_put(self, uid, rev, name, data, content_type='application/octet-stream'):
+        """Add or replace an attachment, making a new revision.
+
+        Similar to `PUT /db/doc/attachment?rev=` of CouchDB, without `rev`
+        a new document is created. The document value has to be a dict.
+        """
+        with self.stripe(uid):
+            value = {}
+            if rev is not None:
+                value = self.get(uid, rev).value
+                if not isinstance(value, dict):
+                    raise DataError('attachments need a dict value')
+                value = dict(value)
+
+            attachments = dict(value.get('_attachments') or {})
+            attachments[name] = {'content_type': content_type, 'data': data}
+            value['_attachments'] = attachments
+            return self.put(value, uid, rev)
+
+    def attachment_get(self, uid, name, rev=None):
+        """Stub and body of an attachment of the winner or `rev`."""
+        value = self.get(uid, rev).value
+        stub = (value.get('_attachments') or {}).get(name) if isinstance(value, dict) else None
+        if stub is None:
+            raise NotFoundError('Document is missing attachment')
+        return stub, self.blobs[stub['digest']]
+
+    def attachment_remove(self, uid, rev, name):
+        with self.stripe(uid):
+            value = self.get(uid, rev).value
+            attachments = dict(value.get('_attachments') or {}) if isinstance(value, dict) else {}
+            if attachments.pop(name, None) is None:
+                raise NotFoundError('Document is missing attachment')
+
+            value = dict(value, _attachments=attachments)
+            if not attachments:
+                del value['_attachments']
+            return self.put(value, uid, rev)
+
+    def attachments_put(self, value, revpos):
+        """Store the attachment bodies given in `data` of a value.
+
+        Like in CouchDB `_attachments` of a value maps names to stubs
+        (`content_type`, `digest`, `length`, `revpos`), a body is stored
+        once for its digest. An attachment with `data` gets its body
+        stored and is turned into a stub of `revpos`, a stub has to refer
+        to a stored body.
+        """
+        if not isinstance(value, dict) or '_attachments' not in value:
+            return value
+
+        attachments = value['_attachments']
+        if not isinstance(attachments, dict):
+            raise DataError('_attachments has to be a dict')
+
+        stubs = {}
+        for name, attachment in attachments.iteritems():
+            if not isinstance(attachment, dict):
+                raise DataError('invalid attachment {!r}'.format(name))
+            if 'data' in attachment:
+                data = attachment['data']
+                digest = blob_digest(data)
+                with self.lock:
+                    if digest not in self.blobs:
+                        self.blobs[digest] = data
+                stub = {
+                    'content_type': attachment.get('content_type', 'application/octet-stream'),
+                    'digest': digest,
+                    'length': len(data),
+                    'revpos': revpos,
+                    'stub': True,
+                }
+            else:
+                if attachment.get('digest') not in self.blobs:
+                    raise DataError('missing attachment body of {!r}'.format(name))
+                stub = dict(attachment, stub=True)
+            stubs[name] = stub
+
+        return dict(value, _attachments=stubs)
+
+    def blobs_get(self, digests):
+        """Attachment bodies by digest, missing ones are left out."""
+        blobs = self.blobs
+        return dict((digest, blobs[digest]) for digest in digests if digest in blobs)
+
+    def blobs_put(self, blobs):
+        """Store attachment bodies given by their digests."""
+        for digest, data in blobs.iteritems():
+            if blob_digest(data) != digest:
+                raise DataError('attachment body does not match {}'.format(digest))
+            with self.lock:
+                if digest not in self.blobs:
+                    self.blobs[digest] = data
+
+    def blobs_get_diff(self, digests):
+        """Digests of the attachment bodies missing here, the counterpart
+        of `changes_get_diff` for attachments.
+        """
+        return [digest for digest in digests if digest not in self.blobs]
+
+    def changes_put(self, uid):
+        """Move the document to the end of the changes log.
+
+        A document has a single entry in the log, its previous entry
+        is dropped, or retired while a snapshot still lists it there.
+        Called holding the stripe of the document.
+        """
+        document = self.storage[uid]
+        with self.lock:
+            self.seq += 1
+            seq = self.changes.pop(uid, None)
+            if seq is not None:
+                if self.snapshots and seq <= max(self.snapshots):
+                    # retired before it is dropped, a feed always finds one of them
+                    self.retired[seq] = (uid, self.seq)
+                del self.changes_seq[seq]
+
+            self.changes[uid] = self.seq
+            self.changes_seq[self.seq] = uid
+            self.ids.put(uid, document.winner, document.deleted)
+            self.conflicted.put(uid, self.seq, bool(document.conflicts and document.open_conflicts))
+
+            self.changes_notify(uid, self.seq)
+            return self.seq
+
+    def changes_notify(self, uid, seq):
+        # a callback may unsubscribe itself
+        for callback in list(self.subscribers):
+            callback(uid, seq)
+
+    def changes_subscribe(self, callback):
+        """Call `callback(uid, seq)` on every change."""
+        with self.lock:
+            self.subscribers.append(callback)
+
+    def changes_unsubscribe(self, callback):
+        with self.lock:
+            self.subscribers.remove(callback)
+
+    def changes_get(self, since=0, style='all_docs'):
+        """Changes feed, `Change` tuples with sequence numbers above `since`.
+
+        Each changed document is listed once, at its latest sequence
+        number, with its current leafs only. Similar to the `style`
+        parameter of CouchDB `_changes`, `'all_docs'` gives all the
+        leafs and `'main_only'` gives just the winner.
+
+        The feed reads a snapshot of the log taken when it starts, writes
+        going on meanwhile do not disturb it. A document changed since is
+        listed at its seq of the snapshot, the new change is left to the
+        next feed.
+        """
+        with self.lock:
+            last = self.seq
+            self.snapshots.append(last)
+        try:
+            for seq in xrange(since + 1, last + 1):
+                uid = self.changes_seq.get(seq)
+                if uid is None:
+                    uid, moved = self.retired.get(seq, (None, 0))
+                    if moved <= last:
+                        continue  # superseded in the snapshot
+
+                with self.stripe(uid):
+                    document = self.storage[uid]
+                    winner = document.winner
+                    conflicts = sorted(document.conflicts) if style == 'all_docs' else ()
+
+                yield Change(uid, winner, seq)
+                for rev in conflicts:
+                    yield Change(uid, rev, seq)
+        finally:
+            with self.lock:
+                self.snapshots.remove(last)
+                if not self.snapshots:
+                    self.retired.clear()
+
+    def changes_get_filtered(self, since=0, style='all_docs', filter=None, params=None):
+        """Changes feed of the documents passing a filter, like
+        `_changes?filter=` of CouchDB.
+
+        The filter is compiled once by `filter_get` and is given the
+        `Result` of the winner of each changed document, deleted or not.
+        When the documents passed over come last, the feed ends with
+        `Change(None, None, seq)`, the `last_seq` of CouchDB, so readers
+        checkpoint past them and do not filter them again.
+        """
+        predicate = self.filter_get(filter, params)
+        scanned = listed = since
+        for uid, changes in groupby(self.changes_get(since, style), lambda change: change.uid):
+            changes = list(changes)
+            scanned = changes[0].seq
+            # the winner comes first
+            if predicate(self.get(uid, changes[0].rev)):
+                for change in changes:
+                    yield change
+                listed = scanned
+        if scanned != listed:
+            yield Change(None, None, scanned)
+
+    def filter_get(self, name, params=None):
+        """Predicate of `Result` tuples for the filter `name`.
+
+        Besides the functions registered in `filters` there are the
+        filters of CouchDB: `_doc_ids` passes the uids in `doc_ids` of
+        `params`, `_selector` the documents matching the Mango selector
+        in `selector`.
+        """
+        params = params or {}
+        if name == '_doc_ids':
+            uids = params.get('doc_ids')
+            if not isinstance(uids, list):
+                raise DataError('_doc_ids needs a list of doc_ids')
+            uids = frozenset(uids)
+            return lambda result: result.uid in uids
+
+        if name == '_selector':
+            match = compile_selector(params.get('selector'))
+            return lambda result: match(filter_doc(result))
+
+        func = self.filters.get(name)
+        if func is None:
+            raise NotFoundError('missing filter {}'.format(name))
+        return lambda result: func(result, params)
+
+    def conflicts_get(self, since=0):
+        """Feed of the documents with open conflicts changed past `since`.
+
+        Gives `Change` tuples of the winner and the open conflicts of each
+        document, at the seq of its latest change, which a resolver keeps
+        to ask for the documents conflicted since. Read from an index of
+        the conflicted documents, it costs their number, not the number
+        of documents.
+        """
+        for uid, seq in self.conflicted.range(since):
+            with self.stripe(uid):
+                document = self.storage[uid]
+                winner = document.winner
+                conflicts = sorted(document.open_conflicts)
+
+            if conflicts:  # unless resolved meanwhile
+                yield Change(uid, winner, seq)
+                for rev in conflicts:
+                    yield Change(uid, rev, seq)
 
     def changes_get_size(self):
         return len(self.changes)
 
+    def seq_min(self, seqs):
+        """Seq of the feed to read from for checkpoints at `seqs`."""
+        return min(seqs)
+
+    def change_newer(self, change, since):
+        """Whether `change` of the feed is past the checkpoint `since`."""
+        return change.seq > since
+
+    def changes_get_seq(self):
+        return self.seq
+
     def changes_get_grouped(self, since=0):
-        res = defaultdict(list)
-        for uid, rev in self.changes_get(since):
-            res[uid].append(rev)
-        return res
+        return group_changes(self.changes_get(since))
 
     def changes_get_diff(self, grouped):
         res = defaultdict(list)
         for uid, revs in grouped.iteritems():
-            for rev in revs:
-                if (uid, rev) not in self.changes:
-                    res[uid].append(rev)
+            with self.stripe(uid):
+                document = self.storage.get(uid, ())
+                for rev in revs:
+                    if rev not in document:
+                        res[uid].append(rev)
         return res
 
     def local_put(self, uid, value):
@@ -1,36 +1,230 @@
-from collections import namedtuple, OrderedDict
+from array import array
+from binascii import hexlify, unhexlify
+from collections import namedtuple, MutableMapping, OrderedDict
+from functools import partial
+from itertools import imap, islice
+from json import encoder
 import hashlib
+import heapq
+import json
+import struct
 
 from asciitree import LeftAligned
 
 from . import exceptions
 
-Revision = namedtuple('Revision', 'value deleted parent')
+Revision = namedtuple('Revision', 'value deleted parent generation stub')
+Revision.__new__.__defaults__ = (None, False)
 
 # agreement for code below:
 # `rev` is a string which is revision ID
 # `revision` is an object with `rev` property where its ID is stored
 
+# a rev ID like "N-<32 hex chars>" is kept as 20 bytes: generation and digest,
+# any other ID is kept as is after the `_RAW` marker
+_GEN = struct.Struct('>I')
+_RAW = '\xff'
+
+# `Document._tree` keeps parent position, generation and flags of a revision
+_PARENT, _GENERATION, _FLAGS = 0, 1, 2
+_WIDTH = 3
+
+# flags bits
+_DELETED = 1
+_STUB = 2
+
+# documents up to this size find revisions without a dict
+_SMALL = 8
+
+# hash functions for rev IDs, their digests are 16 bytes long
+HASHERS = {'md5': hashlib.md5}
+try:
+    HASHERS['blake2b'] = partial(hashlib.blake2b, digest_size=16)
+except AttributeError:
+    try:
+        from pyblake2 import blake2b
+        HASHERS['blake2b'] = partial(blake2b, digest_size=16)
+    except ImportError:
+        pass
+
+
+def get_hasher(name):
+    """Hash function for rev IDs by its name in `HASHERS`."""
+    try:
+        return HASHERS[name]
+    except KeyError:
+        raise ValueError('unknown hasher {}'.format(name))
+
+
+# `json` of Python 2 sorts keys only in its slow pure Python encoder, so
+# dicts are turned into sorted lists of items before the fast one runs
+if encoder.c_make_encoder is not None:
+    _encode = encoder.c_make_encoder(
+        None, json.JSONEncoder().default, encoder.encode_basestring_ascii, None,
+        ':', ',', False, False, True)
+else:
+    _encode = json.JSONEncoder(separators=(',', ':')).iterencode
+
+# exact types which never hold a dict, checking them is much faster than
+# `isinstance`, anything else is looked at by `_sort_dicts`
+_SCALARS = frozenset((str, unicode, int, long, float, bool, type(None)))
+
+
+def _sort_dicts(value):
+    if isinstance(value, dict):
+        keys = sorted(value)
+        values = map(value.__getitem__, keys)
+        if not _SCALARS.issuperset(map(type, values)):
+            values = [v if type(v) in _SCALARS else _sort_dicts(v) for v in values]
+        # a dict is wrapped so it never encodes like a list of pairs
+        return {'{': zip(keys, values)}
+
+    if isinstance(value, (list, tuple)) and not _SCALARS.issuperset(map(type, value)):
+        return [v if type(v) in _SCALARS else _sort_dicts(v) for v in value]
+    return value
+
+
+def canonical(value):
+    """JSON bytes which are the same for equal values, whatever the order
+    of dict keys is and whatever dict or list subclass holds them. It is
+    for hashing, not for reading back.
+
+    The slowdown against hashing `str` of the value, as rev IDs were made
+    before, is accepted: `str` follows the order of dict keys, so two
+    nodes could give the same edit different IDs. `bench_new_rev` measures
+    about 2x for a dict of many keys, whose sort costs about what
+    encoding them does, and about 3x for a value of many small dicts,
+    which `_sort_dicts` goes through in Python. Lists and dicts of
+    scalars are not looked at one by one. Walking the dicts as the
+    encoder reaches them, through a dict subclass, or a level at a time
+    with `map` were both measured no faster.
+    """
+    return ''.join(_canonical_chunks(value))
+
+
+def _canonical_chunks(value, size=4096):
+    """`canonical` bytes in pieces of `size` chunks of the encoder, so
+    they are hashed without being joined all at once. The chunks are
+    small, hashing them one by one is slower.
+    """
+    if type(value) not in _SCALARS:
+        value = _sort_dicts(value)
+    chunks = iter(_encode(value, 0))
+    return iter(lambda: ''.join(islice(chunks, size)), '')
+
+
+def _key(rev):
+    """Compact form of a rev ID."""
+    generation, sep, digest = rev.partition('-')
+    if (sep and len(digest) == 32 and 0 < len(generation) < 10
+            and generation.isdigit() and generation[0] != '0'):
+        try:
+            packed = unhexlify(digest)
+        except TypeError:
+            packed = None
+        if packed is not None and hexlify(packed) == digest:
+            return _GEN.pack(int(generation)) + packed
+
+    if isinstance(rev, unicode):
+        rev = rev.encode('utf-8')
+    return _RAW + rev
+
+
+def _rev(key):
+    """Rev ID of a compact `_key`."""
+    if key[0] == _RAW:
+        rev = key[1:]
+        try:
+            rev.decode('ascii')
+        except UnicodeDecodeError:
+            return rev.decode('utf-8')
+        return rev
+    return '%d-%s' % (_GEN.unpack_from(key)[0], hexlify(key[4:]))
+
+
+class _Leaf(object):
+    """Entry of the leafs heap, the best winner candidate goes first."""
+    __slots__ = ('rev', 'key')
+
+    def __init__(self, rev, revision):
+        self.rev = rev
+        self.key = (not revision.deleted, revision.generation, rev)
+
+    def __lt__(self, other):
+        return self.key > other.key
+
+
+class Document(MutableMapping):
+    """Revision tree of a document, maps rev IDs to `Revision` tuples.
+
+    Revisions are kept in flat arrays in the order they are added, a parent
+    is referred by its position. `Revision` tuples are built on access.
+
+    A document is not thread-safe, an update changes `winner` and
+    `conflicts` one after the other. `DB` holds the lock of its stripe
+    around every access.
+    """
+    __slots__ = ('_keys', '_pos', '_tree', '_values', '_winner', '_conflicts', '_leafs')
 
-class Document(OrderedDict):
     def __init__(self, *args, **kwargs):
-        super(Document, self).__init__(*args, **kwargs)
-        self.winner = None
-        self.conflicts = set()
+        self._keys = []  # compact rev IDs
+        self._pos = None  # key -> position, only for big documents
+        self._tree = array('i')  # `_WIDTH` items for each revision, a root has parent -1
+        self._values = []
+        self._winner = None
+        self._conflicts = None  # `None` while there are no conflicts
+        # heap of `_Leaf` entries, superseded leafs are dropped lazily;
+        # `None` means it has to be rebuilt from `winner` and `conflicts`
+        self._leafs = None
+        self.update(*args, **kwargs)
+
+    @property
+    def winner(self):
+        return self._winner
 
-    def put(self, value, rev=None):
+    @winner.setter
+    def winner(self, rev):
+        self._winner = rev
+        self._leafs = None
+
+    @property
+    def conflicts(self):
+        return self._conflicts or frozenset()
+
+    @property
+    def deleted(self):
+        """Whether the winner is a deleted revision."""
+        i = self._index(self._winner)
+        return i >= 0 and bool(self._tree[i * _WIDTH + _FLAGS] & _DELETED)
+
+    @property
+    def open_conflicts(self):
+        """Conflicts which are not deleted, `_conflicts` of CouchDB."""
+        tree = self._tree
+        return set(
+            rev for rev in self.conflicts
+            if not tree[self._index(rev) * _WIDTH + _FLAGS] & _DELETED
+        )
+
+    @conflicts.setter
+    def conflicts(self, revs):
+        self._conflicts = set(revs) or None
+        self._leafs = None
+
+    def put(self, value, rev=None, hasher=None):
         if rev is None:
             if len(self):
                 raise exceptions.DataError('multiple roots is not allowed')
         elif rev not in self:
             raise exceptions.DataError('unknown rev {}'.format(rev))
 
-        new_rev = self.new_rev(value, rev)
+        new_rev = self.new_rev(value, rev, hasher)
 
         revision = Revision(
             value=value,
             deleted=False,
-            parent=rev
+            parent=rev,
+            generation=self._path_length(rev)
         )
         self[new_rev] = revision
         self.update_winner(new_rev, revision)
@@ -46,29 +240,61 @@ class Document(OrderedDict):
 
         raise exceptions.NotFoundError('unknow rev {}'.format(rev))
 
-    def remove(self, rev=None):
+    def revs(self, rev, limit=None):
+        """IDs of `rev` and its ancestors, the root goes last.
+
+        No more than `limit` IDs are given if it is set.
+        """
+        i = self._index(rev)
+        if i < 0:
+            raise exceptions.NotFoundError('unknow rev {}'.format(rev))
+
+        revs = []
+        while i >= 0 and len(revs) != limit:
+            revs.append(_rev(self._keys[i]))
+            i = self._tree[i * _WIDTH + _PARENT]
+        return revs
+
+    def remove(self, rev=None, hasher=None):
         if rev is None:
             rev = self.winner
         elif rev != self.winner and rev not in self.conflicts:
             raise exceptions.DataError('only a leaf can be removed')
 
-        new_rev = self.new_rev(None, rev)
+        new_rev = self.new_rev(None, rev, hasher)
 
         revision = Revision(
             value=None,
             deleted=True,
-            parent=rev
+            parent=rev,
+            generation=self._path_length(rev)
         )
         self[new_rev] = revision
         self.update_winner(new_rev, revision)
         return new_rev, revision
 
-    def put_existing(self, rev, revision):
+    def put_existing(self, rev, revision, revs=None):
+        """Add a revision with a known ID, e.g. replicated from another node.
+
+        `revs` is the optional revision history, `rev` first and the root
+        last (as `Document.revs` gives it). Ancestors missing here are grafted
+        as stubs without a body.
+        """
         if rev in self:
             return rev
 
+        if revs:
+            if revs[0] != rev or (len(revs) > 1 and revision.parent != revs[1]):
+                raise exceptions.DataError('revision history does not match {}'.format(rev))
+            self._graft(revs[1:])
+
+            if revision.parent is not None and revision.parent not in self:
+                # the history is stemmed right above `rev`
+                revision = revision._replace(parent=None, generation=rev_generation(rev))
+
         if revision.parent is None:
-            if len(self):
+            # only a root of stemmed history can be added next to another one
+            if len(self) and not revision.generation > 1:
                 raise exceptions.DataError('multiple roots is not allowed')
         elif revision.parent not in self:
             raise exceptions.DataError('unknown parent revision {}'.format(revision.parent))
@@ -78,35 +304,217 @@ class Document(OrderedDict):
 
         return rev
 
+    def _graft(self, ancestors):
+        missing = []
+        for rev in ancestors:
+            if rev in self:
+                parent = rev
+                break
+            missing.append(rev)
+        else:
+            parent = None
+            if missing and len(self) and not rev_generation(missing[-1]) > 1:
+                raise exceptions.DataError('multiple roots is not allowed')
+
+        for rev in reversed(missing):
+            stub = Revision(
+                value=None,
+                deleted=False,
+                parent=parent,
+                generation=None if parent else rev_generation(rev),
+                stub=True
+            )
+            self[rev] = stub
+            self.update_winner(rev, stub)
+            parent = rev
+
+    def compact(self, revs_limit=None):
+        """Drop bodies of non-leaf revisions and stem the history.
+
+        Revisions further than `revs_limit` generations from every leaf
+        are removed, the oldest kept ones become roots. Returns `True` if
+        anything has changed.
+        """
+        if not len(self):
+            return False
+
+        leafs = set(self._index(rev) for rev in self.conflicts)
+        leafs.add(self._index(self.winner))
+        changed = False
+
+        if revs_limit:
+            keep = set()
+            for i in leafs:
+                n = 0
+                while i >= 0 and n < revs_limit:
+                    keep.add(i)
+                    i = self._tree[i * _WIDTH + _PARENT]
+                    n += 1
+
+            if len(keep) < len(self):
+                self._retain(keep)
+                leafs = set(self._index(rev) for rev in self.conflicts)
+                leafs.add(self._index(self.winner))
+                changed = True
+
+        for i in xrange(len(self)):
+            flags = self._tree[i * _WIDTH + _FLAGS]
+            if i not in leafs and not flags & _STUB:
+                self._tree[i * _WIDTH + _FLAGS] = flags | _STUB
+                self._values[i] = None
+                changed = True
+
+        return changed
+
     def update_winner(self, new_rev, revision):
-        leafs = set(self.conflicts)
-        if self.winner:
-            leafs.add(self.winner)
+        leafs = self._conflicts or set()
+        if self._winner:
+            leafs.add(self._winner)
 
-        if revision.parent in leafs:
-            leafs.remove(revision.parent)
+        leafs.discard(revision.parent)
         leafs.add(new_rev)
 
-        winner = max((not self[l].deleted, self._path_length(l), l) for l in leafs)
-        self.winner = winner[2]
+        if self._leafs is None or len(self._leafs) > 2 * len(leafs):
+            self._leafs = [_Leaf(l, self[l]) for l in leafs]
+            heapq.heapify(self._leafs)
+        else:
+            heapq.heappush(self._leafs, _Leaf(new_rev, self[new_rev]))
+
+        while self._leafs[0].rev not in leafs:
+            heapq.heappop(self._leafs)
+
+        self._winner = self._leafs[0].rev
+        leafs.remove(self._winner)
+
+        # the heap only pays off for a document with conflicts
+        self._conflicts = leafs or None
+        if not leafs:
+            self._leafs = None
+
+        return self._winner
+
+    def __getitem__(self, rev):
+        i = self._index(rev)
+        if i < 0:
+            raise KeyError(rev)
+        return self._revision(i)
+
+    def __setitem__(self, rev, revision):
+        parent = -1
+        if revision.parent is not None:
+            parent = self._index(revision.parent)
+            if parent < 0:
+                raise exceptions.DataError('unknown parent revision {}'.format(revision.parent))
+
+        # generation is stamped once on insert, so nobody has to walk
+        # the parents chain later on
+        generation = revision.generation
+        if generation is None:
+            generation = self._tree[parent * _WIDTH + _GENERATION] + 1 if parent >= 0 else 1
+
+        flags = (_DELETED if revision.deleted else 0) | (_STUB if revision.stub else 0)
 
-        leafs.remove(self.winner)
-        self.conflicts = leafs
+        key = _key(rev)
+        i = self._find(key)
+        if i < 0:
+            self._keys.append(key)
+            self._tree.extend((parent, generation, flags))
+            self._values.append(revision.value)
+            if self._pos is not None:
+                self._pos[key] = len(self._keys) - 1
+            elif len(self._keys) > _SMALL:
+                self._pos = dict((k, i) for i, k in enumerate(self._keys))
+        else:
+            self._tree[i * _WIDTH:(i + 1) * _WIDTH] = array('i', (parent, generation, flags))
+            self._values[i] = revision.value
 
-        return self.winner
+    def __delitem__(self, rev):
+        i = self._index(rev)
+        if i < 0:
+            raise KeyError(rev)
+        self._retain(set(xrange(len(self))) - {i})
+
+    def __contains__(self, rev):
+        return self._index(rev) >= 0
+
+    def __iter__(self):
+        return imap(_rev, self._keys)
+
+    def __reversed__(self):
+        return imap(_rev, reversed(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def iteritems(self):
+        for i, key in enumerate(self._keys):
+            yield _rev(key), self._revision(i)
+
+    def itervalues(self):
+        for i in xrange(len(self._keys)):
+            yield self._revision(i)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def _revision(self, i):
+        parent, generation, flags = self._tree[i * _WIDTH:(i + 1) * _WIDTH]
+        return Revision(
+            value=self._values[i],
+            deleted=bool(flags & _DELETED),
+            parent=_rev(self._keys[parent]) if parent >= 0 else None,
+            generation=generation,
+            stub=bool(flags & _STUB)
+        )
+
+    def _find(self, key):
+        """Position of a compact rev ID, -1 if there is none."""
+        if self._pos is None:
+            try:
+                return self._keys.index(key)
+            except ValueError:
+                return -1
+        return self._pos.get(key, -1)
+
+    def _index(self, rev):
+        """Position of a revision, -1 if there is none."""
+        if rev is None:
+            return -1
+        return self._find(_key(rev))
+
+    def _retain(self, positions):
+        """Keep only the revisions at `positions`, orphans become roots."""
+        positions = sorted(positions)
+        moved = dict((old, new) for new, old in enumerate(positions))
+
+        keys, tree, values = self._keys, self._tree, self._values
+
+        self._keys = [keys[i] for i in positions]
+        self._tree = array('i')
+        for i in positions:
+            parent, generation, flags = tree[i * _WIDTH:(i + 1) * _WIDTH]
+            self._tree.extend((moved.get(parent, -1), generation, flags))
+        self._values = [values[i] for i in positions]
+        self._pos = None
+        if len(self._keys) > _SMALL:
+            self._pos = dict((k, i) for i, k in enumerate(self._keys))
+        self._leafs = None
 
     def _path_length(self, rev):
-        l = 1
-        if rev in self:
-            l += 1
-            revision = self[rev]
-            while revision.parent:
-                l += 1
-                revision = self[revision.parent]
-        return l
+        """Generation of a child revision of `rev`."""
+        i = self._index(rev)
+        if i >= 0:
+            return self._tree[i * _WIDTH + _GENERATION] + 1
+        return 1
+
+    def new_rev(self, value, rev, hasher=None):
+        return new_rev(value, rev, lambda: str(self._path_length(rev)), hasher)
 
-    def new_rev(self, value, rev):
-        return new_rev(value, rev, prefix=lambda: str(self._path_length(rev)))
+    def __repr__(self):
+        return 'Document({!r})'.format(self.items())
 
     def __str__(self):
         d = self.__render_tree(None)
@@ -123,6 +531,23 @@ class Document(OrderedDict):
         return d
 
 
-def new_rev(value, rev, prefix=None):
+def rev_generation(rev):
+    """Generation encoded in a rev ID, 1 if there is none."""
+    try:
+        return int(rev.split('-', 1)[0])
+    except (AttributeError, ValueError):
+        return 1
+
+
+def new_rev(value, rev, prefix=None, hasher=None):
+    """ID of a revision with `value` made on top of `rev`.
+
+    The digest is taken from `canonical` bytes of both, so every node gives
+    the same ID for the same edit. `hasher` is one of `HASHERS`, MD5 by
+    default as in CouchDB.
+    """
     p = (prefix() + '-') if prefix else ''
-    return p + hashlib.md5(str(rev) + str(value)).hexdigest()
+    h = (hasher or hashlib.md5)()
+    for data in _canonical_chunks([rev, value]):
+        h.update(data)
+    return p + h.hexdigest()
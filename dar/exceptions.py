@@ -4,3 +4,10 @@ class DataError(Exception):
 
 class NotFoundError(Exception):
     pass
+
+
+class RemoteError(Exception):
+    """Unexpected response of a remote database, `args` are the status
+    and the body.
+    """
+    pass
@@ -0,0 +1,644 @@
+"""Append-only log storage for `DB`, with no dependencies.
+
+Everything goes to the end of a log file: bodies, revisions (each one
+pointing to the previous revision of its document), document states,
+local values and attachment bodies. A document state record is also the
+changes feed entry of the document.
+
+Two memory-mapped files index the log: `<path>.idx` is a hash table which
+maps uids to their latest document state (or local value) records, and
+`<path>.seq` maps sequence numbers to document state records. Opening a
+database only reads the index header and replays records appended after
+the index was last updated. Revision trees are read when a document is
+used, bodies are read on `get`. A torn record at the end of the log is
+truncated on open.
+
+`ids` and `conflicted` are saved to `<path>.docs` on `close`, with the
+log size they reflect. Opening reads them back and replays the document
+states logged after it, e.g. by a process which did not close the log.
+"""
+from collections import MutableMapping
+from contextlib import contextmanager
+import base64
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from .db import DB, Change
+from .doc import Document, Revision
+from .exceptions import DataError
+from .storage import CachedStorage, ConflictIndex, IdIndex
+
+MAGIC = 'DARLOG01'
+INDEX_MAGIC = 'DARIDX01'
+
+RECORD = struct.Struct('<II')  # payload length, payload crc32
+HEADER = struct.Struct('<8sQQQQQ')  # magic, capacity, used, docs, log_size, seq
+SLOT = struct.Struct('<QQ')  # key hash, record offset
+OFFSET = struct.Struct('<Q')
+
+
+def encode(record):
+    data = json.dumps(record, separators=(',', ':'))
+    return RECORD.pack(len(data), zlib.crc32(data) & 0xffffffff) + data
+
+
+def key_hash(key):
+    h, = OFFSET.unpack(hashlib.md5(key.encode('utf-8')).digest()[:OFFSET.size])
+    return h or 1
+
+
+def record_key(record):
+    return record['t'] + record['u']
+
+
+class LogDB(DB):
+    def __init__(self, name, path=None, cache_size=1000, capacity=1024, sync=False,
+                 hasher='md5'):
+        super(LogDB, self).__init__(name, hasher)
+        self.path = path or name + '.log'
+        self.sync = sync  # fsync the log after every write
+        self.lock = threading.RLock()
+        self.stripes = [self.lock]  # writes are serialized, see `transaction`
+
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        if not self.size:
+            self._write(MAGIC)
+        elif self._pread(0, len(MAGIC)) != MAGIC:
+            raise DataError('{} is not a log database'.format(self.path))
+
+        self.index = LogIndex(self.path, capacity)
+        self._recover()
+
+        self.storage = LogStorage(self, cache_size)
+        self.local = LogLocal(self)
+        self.blobs = LogBlobs(self)
+        self._load_docs()
+
+    def close(self):
+        with self.lock:
+            if self.fd is None:
+                return
+            self._save_docs()
+            self.index.close()
+            os.close(self.fd)
+            self.fd = None
+
+    @contextmanager
+    def transaction(self):
+        """Serialize writes, drop the cache if a write fails.
+
+        Unlike SQLite there is no rollback: the documents written before
+        the failure stay written.
+        """
+        with self.lock:
+            try:
+                yield
+            except BaseException:
+                self.storage.clear()
+                raise
+
+    def put(self, value, uid=None, rev=None):
+        with self.transaction():
+            return super(LogDB, self).put(value, uid, rev)
+
+    def put_bulk(self, results):
+        with self.transaction():
+            return super(LogDB, self).put_bulk(results)
+
+    def remove(self, uid, rev):
+        with self.transaction():
+            return super(LogDB, self).remove(uid, rev)
+
+    def get(self, uid, rev=None, revs=False):
+        with self.lock:
+            result = super(LogDB, self).get(uid, rev, revs)
+            if isinstance(result.value, Body):
+                result = result._replace(value=result.value.load())
+            return result
+
+    def load_value(self, value):
+        return value.load() if isinstance(value, Body) else value
+
+    def compact_put(self, uid):
+        with self.transaction():
+            self.storage.replace(uid)
+
+    def changes_put(self, uid):
+        with self.transaction():
+            self.storage.save(uid)
+            seq = self.index.seq
+            document = self.storage[uid]
+            self.ids.put(uid, document.winner, document.deleted)
+            self.conflicted.put(uid, seq, bool(document.conflicts and document.open_conflicts))
+
+            self.changes_notify(uid, seq)
+        return seq
+
+    def changes_get(self, since=0, style='all_docs', chunk_size=1000):
+        seq = since
+        while True:
+            with self.lock:
+                last = self.index.seq
+                records = []
+                while seq < last and len(records) < chunk_size:
+                    seq += 1
+                    offset = self.index.seq_get(seq)
+                    if offset:
+                        records.append(self.read(offset))
+
+            for record in records:
+                yield Change(record['u'], record['w'], record['q'])
+                if style == 'all_docs':
+                    for rev in record['c']:
+                        yield Change(record['u'], rev, record['q'])
+
+            if seq >= last:
+                return
+
+    def changes_get_size(self):
+        return self.index.docs
+
+    def changes_get_seq(self):
+        return self.index.seq
+
+    def read(self, offset):
+        """Read the record at `offset` of the log."""
+        with self.lock:
+            length, crc = RECORD.unpack(self._pread(offset, RECORD.size))
+            return json.loads(self._pread(offset + RECORD.size, length))
+
+    @contextmanager
+    def batch(self):
+        """Collect records and append them to the log at once.
+
+        `add` of the yielded batch gives the offset a record is going to
+        have, so later records can refer to it. Document state, local
+        value and attachment records are indexed once the batch is written.
+        """
+        with self.lock:
+            batch = LogBatch(self.size)
+            yield batch
+
+            self._write(''.join(batch.chunks))
+            for offset, record in batch.records:
+                if record['t'] in 'dla':
+                    self._apply(offset, record)
+            self.index.log_size = self.size
+
+    def lookup(self, key):
+        """Offset of the latest record of `key`, 0 if there is none."""
+        with self.lock:
+            return self.index.find(key_hash(key), self._matcher(key))[1]
+
+    def records(self):
+        """Latest records of all the keys in the index."""
+        with self.lock:
+            index = self.index
+            offsets = [
+                SLOT.unpack_from(index.mm, HEADER.size + i * SLOT.size)[1]
+                for i in range(index.capacity)
+            ]
+            return [self.read(offset) for offset in offsets if offset]
+
+    def _matcher(self, key):
+        return lambda offset: record_key(self.read(offset)) == key
+
+    def _write(self, data):
+        with self.lock:
+            os.lseek(self.fd, self.size, os.SEEK_SET)
+            while data:
+                written = os.write(self.fd, data)
+                data = data[written:]
+                self.size += written
+            if self.sync:
+                os.fsync(self.fd)
+
+    def _pread(self, offset, length):
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        chunks = []
+        while length:
+            chunk = os.read(self.fd, length)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            length -= len(chunk)
+        return ''.join(chunks)
+
+    def _apply(self, offset, record):
+        """Update the index with a document state, a local value or an
+        attachment record.
+        """
+        key = record_key(record)
+        old = self.index.put(key_hash(key), offset, self._matcher(key))
+        if record['t'] == 'd':
+            if old:
+                self.index.seq_set(self.read(old)['q'], 0)
+            else:
+                self.index.docs += 1
+            self.index.seq_set(record['q'], offset)
+            self.index.seq = max(self.index.seq, record['q'])
+
+    def _recover(self):
+        pos = self.index.log_size
+        if pos > self.size:
+            # the index knows more than the log has, rebuild it
+            self.index.reset()
+            pos = 0
+        pos = max(pos, len(MAGIC))
+
+        for offset, pos, record in self._scan(pos):
+            if record['t'] in 'dla':
+                self._apply(offset, record)
+
+        if pos < self.size:
+            os.ftruncate(self.fd, pos)  # torn tail
+            self.size = pos
+        self.index.log_size = self.size
+
+    def _scan(self, pos):
+        """Offset, end and content of the records from `pos` on, up to
+        a torn one.
+        """
+        while pos + RECORD.size <= self.size:
+            length, crc = RECORD.unpack(self._pread(pos, RECORD.size))
+            end = pos + RECORD.size + length
+            if end > self.size:
+                return
+            data = self._pread(pos + RECORD.size, length)
+            if zlib.crc32(data) & 0xffffffff != crc:
+                return
+            yield pos, end, json.loads(data)
+            pos = end
+
+    def _load_docs(self):
+        """Read `ids` and `conflicted` saved by `_save_docs` and replay the
+        document states logged since. Without them, or if they are ahead
+        of the log, they are built from the latest document states.
+        """
+        try:
+            with open(self.path + '.docs', 'rb') as f:
+                docs = json.load(f)
+        except (IOError, ValueError):
+            docs = None
+
+        if docs is None or docs['s'] > self.size:
+            ids, conflicted = {}, {}
+            for record in self.records():
+                if record['t'] == 'd':
+                    ids[record['u']] = record['w'], record['e']
+                    # only the documents with conflicts are loaded
+                    if record['c'] and self.storage[record['u']].open_conflicts:
+                        conflicted[record['u']] = record['q']
+            records = []
+        else:
+            ids = dict((uid, tuple(status)) for uid, status in docs['d'].iteritems())
+            conflicted = docs['c']
+            records = (record for _, _, record in self._scan(docs['s']) if record['t'] == 'd')
+
+        self.ids = IdIndex(ids)
+        self.conflicted = ConflictIndex(conflicted)
+        for record in records:
+            uid = record['u']
+            self.ids.put(uid, record['w'], record['e'])
+            self.conflicted.put(
+                uid, record['q'], bool(record['c'] and self.storage[uid].open_conflicts))
+
+    def _save_docs(self):
+        """Save `ids` and `conflicted` for the next open."""
+        tmp = self.path + '.docs.tmp'
+        with open(tmp, 'wb') as f:
+            json.dump({'s': self.size, 'd': self.ids.status, 'c': self.conflicted.status}, f,
+                      separators=(',', ':'))
+        os.rename(tmp, self.path + '.docs')
+
+
+class LogBatch(object):
+    def __init__(self, offset):
+        self.offset = offset  # of the next record
+        self.chunks = []
+        self.records = []  # (offset, record)
+
+    def add(self, record):
+        offset = self.offset
+        data = encode(record)
+        self.chunks.append(data)
+        self.records.append((offset, record))
+        self.offset += len(data)
+        return offset
+
+
+class LogIndex(object):
+    """Memory-mapped hash table of keys and array of sequence numbers.
+
+    The hash table uses linear probing and stores a hash of the key with
+    the offset of its latest record, the key itself is checked against the
+    record. It is doubled when it gets half full.
+    """
+
+    def __init__(self, path, capacity):
+        self.path = path + '.idx'
+        self.seq_path = path + '.seq'
+        self.capacity_min = capacity
+
+        if not os.path.exists(self.path) or not os.path.exists(self.seq_path):
+            self.reset()
+        else:
+            self._open()
+            if self.header[0] != INDEX_MAGIC:
+                self.close()
+                self.reset()
+
+    def reset(self):
+        """Start with an empty index."""
+        if getattr(self, 'mm', None) is not None:
+            self.close()
+        self._create(self.path, self.capacity_min)
+        with open(self.seq_path, 'wb') as f:
+            f.truncate(OFFSET.size * self.capacity_min)
+        self._open()
+
+    def close(self):
+        for mm in (self.mm, self.seq_mm):
+            mm.flush()
+            mm.close()
+        self.mm = self.seq_mm = None
+
+    @property
+    def header(self):
+        return HEADER.unpack_from(self.mm, 0)
+
+    def _header_field(i):
+        def get(self):
+            return self.header[i]
+
+        def set(self, value):
+            header = list(self.header)
+            header[i] = value
+            HEADER.pack_into(self.mm, 0, *header)
+        return property(get, set)
+
+    capacity = _header_field(1)
+    used = _header_field(2)  # taken slots
+    docs = _header_field(3)  # indexed documents
+    log_size = _header_field(4)  # log bytes reflected in the index
+    seq = _header_field(5)  # last sequence number
+    del _header_field
+
+    def find(self, h, match):
+        """Slot number and record offset of a key, offset is 0 if not found."""
+        capacity = self.capacity
+        i = h % capacity
+        while True:
+            slot_h, offset = SLOT.unpack_from(self.mm, HEADER.size + i * SLOT.size)
+            if not offset or (slot_h == h and match(offset)):
+                return i, offset
+            i = (i + 1) % capacity
+
+    def put(self, h, offset, match):
+        """Point a key to a new record, return the previous offset."""
+        i, old = self.find(h, match)
+        SLOT.pack_into(self.mm, HEADER.size + i * SLOT.size, h, offset)
+        if not old:
+            self.used += 1
+            if self.used * 2 > self.capacity:
+                self._grow()
+        return old
+
+    def seq_get(self, seq):
+        if (seq + 1) * OFFSET.size > len(self.seq_mm):
+            return 0
+        return OFFSET.unpack_from(self.seq_mm, seq * OFFSET.size)[0]
+
+    def seq_set(self, seq, offset):
+        size = len(self.seq_mm)
+        if (seq + 1) * OFFSET.size > size:
+            self.seq_mm.close()
+            with open(self.seq_path, 'r+b') as f:
+                f.truncate(max(2 * size, (seq + 1) * OFFSET.size))
+            self.seq_mm = self._map(self.seq_path)
+        OFFSET.pack_into(self.seq_mm, seq * OFFSET.size, offset)
+
+    def _grow(self):
+        header = list(self.header)
+        capacity = header[1] * 2
+        slots = [
+            SLOT.unpack_from(self.mm, HEADER.size + i * SLOT.size)
+            for i in range(header[1])
+        ]
+
+        tmp = self.path + '.tmp'
+        self._create(tmp, capacity)
+        mm = self._map(tmp)
+        header[1] = capacity
+        HEADER.pack_into(mm, 0, *header)
+        for h, offset in slots:
+            if not offset:
+                continue
+            i = h % capacity
+            while SLOT.unpack_from(mm, HEADER.size + i * SLOT.size)[1]:
+                i = (i + 1) % capacity
+            SLOT.pack_into(mm, HEADER.size + i * SLOT.size, h, offset)
+        mm.flush()
+        mm.close()
+
+        self.mm.close()
+        os.rename(tmp, self.path)
+        self.mm = self._map(self.path)
+
+    def _create(self, path, capacity):
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(INDEX_MAGIC, capacity, 0, 0, 0, 0))
+            f.truncate(HEADER.size + SLOT.size * capacity)
+
+    def _open(self):
+        self.mm = self._map(self.path)
+        self.seq_mm = self._map(self.seq_path)
+
+    def _map(self, path):
+        with open(path, 'r+b') as f:
+            return mmap.mmap(f.fileno(), 0)
+
+
+class Body(object):
+    """Value of a revision which is read from the log when needed."""
+    __slots__ = ('db', 'offset')
+
+    def __init__(self, db, offset):
+        self.db = db
+        self.offset = offset
+
+    def load(self):
+        return self.db.read(self.offset)['v']
+
+    def __eq__(self, other):
+        if isinstance(other, Body):
+            other = other.load()
+        return self.load() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Body({})'.format(self.offset)
+
+
+class LogStorage(CachedStorage):
+    def __init__(self, db, cache_size):
+        super(LogStorage, self).__init__(db.lock, cache_size)
+        self.db = db
+
+    def __contains__(self, uid):
+        return bool(self.db.lookup('d' + uid))
+
+    def __iter__(self):
+        return (record['u'] for record in self.db.records() if record['t'] == 'd')
+
+    def __len__(self):
+        return self.db.index.docs
+
+    def load(self, uid):
+        document = Document()
+        offset = self.db.lookup('d' + uid)
+        if not offset:
+            return document
+
+        state = self.db.read(offset)
+        records = []
+        offset = state['l']
+        while offset:
+            record = self.db.read(offset)
+            records.append(record)
+            offset = record['n']
+
+        for record in reversed(records):
+            document[record['r']] = Revision(
+                value=Body(self.db, record['b']) if record['b'] else None,
+                deleted=record['d'],
+                parent=record['p'],
+                generation=record['g'],
+                stub=record['s']
+            )
+
+        document.winner = state['w']
+        document.conflicts = set(state['c'])
+        return document
+
+    def write(self, uid, document, revs, replace=False):
+        db = self.db
+        offset = db.lookup('d' + uid)
+        state = db.read(offset) if offset else None
+        last = state['l'] if state and not replace else 0
+        # a rewritten document stays at its place in the changes log
+        seq = state['q'] if state and replace else db.index.seq + 1
+
+        with db.batch() as batch:
+            for rev in revs:
+                revision = document[rev]
+                value = revision.value
+                if isinstance(value, Body):
+                    value = value.load()
+
+                body = batch.add({'t': 'b', 'v': value}) if value is not None else 0
+                last = batch.add({
+                    't': 'r',
+                    'u': uid,
+                    'r': rev,
+                    'p': revision.parent,
+                    'g': revision.generation,
+                    'd': revision.deleted,
+                    's': revision.stub,
+                    'b': body,
+                    'n': last,
+                })
+
+            batch.add({
+                't': 'd',
+                'u': uid,
+                'q': seq,
+                'w': document.winner,
+                'c': sorted(document.conflicts),
+                'e': document.deleted,
+                'l': last,
+            })
+
+
+class LogLocal(MutableMapping):
+    """`DB.local` replacement, not replicated values of the database."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __getitem__(self, uid):
+        offset = self.db.lookup('l' + uid)
+        record = self.db.read(offset) if offset else {'x': True}
+        if record.get('x'):
+            raise KeyError(uid)
+        return record['v']
+
+    def __setitem__(self, uid, value):
+        with self.db.batch() as batch:
+            batch.add({'t': 'l', 'u': uid, 'v': value})
+
+    def __delitem__(self, uid):
+        with self.db.lock:
+            if uid not in self:
+                raise KeyError(uid)
+            with self.db.batch() as batch:
+                batch.add({'t': 'l', 'u': uid, 'x': True})
+
+    def __iter__(self):
+        return (
+            record['u'] for record in self.db.records()
+            if record['t'] == 'l' and not record.get('x')
+        )
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class LogBlobs(MutableMapping):
+    """`DB.blobs` replacement, attachment bodies by digest.
+
+    A body is a base64 record of the log, a dropped one stays in the log
+    as dead bytes.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __contains__(self, digest):
+        offset = self.db.lookup('a' + digest)
+        return bool(offset) and not self.db.read(offset).get('x')
+
+    def __getitem__(self, digest):
+        offset = self.db.lookup('a' + digest)
+        record = self.db.read(offset) if offset else {'x': True}
+        if record.get('x'):
+            raise KeyError(digest)
+        return base64.b64decode(record['v'])
+
+    def __setitem__(self, digest, data):
+        with self.db.batch() as batch:
+            batch.add({'t': 'a', 'u': digest, 'v': base64.b64encode(data)})
+
+    def __delitem__(self, digest):
+        with self.db.lock:
+            if digest not in self:
+                raise KeyError(digest)
+            with self.db.batch() as batch:
+                batch.add({'t': 'a', 'u': digest, 'x': True})
+
+    def __iter__(self):
+        return (
+            record['u'] for record in self.db.records()
+            if record['t'] == 'a' and not record.get('x')
+        )
+
+    def __len__(self):
+        return sum(1 for _ in self)
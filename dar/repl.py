@@ -1,28 +1,401 @@
+from multiprocessing.pool import ThreadPool
 import hashlib
+import json
+import logging
+from Queue import Queue
+import threading
+import time
 
+from .db import attachment_digests, group_changes
 
-class Repl(object):
-    def __init__(self, source, target):
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class Continuous(object):
+    """Continuous replication, for replicators with `source`,
+    `batch_size` and `replicate`.
+    """
+
+    def start(self, max_delay=0.1, backoff=1, max_backoff=60):
+        """Replicate continuously in a background thread.
+
+        The thread sleeps until the source notifies about a change, then
+        it collects more changes for up to `max_delay` seconds or until
+        there are `batch_size` of them, and replicates them at once.
+
+        A failed replication is logged and retried from its checkpoint,
+        waiting `backoff` seconds doubled on each failure in a row, up to
+        `max_backoff`. The error is kept in `error` until one succeeds.
+        """
+        if self._thread is not None:
+            raise RuntimeError('replication is already running')
+
+        self._condition = threading.Condition()
+        self._pending = 0
+        self._stopped = False
+        self.error = None
+        self.source.changes_subscribe(self._notify)
+
+        self._thread = threading.Thread(target=self._run, args=(max_delay, backoff, max_backoff))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop continuous replication started by `start`."""
+        if self._thread is None:
+            return
+
+        self.source.changes_unsubscribe(self._notify)
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+        self._thread.join()
+        self._thread = None
+
+    def _notify(self, uid, seq):
+        with self._condition:
+            self._pending += 1
+            self._condition.notify()
+
+    def _run(self, max_delay, backoff, max_backoff):
+        condition = self._condition
+        failures = 0
+        while True:
+            try:
+                self.replicate()  # the first one catches up
+            except Exception as e:
+                failures += 1
+                self.error = e
+                logger.exception('replication of %s failed', self.source.name)
+            else:
+                failures = 0
+                self.error = None
+
+            with condition:
+                if failures:
+                    deadline = time.time() + min(backoff * 2 ** (failures - 1), max_backoff)
+                    while not self._stopped and time.time() < deadline:
+                        condition.wait(deadline - time.time())
+                else:
+                    while not self._pending and not self._stopped:
+                        condition.wait()
+
+                    deadline = time.time() + max_delay
+                    while self._pending < self.batch_size and not self._stopped:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        condition.wait(remaining)
+
+                if self._stopped:
+                    return
+                self._pending = 0
+
+
+class Repl(Continuous):
+    """Replication from `source` to `target`.
+
+    With a `filter` only the documents passing it, given `params`, are
+    replicated (see `DB.filter_get`). The source filters its changes feed,
+    so the other documents are neither diffed nor fetched.
+    """
+
+    def __init__(self, source, target, batch_size=1000, filter=None, params=None):
         self.source = source
         self.target = target
+        self.batch_size = batch_size
+        self.filter = filter
+        self.params = params
         self.uid = self.get_uid()
+        self.doc_write_failures = 0  # revisions the target refused
+        self._thread = None
 
     def get_uid(self):
-        return hashlib.sha1(self.source.name + self.target.name).hexdigest()
+        key = self.source.name + self.target.name
+        if self.filter is not None:
+            # a filtered replication has a checkpoint of its own
+            key += json.dumps([self.filter, self.params], sort_keys=True)
+        return hashlib.sha1(key).hexdigest()
+
+    def changes_get(self, since):
+        """Changes of the source to replicate."""
+        if self.filter is None:
+            return self.source.changes_get(since)
+        return self.source.changes_get_filtered(since, filter=self.filter, params=self.params)
 
     def replicate(self):
+        """Pull the changes since the last checkpoint batch by batch.
+
+        A checkpoint is saved after each batch, so an interrupted
+        replication resumes from the last applied batch.
+        """
         seq = self.target.local_get(self.uid)
 
-        grouped = self.source.changes_get_grouped(seq)
-        diff = self.target.changes_get_diff(grouped)
+        for batch in self.get_batches(self.changes_get(seq)):
+            self.replicate_batch(batch)
+
+    def replicate_batch(self, changes):
+        self.write_batch(self.fetch_batch(self.diff_batch(changes)))
+
+    def diff_batch(self, changes):
+        grouped = group_changes(changes)
+        return changes, self.target.changes_get_diff(grouped)
+
+    def fetch_batch(self, item):
+        changes, diff = item
+        return changes, self.get_diff_docs(diff)
+
+    def write_batch(self, item):
+        changes, results = item
+        results = list(results)
+        self.copy_blobs(results)
+        self.put_results(results)
+        self.target.local_put(self.uid, changes[-1].seq)
+
+    def put_results(self, results):
+        """Write fetched revisions to the target.
 
-        results = self.get_diff_docs(diff)
+        A revision refused for a missing attachment body, dropped by a
+        compaction of the target since `copy_blobs`, is written again once
+        the bodies are copied again. Other refusals, such as a second root
+        of a uid created on both sides, never go away: like CouchDB they
+        are logged and counted in `doc_write_failures`, and the
+        replication goes on.
+        """
+        failures = self._put(results)
+        while failures and self.copy_blobs([result for result, _ in failures]):
+            failures = self._put([result for result, _ in failures])
 
-        self.target.put_bulk(results)
+        for result, error in failures:
+            logger.warning('%s %s not written to %s: %s',
+                           result.uid, result.rev, self.target.name, error)
+        self.doc_write_failures += len(failures)
 
-        self.target.local_put(self.uid, self.source.changes_get_size())
+    def _put(self, results):
+        written = self.target.put_bulk(results)
+        return [(result, e) for result, e in zip(results, written) if isinstance(e, Exception)]
+
+    def copy_blobs(self, results):
+        """Copy the attachment bodies the target is missing.
+
+        Revisions refer to their attachments by digest, the target is
+        asked which ones it lacks and each of them is copied once. It
+        plays the role of `atts_since` of CouchDB: attachments the target
+        has, from any document, are never transferred again. Gives the
+        digests copied.
+        """
+        digests = set()
+        for result in results:
+            digests.update(attachment_digests(result.value))
+        if not digests:
+            return []
+
+        missing = self.target.blobs_get_diff(sorted(digests))
+        blobs = self.source.blobs_get(missing) if missing else {}
+        if blobs:
+            self.target.blobs_put(blobs)
+        return sorted(blobs)
+
+    def get_batches(self, changes):
+        """Split the changes feed into lists of about `batch_size` changes.
+
+        Changes of the same sequence number are never split, so the last
+        seq of a batch is safe to be used as a checkpoint.
+        """
+        batch = []
+        for change in changes:
+            if len(batch) >= self.batch_size and change.seq != batch[-1].seq:
+                yield batch
+                batch = []
+            batch.append(change)
+
+        if batch:
+            yield batch
 
     def get_diff_docs(self, diff):
-        for uid, l in diff.iteritems():
-            for rev in l:
-                yield self.source.get(uid, rev)
+        """Fetch missing leafs along with their revision history."""
+        pairs = [(uid, rev) for uid, l in diff.iteritems() for rev in l]
+        for result in self.source.get_bulk(pairs, revs=True):
+            if not isinstance(result, Exception):
+                yield result
+
+
+_DONE = object()  # end of a pipeline queue
+
+
+class PipelinedRepl(Repl):
+    """Replication running as a data-flow system.
+
+    Reading changes, revs diff, fetching from the source and writing to
+    the target run in their own threads connected with bounded queues,
+    so a slow step holds back the steps before it, and the throughput
+    is limited by the slowest step rather than by the sum of them.
+    """
+
+    def __init__(self, source, target, batch_size=1000, queue_size=2, filter=None, params=None):
+        super(PipelinedRepl, self).__init__(source, target, batch_size, filter, params)
+        self.queue_size = queue_size
+
+    def replicate(self):
+        seq = self.target.local_get(self.uid)
+
+        errors = []
+        steps = [self.diff_batch, self.fetch_batch, self.write_batch]
+        queues = [Queue(self.queue_size) for _ in steps] + [None]
+        threads = [
+            threading.Thread(target=self._step, args=(step, inbox, outbox, errors))
+            for step, inbox, outbox in zip(steps, queues, queues[1:])
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for batch in self.get_batches(self.changes_get(seq)):
+                if errors:
+                    break
+                queues[0].put(batch)
+        finally:
+            queues[0].put(_DONE)
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def fetch_batch(self, item):
+        # the documents have to be fetched here, not by the writer
+        changes, diff = item
+        return changes, list(self.get_diff_docs(diff))
+
+    def _step(self, step, inbox, outbox, errors):
+        for item in iter(inbox.get, _DONE):
+            if errors:
+                continue  # drain, so the previous step is never blocked
+            try:
+                item = step(item)
+            except Exception as e:
+                errors.append(e)
+                continue
+            if outbox is not None:
+                outbox.put(item)
+
+        if outbox is not None:
+            outbox.put(_DONE)
+
+
+class FanoutRepl(Continuous):
+    """Replication from one `source` to many `targets`.
+
+    The changes feed of the source is read once and each missing
+    revision and attachment is fetched once, whatever the number of
+    targets, then every target gets what it lacks. The diffs and the
+    writes of the targets run concurrently. Each target keeps the
+    checkpoint a `Repl` of it would, so they can be used in turn and a
+    target which is behind is caught up from its own checkpoint.
+
+    A failing target is left out of the following batches, the others
+    go on and the first error is raised at the end.
+    """
+
+    def __init__(self, source, targets, batch_size=1000, filter=None, params=None):
+        self.source = source
+        self.targets = targets
+        self.batch_size = batch_size
+        self.repls = [Repl(source, target, batch_size, filter, params) for target in targets]
+        self._thread = None
+
+    def replicate(self):
+        repls = self.repls
+        pool = ThreadPool(len(repls))
+        try:
+            # the checkpoint of each target, or the error which stopped it
+            states = _each(pool, lambda repl, _: repl.target.local_get(repl.uid), repls)
+            seqs = [state for state in states if not isinstance(state, Exception)]
+            changes = repls[0].changes_get(self.source.seq_min(seqs)) if seqs else []
+            for batch in repls[0].get_batches(changes):
+                states = self.replicate_batch(pool, batch, states)
+        finally:
+            pool.close()
+            pool.join()
+
+        for state in states:
+            if isinstance(state, Exception):
+                raise state
+
+    def replicate_batch(self, pool, changes, seqs):
+        """Replicate `changes` to the targets, which have the changes up
+        to their seqs. Gives the new seqs, or errors of failed targets.
+
+        A target which already has the batch keeps its seq through the
+        steps, the others go through diff, missing blobs and write.
+        """
+        last = changes[-1].seq
+
+        def diff(repl, seq):
+            newer = [change for change in changes if self.source.change_newer(change, seq)]
+            if not newer:
+                return seq
+            return repl.target.changes_get_diff(group_changes(newer))
+
+        diffs = _each(pool, diff, self.repls, seqs)
+        wanted = set()
+        for diff in diffs:
+            if isinstance(diff, dict):
+                wanted.update((uid, rev) for uid, revs in diff.iteritems() for rev in revs)
+
+        fetched = {}
+        if wanted:
+            for result in self.source.get_bulk(sorted(wanted), revs=True):
+                if not isinstance(result, Exception):
+                    fetched[result.uid, result.rev] = result
+
+        def blobs_diff(repl, diff):
+            if not isinstance(diff, dict):
+                return diff
+            results = [
+                fetched[uid, rev]
+                for uid, revs in diff.iteritems() for rev in revs if (uid, rev) in fetched
+            ]
+            digests = set()
+            for result in results:
+                digests.update(attachment_digests(result.value))
+            return results, repl.target.blobs_get_diff(sorted(digests)) if digests else []
+
+        items = _each(pool, blobs_diff, self.repls, diffs)
+        digests = set()
+        for item in items:
+            if isinstance(item, tuple):
+                digests.update(item[1])
+        blobs = self.source.blobs_get(sorted(digests)) if digests else {}
+
+        def write(repl, item):
+            if not isinstance(item, tuple):
+                return item
+            results, digests = item
+            if digests:
+                repl.target.blobs_put(
+                    dict((digest, blobs[digest]) for digest in digests if digest in blobs))
+            repl.put_results(results)
+            repl.target.local_put(repl.uid, last)
+            return last
+
+        return _each(pool, write, self.repls, items)
+
+
+def _each(pool, func, repls, states=None):
+    """Call `func(repl, state)` for the repls concurrently, give the
+    results and the raised exceptions in order. A state which is an
+    exception, a failure of a previous step, is given back as is.
+    """
+    def call((repl, state)):
+        if isinstance(state, Exception):
+            return state
+        try:
+            return func(repl, state)
+        except Exception as e:
+            return e
+
+    return pool.map(call, zip(repls, states or [None] * len(repls)))
@@ -0,0 +1,154 @@
+"""Mango selectors of CouchDB compiled to predicates.
+
+A selector maps fields (dotted for nested ones) to a value they have to
+equal, to operators or to an object of conditions on their sub-fields,
+and combines selectors with `$and`, `$or`, `$nor` and `$not`. As in
+Mango `{"imdb": {"rating": 8}}` is `{"imdb.rating": 8}`, a whole object
+is compared with `$eq`. It is compiled once into nested closures, matching a
+document then costs no parsing. Values are compared by their collation
+key of views, so `"a"` equals `u"a"` but `1` does not equal `true`.
+"""
+import re
+
+from .exceptions import DataError
+from .view import collate
+
+_MISSING = object()  # value of a field a document does not have
+
+
+def compile_selector(selector):
+    """Predicate telling whether a document, a dict, matches `selector`."""
+    if not isinstance(selector, dict):
+        raise DataError('selector has to be an object')
+
+    tests = []
+    for field, condition in selector.iteritems():
+        if field in _COMBINATIONS:
+            if not isinstance(condition, list):
+                raise DataError('{} takes a list of selectors'.format(field))
+            tests.append(_COMBINATIONS[field]([compile_selector(s) for s in condition]))
+        elif field == '$not':
+            tests.append(_negate(compile_selector(condition)))
+        elif field.startswith('$'):
+            raise DataError('unknown operator {}'.format(field))
+        else:
+            tests.append(_field(field.split('.'), compile_condition(condition)))
+
+    if len(tests) == 1:
+        return tests[0]
+    return lambda doc: all(test(doc) for test in tests)
+
+
+def compile_condition(condition):
+    """Predicate of a field value, `_MISSING` if the field is not there."""
+    if not (isinstance(condition, dict) and condition):
+        return _OPERATORS['$eq'](condition)
+
+    tests = []
+    for key, argument in condition.iteritems():
+        if not key.startswith('$'):
+            tests.append(_field(key.split('.'), compile_condition(argument)))
+        elif key in _OPERATORS:
+            tests.append(_OPERATORS[key](argument))
+        else:
+            raise DataError('unknown operator {}'.format(key))
+
+    if len(tests) == 1:
+        return tests[0]
+    return lambda value: all(test(value) for test in tests)
+
+
+def _field(path, test):
+    def match(doc):
+        value = doc
+        for name in path:
+            if not isinstance(value, dict) or name not in value:
+                return test(_MISSING)
+            value = value[name]
+        return test(value)
+    return match
+
+
+def _negate(test):
+    return lambda value: not test(value)
+
+
+def _collate(argument):
+    try:
+        return collate(argument)
+    except TypeError as e:
+        raise DataError(str(e))
+
+
+def _compare(compare):
+    def operator(argument):
+        key = _collate(argument)
+        return lambda value: value is not _MISSING and compare(collate(value), key)
+    return operator
+
+
+def _in(argument):
+    if not isinstance(argument, list):
+        raise DataError('$in takes a list')
+    keys = frozenset(_collate(a) for a in argument)
+    return lambda value: value is not _MISSING and collate(value) in keys
+
+
+def _nin(argument):
+    test = _in(argument)
+    return lambda value: value is not _MISSING and not test(value)
+
+
+def _all(argument):
+    if not isinstance(argument, list):
+        raise DataError('$all takes a list')
+    keys = frozenset(_collate(a) for a in argument)
+    return lambda value: isinstance(value, list) and keys <= set(collate(v) for v in value)
+
+
+def _elem_match(argument):
+    if isinstance(argument, dict) and argument and all(k.startswith('$') for k in argument):
+        test = compile_condition(argument)
+    else:
+        test = compile_selector(argument)
+    return lambda value: isinstance(value, list) and any(test(v) for v in value)
+
+
+def _regex(argument):
+    try:
+        pattern = re.compile(argument)
+    except (re.error, TypeError):
+        raise DataError('invalid $regex {!r}'.format(argument))
+    return lambda value: isinstance(value, basestring) and pattern.search(value) is not None
+
+
+def _size(argument):
+    return lambda value: isinstance(value, list) and len(value) == argument
+
+
+def _exists(argument):
+    return lambda value: (value is not _MISSING) == bool(argument)
+
+
+_OPERATORS = {
+    '$eq': _compare(lambda a, b: a == b),
+    '$ne': _compare(lambda a, b: a != b),
+    '$gt': _compare(lambda a, b: a > b),
+    '$gte': _compare(lambda a, b: a >= b),
+    '$lt': _compare(lambda a, b: a < b),
+    '$lte': _compare(lambda a, b: a <= b),
+    '$in': _in,
+    '$nin': _nin,
+    '$all': _all,
+    '$elemMatch': _elem_match,
+    '$regex': _regex,
+    '$size': _size,
+    '$exists': _exists,
+    '$not': lambda argument: _negate(compile_condition(argument)),
+}
+
+_COMBINATIONS = {
+    '$and': lambda tests: lambda doc: all(test(doc) for test in tests),
+    '$or': lambda tests: lambda doc: any(test(doc) for test in tests),
+    '$nor': lambda tests: lambda doc: not any(test(doc) for test in tests),
+}
@@ -0,0 +1,753 @@
+"""CouchDB compatible HTTP front-end of `DB`.
+
+Serve in-memory databases with `python -m dar.server name1 name2`.
+
+Documents are JSON objects, a value which is not a dict travels in the
+`_value` field. Every connection is served by its own thread and kept
+alive between requests; `_changes` responses are streamed.
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from itertools import chain, groupby, islice
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs, urlparse
+from urllib import unquote
+import base64
+import json
+import logging
+import select
+import socket
+import sys
+import threading
+import time
+import zlib
+
+from .db import DB, Result
+from .doc import rev_generation
+from .exceptions import DataError, NotFoundError
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+GZIP = 16 + zlib.MAX_WBITS  # zlib window bits of the gzip format
+
+# `_changes` query parameters which are not passed to filters
+CHANGES_PARAMS = frozenset(['feed', 'style', 'limit', 'timeout', 'heartbeat', 'since', 'filter'])
+
+
+class HTTPError(Exception):
+    """Error response with a CouchDB-like `{"error", "reason"}` body."""
+
+    def __init__(self, status, error, reason=None):
+        super(HTTPError, self).__init__(reason or error)
+        self.status = status
+        self.error = error
+        self.reason = reason or error
+
+
+def revs_to_revisions(revs):
+    """`_revisions` field of a revision history given by `Document.revs`."""
+    return {
+        'start': rev_generation(revs[0]),
+        'ids': [rev.split('-', 1)[-1] for rev in revs],
+    }
+
+
+def revisions_to_revs(revisions):
+    """Revision history of a `_revisions` field, `rev` first."""
+    start = revisions['start']
+    return ['{}-{}'.format(start - i, rev) for i, rev in enumerate(revisions['ids'])]
+
+
+def encode_attachments(value, convert):
+    """Value with the `data` of its attachments converted, bodies are
+    base64 in JSON.
+    """
+    attachments = value.get('_attachments')
+    if not isinstance(attachments, dict) or not any(
+            isinstance(a, dict) and 'data' in a for a in attachments.itervalues()):
+        return value
+    try:
+        return dict(value, _attachments=dict(
+            (name, dict(a, data=convert(a['data'])) if isinstance(a, dict) and 'data' in a else a)
+            for name, a in attachments.iteritems()
+        ))
+    except TypeError:
+        raise DataError('invalid base64 attachment data')
+
+
+def result_to_json(result):
+    """CouchDB document of a `Result`."""
+    if isinstance(result.value, dict):
+        body = encode_attachments(dict(result.value), base64.b64encode)
+    elif result.deleted and result.value is None:
+        body = {}
+    else:
+        body = {'_value': result.value}
+
+    body['_id'] = result.uid
+    body['_rev'] = result.rev
+    if result.deleted:
+        body['_deleted'] = True
+    if result.revs:
+        body['_revisions'] = revs_to_revisions(result.revs)
+    return body
+
+
+def json_to_result(body, uid=None):
+    """`Result` of a CouchDB document, the reverse of `result_to_json`."""
+    body = dict(body)
+    uid = body.pop('_id', uid)
+    rev = body.pop('_rev', None)
+    deleted = body.pop('_deleted', False)
+    revisions = body.pop('_revisions', None)
+    if '_value' in body:
+        value = body.pop('_value')
+    else:
+        value = None if deleted and not body else encode_attachments(body, base64.b64decode)
+
+    revs = revisions_to_revs(revisions) if revisions else None
+    if revs and rev is None:
+        rev = revs[0]
+    parent = revs[1] if revs and len(revs) > 1 else None
+    return Result(uid, rev, value, deleted, parent, revs)
+
+
+class Unlocked(object):
+    """`Server.lock` of thread-safe databases, holds nothing."""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    """HTTP server of named databases.
+
+    The databases are thread-safe, requests are served concurrently and
+    a changes feed is read while writes go on. With `serialize` calls
+    of a database are serialized by `lock` instead, waiting for changes
+    does not hold it.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, address, dbs, serialize=False):
+        HTTPServer.__init__(self, address, Handler)
+        self.dbs = dbs  # name -> `DB`
+        self.lock = threading.RLock() if serialize else Unlocked()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self, poll_interval=0.05):
+        """Serve in a background thread, `stop` waits up to `poll_interval`."""
+        self._thread = threading.Thread(target=self.serve_forever, args=(poll_interval,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop a server started by `start` and close its socket."""
+        self.shutdown()
+        self._thread.join()
+        self.server_close()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep connections alive
+    server_version = 'dar'
+    timeout = 60  # for idle connections
+    disable_nagle_algorithm = True  # headers and body are written apart
+    compress_size = 1024  # smaller responses are not gzipped
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_HEAD(self):
+        self.dispatch('HEAD')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        self.query = dict((k, v[-1]) for k, v in parse_qs(url.query).iteritems())
+        parts = [unquote(part) for part in url.path.split('/')[1:]]
+        if parts and not parts[-1]:
+            parts.pop()
+
+        try:
+            # the body has to be read even if it is not used to keep
+            # the connection usable
+            self.body = self.read_body()
+            self.route(method, parts)
+        except HTTPError as e:
+            self.send_json(e.status, {'error': e.error, 'reason': e.reason})
+        except NotFoundError as e:
+            self.send_json(404, {'error': 'not_found', 'reason': str(e) or 'missing'})
+        except DataError as e:
+            self.send_json(400, {'error': 'bad_request', 'reason': str(e)})
+        except socket.error:
+            self.close_connection = 1
+        except Exception as e:
+            logger.exception('%s %s failed', method, self.path)
+            self.send_json(500, {'error': 'unknown_error', 'reason': str(e)})
+
+    def route(self, method, parts):
+        if not parts:
+            return self.send_json(200, {'couchdb': 'Welcome', 'version': 'dar'})
+
+        db = self.server.dbs.get(parts[0])
+        if db is None:
+            raise HTTPError(404, 'not_found', 'no_db_file')
+
+        if len(parts) == 1:
+            self.check_method(method, 'GET')
+            return self.db_info(db)
+
+        if len(parts) == 3 and parts[1] == '_local':
+            return self.local(method, db, parts[2])
+
+        if len(parts) == 3 and not parts[1].startswith('_'):
+            return self.attachment(method, db, parts[1], parts[2])
+
+        if len(parts) == 2:
+            endpoint = parts[1]
+            if endpoint == '_changes':
+                self.check_method(method, 'GET', 'POST')
+                return self.changes(db)
+            if endpoint == '_bulk_docs':
+                self.check_method(method, 'POST')
+                return self.bulk_docs(db)
+            if endpoint == '_revs_diff':
+                self.check_method(method, 'POST')
+                return self.revs_diff(db)
+            if endpoint == '_all_docs':
+                self.check_method(method, 'GET')
+                return self.all_docs(db)
+            if endpoint == '_bulk_get':
+                self.check_method(method, 'POST')
+                return self.bulk_get(db)
+            if endpoint in ('_blobs', '_blobs_diff', '_blobs_get'):
+                self.check_method(method, 'POST')
+                return self.blobs(db, endpoint)
+            if not endpoint.startswith('_'):
+                return self.document(method, db, endpoint)
+
+        raise HTTPError(404, 'not_found', 'missing')
+
+    def check_method(self, method, *allowed):
+        if method not in allowed:
+            raise HTTPError(405, 'method_not_allowed', 'Only {} allowed'.format(','.join(allowed)))
+
+    def db_info(self, db):
+        with self.server.lock:
+            info = {
+                'db_name': db.name,
+                'doc_count': len(db.storage),
+                'update_seq': db.changes_get_seq(),
+            }
+        self.send_json(200, info)
+
+    def document(self, method, db, uid):
+        if method in ('GET', 'HEAD'):
+            with self.server.lock:
+                result = db.get(uid, self.query.get('rev'), self.query.get('revs') == 'true')
+            return self.send_json(200, result_to_json(result), etag=result.rev)
+
+        if method == 'PUT':
+            body = self.json_body()
+            if not isinstance(body, dict):
+                raise HTTPError(400, 'bad_request', 'Document must be a JSON object')
+            result = json_to_result(body, uid)._replace(uid=uid)
+            if self.query.get('new_edits') == 'false':
+                error = self.put_existing(db, result)
+                if error is not None:
+                    raise error
+                return self.send_json(201, {'ok': True, 'id': uid, 'rev': result.rev})
+            result = self.update(db, result._replace(rev=self.query.get('rev', result.rev)))
+            return self.send_json(201, {'ok': True, 'id': uid, 'rev': result.rev}, etag=result.rev)
+
+        if method == 'DELETE':
+            rev = self.query.get('rev')
+            result = self.update(db, Result(uid, rev, None, True, rev))
+            return self.send_json(200, {'ok': True, 'id': uid, 'rev': result.rev}, etag=result.rev)
+
+        self.check_method(method, 'GET', 'HEAD', 'PUT', 'DELETE')
+
+    def attachment(self, method, db, uid, name):
+        """Body of an attachment, like `/db/doc/attachment` of CouchDB."""
+        rev = self.query.get('rev')
+        if method in ('GET', 'HEAD'):
+            with self.server.lock:
+                stub, data = db.attachment_get(uid, name, rev)
+            return self.send_data(200, data, stub['content_type'], etag=stub['digest'])
+
+        if method in ('PUT', 'DELETE'):
+            with self.server.lock, db.stripe(uid):
+                self.check_winner(db, uid, rev)
+                if method == 'PUT':
+                    content_type = self.headers.get('Content-Type', 'application/octet-stream')
+                    result = db.attachment_put(uid, rev, name, self.body, content_type)
+                else:
+                    result = db.attachment_remove(uid, rev, name)
+            status = 201 if method == 'PUT' else 200
+            return self.send_json(status, {'ok': True, 'id': uid, 'rev': result.rev}, etag=result.rev)
+
+        self.check_method(method, 'GET', 'HEAD', 'PUT', 'DELETE')
+
+    def check_winner(self, db, uid, rev):
+        """Called holding the stripe of `uid`, up to the write."""
+        document = db.storage.get(uid)
+        winner = document.winner if document else None
+        if rev != winner or winner is not None and document[winner].deleted:
+            raise HTTPError(409, 'conflict', 'Document update conflict.')
+
+    def blobs(self, db, endpoint):
+        """Attachment bodies by digest, used by replication.
+
+        `_blobs_diff` gives the missing digests of a list, `_blobs_get`
+        the base64 bodies of digests and `_blobs` stores such bodies.
+        """
+        body = self.json_body()
+        key = 'blobs' if endpoint == '_blobs' else 'digests'
+        items = body.get(key) if isinstance(body, dict) else None
+        if not isinstance(items, dict if key == 'blobs' else list):
+            raise HTTPError(400, 'bad_request', 'Missing {}'.format(key))
+
+        if endpoint == '_blobs_diff':
+            with self.server.lock:
+                return self.send_json(200, {'missing': db.blobs_get_diff(items)})
+        if endpoint == '_blobs_get':
+            with self.server.lock:
+                blobs = db.blobs_get(items)
+            return self.send_json(200, {'blobs': dict(
+                (digest, base64.b64encode(data)) for digest, data in blobs.iteritems())})
+
+        try:
+            blobs = dict((digest, base64.b64decode(data)) for digest, data in items.iteritems())
+        except TypeError:
+            raise HTTPError(400, 'bad_request', 'invalid base64 data')
+        with self.server.lock:
+            db.blobs_put(blobs)
+        self.send_json(201, {'ok': True})
+
+    def update(self, db, result):
+        """Put or remove a revision on top of the winner, like CouchDB does,
+        or on top of a losing leaf to resolve a conflict.
+
+        The winner is checked and written holding the stripe of the
+        document, concurrent updates of the same rev get a conflict.
+        """
+        with self.server.lock, db.stripe(result.uid):
+            document = db.storage.get(result.uid)
+            winner = document.winner if document else None
+            rev = result.rev
+
+            if winner is None or result.deleted and document[winner].deleted:
+                if result.deleted:
+                    raise NotFoundError('missing' if winner is None else 'deleted')
+                if rev is not None:
+                    raise HTTPError(409, 'conflict', 'Document update conflict.')
+            elif rev is None and document[winner].deleted and not result.deleted:
+                rev = winner  # a deleted document is created again
+            elif rev != winner and (rev not in document.conflicts or
+                                    result.deleted and document[rev].deleted):
+                raise HTTPError(409, 'conflict', 'Document update conflict.')
+
+            if result.deleted:
+                return db.remove(result.uid, rev)
+            return db.put(result.value, result.uid, rev)
+
+    def put_existing(self, db, result):
+        """Add a revision with its ID, an error to report if it failed."""
+        return self.put_existing_bulk(db, [result])[0]
+
+    def put_existing_bulk(self, db, results):
+        """Add revisions with their IDs, give an error or `None` for each."""
+        errors = [
+            None if result.uid and result.rev else
+            HTTPError(400, 'bad_request', 'Document id and revision are required')
+            for result in results
+        ]
+        valid = [result for result, error in zip(results, errors) if error is None]
+        with self.server.lock:
+            written = iter(db.put_bulk(valid))
+
+        for i, error in enumerate(errors):
+            if error is None:
+                res = next(written)
+                if isinstance(res, Exception):
+                    errors[i] = HTTPError(400, 'bad_request', str(res))
+        return errors
+
+    def bulk_docs(self, db):
+        body = self.json_body()
+        docs = body.get('docs') if isinstance(body, dict) else None
+        if not isinstance(docs, list) or not all(isinstance(doc, dict) for doc in docs):
+            raise HTTPError(400, 'bad_request', 'Missing JSON list of docs')
+        results = [json_to_result(doc) for doc in docs]
+
+        if not body.get('new_edits', True):
+            # like CouchDB only the failed revisions are reported
+            errors = self.put_existing_bulk(db, results)
+            return self.send_json(201, [
+                {'id': result.uid, 'rev': result.rev, 'error': error.error, 'reason': error.reason}
+                for result, error in zip(results, errors) if error is not None
+            ])
+
+        response = []
+        with self.server.lock:
+            for result in results:
+                if result.uid is None:
+                    result = result._replace(uid=db.uid())
+                try:
+                    res = self.update(db, result)
+                    response.append({'ok': True, 'id': res.uid, 'rev': res.rev})
+                except HTTPError as e:
+                    response.append({'id': result.uid, 'error': e.error, 'reason': e.reason})
+                except (DataError, NotFoundError) as e:
+                    response.append({'id': result.uid, 'error': 'bad_request', 'reason': str(e)})
+        self.send_json(201, response)
+
+    def revs_diff(self, db):
+        body = self.json_body()
+        if not isinstance(body, dict):
+            raise HTTPError(400, 'bad_request', 'Request body must be a JSON object')
+        with self.server.lock:
+            diff = db.changes_get_diff(body)
+        self.send_json(200, dict((uid, {'missing': revs}) for uid, revs in diff.iteritems()))
+
+    def all_docs(self, db, rows_per_chunk=1000):
+        """Documents in the order of their uids, streamed in chunks which
+        are each read holding the lock.
+        """
+        query = self.query
+
+        def param(*names):
+            for name in names:
+                if name in query:
+                    try:
+                        return json.loads(query[name])
+                    except ValueError:
+                        raise HTTPError(400, 'bad_request', 'invalid JSON in {}'.format(name))
+            return None
+
+        startkey = param('startkey', 'start_key', 'key')
+        endkey = param('endkey', 'end_key', 'key')
+        limit = param('limit')
+        include_docs = query.get('include_docs') == 'true'
+        with self.server.lock:
+            total = len(db.ids)
+            rows = db.all_docs(
+                startkey, endkey, limit, param('skip') or 0, query.get('descending') == 'true',
+                include_docs, query.get('inclusive_end') != 'false')
+
+        def chunks():
+            yield '{{"total_rows":{},"rows":[\n'.format(total)
+            sent = 0
+            while True:
+                with self.server.lock:
+                    chunk = list(islice(rows, rows_per_chunk))
+                lines = []
+                for row in chunk:
+                    data = {'id': row.uid, 'key': row.uid, 'value': {'rev': row.rev}}
+                    if include_docs:
+                        data['doc'] = result_to_json(row.doc)
+                    lines.append(json.dumps(data))
+                if lines:
+                    yield (',\n' if sent else '') + ',\n'.join(lines)
+                sent += len(lines)
+                if len(chunk) < rows_per_chunk:
+                    break
+            yield '\n]}\n'
+
+        self.send_chunked(200, chunks())
+
+    def bulk_get(self, db, lines_per_chunk=100):
+        """Many revisions with their history in one streamed response,
+        the `_bulk_get` extension of Sync Gateway and CouchDB 2.
+
+        With `Accept: application/x-ndjson` each revision is a line of its
+        own, otherwise the CouchDB JSON format is used.
+        """
+        body = self.json_body()
+        docs = body.get('docs') if isinstance(body, dict) else None
+        if not isinstance(docs, list) or not all(isinstance(doc, dict) and doc.get('id') for doc in docs):
+            raise HTTPError(400, 'bad_request', 'Missing JSON list of docs')
+        pairs = [(doc['id'], doc.get('rev')) for doc in docs]
+        with self.server.lock:
+            results = db.get_bulk(pairs, self.query.get('revs') == 'true')
+
+        items = [
+            {'error': {
+                'id': uid, 'rev': rev or 'undefined',
+                'error': 'not_found', 'reason': str(result) or 'missing',
+            }} if isinstance(result, Exception) else {'ok': result_to_json(result)}
+            for (uid, rev), result in zip(pairs, results)
+        ]
+
+        if 'application/x-ndjson' in self.headers.get('Accept', ''):
+            lines = [json.dumps(item) + '\n' for item in items]
+            content_type = 'application/x-ndjson'
+        else:
+            grouped = groupby(zip(pairs, items), lambda entry: entry[0][0])
+            lines = [
+                (',\n' if i else '') + json.dumps({'id': uid, 'docs': [item for _, item in group]})
+                for i, (uid, group) in enumerate(grouped)
+            ]
+            lines = ['{"results":[\n'] + lines + ['\n]}\n']
+            content_type = 'application/json'
+
+        self.send_chunked(200, (
+            ''.join(lines[i:i + lines_per_chunk]) for i in xrange(0, len(lines), lines_per_chunk)
+        ), content_type)
+
+    def changes(self, db):
+        """Changes feed, `normal`, `longpoll` or `continuous`.
+
+        Changes of one document share their seq, they are given as one
+        result with all the leaf revs. With `filter` only the documents
+        passing it are listed, the filter is given the other query
+        parameters and the fields of a JSON object body, such as
+        `doc_ids` or `selector`.
+        """
+        feed = self.query.get('feed', 'normal')
+        style = self.query.get('style', 'main_only')
+        limit = int(self.query['limit']) if 'limit' in self.query else None
+        timeout = int(self.query.get('timeout', 60000)) / 1000.
+        heartbeat = int(self.query['heartbeat']) / 1000. if 'heartbeat' in self.query else None
+
+        since = self.query.get('since', '0')
+        if since == 'now':
+            with self.server.lock:
+                since = db.changes_get_seq()
+        since = int(since)
+
+        filter = self.query.get('filter')
+        params = None
+        if filter is not None:
+            params = dict((k, v) for k, v in self.query.iteritems() if k not in CHANGES_PARAMS)
+            if self.body:
+                body = self.json_body()
+                if not isinstance(body, dict):
+                    raise HTTPError(400, 'bad_request', 'body has to be a JSON object')
+                params.update(body)
+            db.filter_get(filter, params)  # an invalid filter fails before the feed starts
+        read = lambda since, limit: self.changes_read(db, since, style, limit, filter, params)
+
+        # subscribed before reading, so no change is missed
+        event = threading.Event()
+        notify = lambda uid, seq: event.set()
+        db.changes_subscribe(notify)
+        try:
+            if feed == 'continuous':
+                return self.changes_continuous(read, event, since, limit, timeout, heartbeat)
+
+            pages = read(since, limit)
+            first = next(pages, ([], since))
+            if feed == 'longpoll' and not first[0]:
+                self.wait_change(event, timeout)
+                pages = read(since, limit)
+                first = next(pages, ([], since))
+        finally:
+            db.changes_unsubscribe(notify)
+
+        def chunks(last_seq=since):
+            yield '{"results":[\n'
+            sent = 0
+            for page, last_seq in chain([first], pages):
+                if page:
+                    yield (',\n' if sent else '') + ',\n'.join(json.dumps(r) for r in page)
+                    sent += len(page)
+            yield '\n],\n"last_seq":{}}}\n'.format(last_seq)
+
+        self.send_chunked(200, chunks())
+
+    def changes_continuous(self, read, event, since, limit, timeout, heartbeat):
+        """A line for each result as they come, until `timeout` passes
+        without changes or `limit` results are sent. `read(since, limit)`
+        gives the results in pages.
+        """
+        self.send_chunked_start(200)
+        deadline = time.time() + timeout
+        sent = 0
+        while limit is None or sent < limit:
+            event.clear()
+            count = 0
+            for page, since in read(since, None if limit is None else limit - sent):
+                if page:
+                    self.send_chunk(''.join(json.dumps(result) + '\n' for result in page))
+                count += len(page)
+            sent += count
+            if count:
+                deadline = time.time() + timeout
+                continue
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if not self.wait_change(event, min(remaining, heartbeat or remaining)) and heartbeat:
+                self.send_chunk('\n')
+
+        self.send_chunk(json.dumps({'last_seq': since}) + '\n')
+        self.send_chunk('')
+
+    def wait_change(self, event, timeout, check_interval=1):
+        """Wait for `event` up to `timeout` seconds, give up early if the
+        client has gone. Returns `True` if the event is set.
+        """
+        deadline = time.time() + timeout
+        while not event.wait(min(check_interval, max(deadline - time.time(), 0))):
+            if time.time() >= deadline:
+                return False
+            if self.client_gone():
+                raise socket.error('client disconnected')
+        return True
+
+    def client_gone(self):
+        readable, _, _ = select.select([self.connection], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return not self.connection.recv(1, socket.MSG_PEEK)
+        except socket.error:
+            return True
+
+    def changes_read(self, db, since, style, limit=None, filter=None, params=None,
+                     results_per_page=1000):
+        """Results of the changes feed, a document is listed with its seq
+        and the leaf revs the feed gave for it. They are read as they are
+        sent, in pages which are each read holding the lock, given with
+        the last seq read: a filtered feed reads past the results.
+        """
+        with self.server.lock:
+            if filter is None:
+                changes = db.changes_get(since, style)
+            else:
+                changes = db.changes_get_filtered(since, style, filter, params)
+        groups = islice(groupby(changes, lambda change: change.seq), limit)
+
+        while True:
+            page = []
+            read = 0
+            with self.server.lock:
+                for seq, group in islice(groups, results_per_page):
+                    read += 1
+                    group = list(group)
+                    if group[0].uid is None:
+                        continue  # the last seq of a filtered feed
+                    page.append({
+                        'seq': seq,
+                        'id': group[0].uid,
+                        'changes': [{'rev': change.rev} for change in group],
+                    })
+            if read:
+                yield page, seq
+            if read < results_per_page:
+                return
+
+    def local(self, method, db, uid):
+        if method in ('GET', 'HEAD'):
+            with self.server.lock:
+                value = db.local_get(uid, None)
+            if value is None:
+                raise NotFoundError('missing')
+            body = result_to_json(Result('_local/' + uid, '0-1', value, False, None))
+            return self.send_json(200, body)
+
+        if method == 'PUT':
+            result = json_to_result(self.json_body())
+            with self.server.lock:
+                db.local_put(uid, result.value)
+            return self.send_json(201, {'ok': True, 'id': '_local/' + uid, 'rev': '0-1'})
+
+        if method == 'DELETE':
+            with self.server.lock:
+                if db.local_get(uid, None) is None:
+                    raise NotFoundError('missing')
+                del db.local[uid]
+            return self.send_json(200, {'ok': True, 'id': '_local/' + uid, 'rev': '0-0'})
+
+        self.check_method(method, 'GET', 'HEAD', 'PUT', 'DELETE')
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        if body and self.headers.get('Content-Encoding') == 'gzip':
+            try:
+                body = zlib.decompress(body, GZIP)
+            except zlib.error:
+                raise HTTPError(400, 'bad_request', 'invalid gzip body')
+        return body
+
+    def json_body(self):
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            raise HTTPError(400, 'bad_request', 'invalid UTF-8 JSON')
+
+    def send_json(self, status, body, etag=None):
+        self.send_data(status, json.dumps(body) + '\n', 'application/json', etag)
+
+    def send_data(self, status, data, content_type, etag=None):
+        gzipped = (
+            len(data) >= self.compress_size and
+            'gzip' in self.headers.get('Accept-Encoding', '')
+        )
+        if gzipped:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, GZIP)
+            data = compressor.compress(data) + compressor.flush()
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        if etag is not None:
+            self.send_header('ETag', '"{}"'.format(etag))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def send_chunked_start(self, status, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def send_chunk(self, data):
+        """Write a chunk at once, an empty one ends the response."""
+        self.wfile.write('{:x}\r\n{}\r\n'.format(len(data), data))
+
+    def send_chunked(self, status, chunks, content_type='application/json'):
+        self.send_chunked_start(status, content_type)
+        for chunk in chunks:
+            if chunk:
+                self.send_chunk(chunk)
+        self.send_chunk('')
+
+    def log_message(self, format, *args):
+        logger.info('%s %s', self.address_string(), format % args)
+
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO)
+    server = Server(('', 5984), dict((name, DB(name)) for name in argv))
+    print('serving {} at {}'.format(', '.join(argv), server.url))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,406 @@
+"""Databases split into shards by document uid.
+
+Documents are spread over the shards by a hash of their uid, like in
+CouchDB 2. Each shard is a database of its own, run by a worker process
+so the shards use as many cores. A request touching several shards is
+sent to all of them before any reply is read, the shards serve it in
+parallel.
+
+The changes feeds of the shards are merged into one. Its seqs are lists
+with the seq of every shard, so a feed resumed from one of them starts
+each shard where it was left. Seqs of different feeds can not be
+compared like numbers, a checkpoint may be ahead on a shard and behind
+on another, replicators compare them with `seq_min` and `change_newer`.
+"""
+from collections import defaultdict
+from multiprocessing import Pipe, Process
+import threading
+import uuid
+import zlib
+
+from .db import DB, group_changes
+from .exceptions import DataError
+
+
+def shard_of(uid, shards):
+    """Index of the shard of a document, the CRC32 of its uid."""
+    if isinstance(uid, unicode):
+        uid = uid.encode('utf-8')
+    return (zlib.crc32(uid) & 0xffffffff) % shards
+
+
+class ShardWorker(object):
+    """Serves the requests to the database of a shard.
+
+    A request is a `(method, args, kwargs)` tuple, a method of the
+    database or one of `WORKER_METHODS`. The reply is `(True, result)`,
+    or `(False, exception)` if it raised.
+    """
+
+    WORKER_METHODS = frozenset(['changes_page', 'notify'])
+
+    def __init__(self, db, on_change):
+        self.db = db
+        self.on_change = on_change  # called with `uid, seq` of the changes when notifying
+
+    def handle(self, request):
+        method, args, kwargs = request
+        target = self if method in self.WORKER_METHODS else self.db
+        try:
+            result = getattr(target, method)(*args, **kwargs)
+            if hasattr(result, 'next'):
+                result = list(result)  # generators do not cross processes
+            return True, result
+        except Exception as e:
+            return False, e
+
+    def changes_page(self, since, limit, style='all_docs', filter=None, params=None):
+        """About `limit` changes since `since` and whether the feed ends
+        there. Changes sharing a seq are kept on one page.
+        """
+        if filter is None:
+            changes = self.db.changes_get(since, style)
+        else:
+            changes = self.db.changes_get_filtered(since, style, filter, params)
+
+        page = []
+        for change in changes:
+            if len(page) >= limit and change.seq != page[-1].seq:
+                return page, False
+            page.append(change)
+        return page, True
+
+    def notify(self, on):
+        """Pass the changes to `on_change`, or stop to."""
+        if on:
+            self.db.changes_subscribe(self.on_change)
+        else:
+            self.db.changes_unsubscribe(self.on_change)
+
+
+class LocalShard(object):
+    """Shard served in the calling thread."""
+
+    def __init__(self, db, on_change):
+        self.lock = threading.RLock()
+        self.worker = ShardWorker(db, on_change)
+        self._replies = []
+
+    def send(self, request):
+        self._replies.append(self.worker.handle(request))
+
+    def recv(self):
+        return self._replies.pop(0)
+
+    def close(self):
+        close = getattr(self.worker.db, 'close', None)
+        if close is not None:
+            close()
+
+
+class ProcessShard(object):
+    """Shard served by a worker process, over a pipe.
+
+    The changes the worker is asked to notify come on a pipe of their
+    own, read by a thread which calls `on_change(uid, seq)`.
+    """
+
+    def __init__(self, db_class, name, on_change):
+        self.lock = threading.RLock()
+        self.conn, conn = Pipe()
+        events, send_events = Pipe(duplex=False)
+        self.process = Process(target=_serve, args=(db_class, name, conn, send_events))
+        self.process.daemon = True
+        self.process.start()
+        # the worker holds the other ends, the pipes end with it
+        conn.close()
+        send_events.close()
+
+        self._listener = threading.Thread(target=self._listen, args=(events, on_change))
+        self._listener.daemon = True
+        self._listener.start()
+
+    def send(self, request):
+        self.conn.send(request)
+
+    def recv(self):
+        return self.conn.recv()
+
+    def close(self):
+        with self.lock:
+            self.conn.send(None)
+            self.conn.close()
+        self.process.join()
+        self._listener.join()
+
+    def _listen(self, events, on_change):
+        while True:
+            try:
+                uid, seq = events.recv()
+            except EOFError:
+                return
+            on_change(uid, seq)
+
+
+def _serve(db_class, name, conn, events):
+    """Main loop of a shard worker process."""
+    db = db_class(name)
+    worker = ShardWorker(db, lambda uid, seq: events.send((uid, seq)))
+    for request in iter(conn.recv, None):
+        conn.send(worker.handle(request))
+
+    close = getattr(db, 'close', None)
+    if close is not None:
+        close()
+
+
+class ShardedDB(object):
+    """Database of `shards` databases made by `db_class(name)`, the
+    name of a shard is the name of the database and its index.
+
+    The shards run in worker processes, or in the calling thread if not
+    `processes`. `db_class` is then called in the worker, it has to be
+    a class or a function which can be pickled.
+    """
+
+    def __init__(self, name, shards=4, db_class=DB, processes=True):
+        self.name = name
+        self.subscribers = []  # callbacks notified of the changes of all shards
+        self.seqs = [0] * shards  # latest seqs the shards notified
+
+        self.shards = []
+        for i in range(shards):
+            on_change = lambda uid, seq, i=i: self.changes_notify(i, uid, seq)
+            shard_name = '{}.{}'.format(name, i)
+            if processes:
+                self.shards.append(ProcessShard(db_class, shard_name, on_change))
+            else:
+                self.shards.append(LocalShard(db_class(shard_name), on_change))
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def shard_of(self, uid):
+        return shard_of(uid, len(self.shards))
+
+    def put(self, value, uid=None, rev=None):
+        uid = self.uid() if uid is None else uid
+        return self._call(uid, 'put', value, uid, rev)
+
+    def put_bulk(self, results):
+        """Write the results of each shard in parallel, give the results
+        of `DB.put_bulk` in the order of `results`.
+        """
+        return self._split(results, lambda result: result.uid, 'put_bulk')
+
+    def get(self, uid, rev=None, revs=False):
+        return self._call(uid, 'get', uid, rev, revs)
+
+    def get_bulk(self, pairs, revs=False):
+        return self._split(pairs, lambda pair: pair[0], 'get_bulk', revs)
+
+    def remove(self, uid, rev):
+        return self._call(uid, 'remove', uid, rev)
+
+    def all_docs(self, startkey=None, endkey=None, limit=None, skip=0, descending=False,
+                 include_docs=False, inclusive_end=True):
+        """Rows of `DB.all_docs`, merged from the pages of the shards."""
+        count = None if limit is None else skip + limit
+        pages = self._scatter([
+            (i, 'all_docs', (startkey, endkey, count, 0, descending, include_docs, inclusive_end))
+            for i in range(len(self.shards))
+        ])
+        rows = sorted((row for page in pages for row in page), reverse=descending)
+        return iter(rows[skip:count])
+
+    def compact(self):
+        self._scatter([(i, 'compact', ()) for i in range(len(self.shards))])
+
+    def attachment_put(self, uid, rev, name, data, content_type='application/octet-stream'):
+        return self._call(uid, 'attachment_put', uid, rev, name, data, content_type)
+
+    def attachment_get(self, uid, name, rev=None):
+        return self._call(uid, 'attachment_get', uid, name, rev)
+
+    def attachment_remove(self, uid, rev, name):
+        return self._call(uid, 'attachment_remove', uid, rev, name)
+
+    def blobs_get(self, digests):
+        blobs = {}
+        for found in self._scatter([(i, 'blobs_get', (digests,)) for i in range(len(self.shards))]):
+            blobs.update(found)
+        return blobs
+
+    def blobs_put(self, blobs):
+        """Store the bodies in the shards lacking them, a document of any
+        shard may refer to them.
+        """
+        missing = self._scatter([
+            (i, 'blobs_get_diff', (sorted(blobs),)) for i in range(len(self.shards))])
+        self._scatter([
+            (i, 'blobs_put', (dict((digest, blobs[digest]) for digest in digests),))
+            for i, digests in enumerate(missing) if digests
+        ])
+
+    def blobs_get_diff(self, digests):
+        missing = set()
+        for found in self._scatter([
+                (i, 'blobs_get_diff', (digests,)) for i in range(len(self.shards))]):
+            missing.update(found)
+        return [digest for digest in digests if digest in missing]
+
+    def changes_notify(self, index, uid, seq):
+        self.seqs[index] = max(self.seqs[index], seq)
+        seqs = list(self.seqs)
+        for callback in list(self.subscribers):
+            callback(uid, seqs)
+
+    def changes_subscribe(self, callback):
+        """Call `callback(uid, seq)` on every change, `seq` has the
+        latest seq of each shard known when it is called.
+        """
+        if not self.subscribers:
+            self._scatter([(i, 'notify', (True,)) for i in range(len(self.shards))])
+            self.seqs = self.changes_get_seq()
+        self.subscribers.append(callback)
+
+    def changes_unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+        if not self.subscribers:
+            self._scatter([(i, 'notify', (False,)) for i in range(len(self.shards))])
+
+    def changes_get(self, since=0, style='all_docs', chunk_size=1000):
+        """Changes of all the shards, with seqs resuming the feed.
+
+        The shards are read a page of `chunk_size` changes at a time, in
+        parallel, and their pages are given in turn.
+        """
+        return self._changes(since, chunk_size, style)
+
+    def changes_get_filtered(self, since=0, style='all_docs', filter=None, params=None,
+                             chunk_size=1000):
+        """Filtered changes of all the shards, a filter of `filters` of
+        the shard databases or one of the built-in ones.
+        """
+        return self._changes(since, chunk_size, style, filter, params)
+
+    def conflicts_get(self, since=0):
+        """Conflicted documents of all the shards, with seqs of the
+        changes feed.
+        """
+        seqs = self._seqs(since)
+        pages = self._scatter([(i, 'conflicts_get', (seq,)) for i, seq in enumerate(seqs)])
+        for i, page in enumerate(pages):
+            for change in page:
+                seqs[i] = change.seq
+                yield change._replace(seq=list(seqs))
+
+    def _seqs(self, since):
+        """Seq of each shard in a seq of the feed."""
+        seqs = list(since) if since else [0] * len(self.shards)
+        if len(seqs) != len(self.shards):
+            raise DataError('seq of {} shards, not {}'.format(len(seqs), len(self.shards)))
+        return seqs
+
+    def _changes(self, since, chunk_size, *args):
+        seqs = self._seqs(since)
+        active = range(len(self.shards))
+        while active:
+            pages = self._scatter([
+                (i, 'changes_page', (seqs[i], chunk_size) + args) for i in active])
+            for i, (page, done) in zip(list(active), pages):
+                for change in page:
+                    seqs[i] = change.seq
+                    yield change._replace(seq=list(seqs))
+                if done:
+                    active.remove(i)
+
+    def changes_get_size(self):
+        return sum(self._scatter([(i, 'changes_get_size', ()) for i in range(len(self.shards))]))
+
+    def changes_get_seq(self):
+        return self._scatter([(i, 'changes_get_seq', ()) for i in range(len(self.shards))])
+
+    def seq_min(self, seqs):
+        """Seq of the feed to read from for checkpoints at `seqs`, the
+        lowest seq of each shard.
+        """
+        return [min(shard_seqs) for shard_seqs in zip(*[self._seqs(seq) for seq in seqs])]
+
+    def change_newer(self, change, since):
+        """Whether `change` is past the checkpoint `since` on its shard,
+        on any shard for the last seq of a filtered feed.
+        """
+        if not since:
+            return True
+        if change.uid is None:
+            return any(seq > seen for seq, seen in zip(change.seq, since))
+        i = self.shard_of(change.uid)
+        return change.seq[i] > since[i]
+
+    def changes_get_grouped(self, since=0):
+        return group_changes(self.changes_get(since))
+
+    def changes_get_diff(self, grouped):
+        split = defaultdict(dict)
+        for uid, revs in grouped.iteritems():
+            split[self.shard_of(uid)][uid] = revs
+
+        res = {}
+        for diff in self._scatter([(i, 'changes_get_diff', (split[i],)) for i in split]):
+            res.update(diff)
+        return res
+
+    def local_put(self, uid, value):
+        return self._call(uid, 'local_put', uid, value)
+
+    def local_get(self, uid, default=0):
+        return self._call(uid, 'local_get', uid, default)
+
+    def uid(self):
+        return str(uuid.uuid4())
+
+    def _call(self, uid, method, *args, **kwargs):
+        """Call `method` of the shard of `uid`."""
+        return self._scatter([(self.shard_of(uid), method, args, kwargs)])[0]
+
+    def _split(self, items, get_uid, method, *args):
+        """Call `method` of each shard with its share of `items`, give
+        the results in the order of `items`.
+        """
+        positions = defaultdict(list)
+        for position, item in enumerate(items):
+            positions[self.shard_of(get_uid(item))].append(position)
+
+        res = [None] * len(items)
+        replies = self._scatter([
+            (i, method, ([items[position] for position in shard_positions],) + args)
+            for i, shard_positions in positions.iteritems()
+        ])
+        for shard_positions, results in zip(positions.itervalues(), replies):
+            for position, result in zip(shard_positions, results):
+                res[position] = result
+        return res
+
+    def _scatter(self, requests):
+        """Send `(index, method, args[, kwargs])` requests to the shards,
+        then read the replies, so the shards serve them in parallel.
+        Gives the results in order, raises the first error.
+        """
+        shards = [self.shards[i] for i in sorted(set(request[0] for request in requests))]
+        for shard in shards:
+            shard.lock.acquire()
+        try:
+            for request in requests:
+                kwargs = request[3] if len(request) > 3 else {}
+                self.shards[request[0]].send((request[1], request[2], kwargs))
+            replies = [self.shards[request[0]].recv() for request in requests]
+        finally:
+            for shard in shards:
+                shard.lock.release()
+
+        for ok, result in replies:
+            if not ok:
+                raise result
+        return [result for ok, result in replies]
@@ -0,0 +1,384 @@
+"""SQLite storage for `DB`.
+
+The revision trees are kept in SQLite tables, while the revision logic
+is the one of `Document`: documents are loaded into a small cache of
+`Document` objects and the revisions added to them are written back
+(see `CachedStorage`). A database file is meant to be used by a single `SqliteDB` at a time.
+"""
+from collections import MutableMapping, defaultdict
+from contextlib import contextmanager
+import json
+import sqlite3
+import threading
+
+from .db import DB, Change
+from .doc import Document, Revision
+from .storage import CachedStorage
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    uid TEXT PRIMARY KEY,
+    winner TEXT,
+    conflicts TEXT,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    conflicted INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS docs_listed ON docs (deleted, uid);
+CREATE INDEX IF NOT EXISTS docs_conflicted ON docs (conflicted, uid);
+CREATE TABLE IF NOT EXISTS revs (
+    id INTEGER PRIMARY KEY,
+    uid TEXT NOT NULL,
+    rev TEXT NOT NULL,
+    parent TEXT,
+    generation INTEGER NOT NULL,
+    deleted INTEGER NOT NULL,
+    stub INTEGER NOT NULL,
+    value TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS revs_uid_rev ON revs (uid, rev);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    uid TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS local (
+    uid TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+"""
+
+# SQLite limits the number of host parameters of a statement
+MAX_PARAMS = 900
+
+
+class SqliteDB(DB):
+    def __init__(self, name, path=None, cache_size=1000, hasher='md5'):
+        super(SqliteDB, self).__init__(name, hasher)
+        self.path = path or name + '.sqlite'
+        self.lock = threading.RLock()
+        self.stripes = [self.lock]  # writes are serialized, see `transaction`
+        self._depth = 0  # nesting of `transaction`
+
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+
+        self.storage = SqliteStorage(self, cache_size)
+        self.local = SqliteLocal(self)
+        self.blobs = SqliteBlobs(self)
+        self.ids = SqliteIds(self)
+        self.conflicted = SqliteConflicts(self)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """Group all the writes in one transaction, nested calls join it."""
+        with self.lock:
+            self._depth += 1
+            try:
+                yield self.conn
+            except BaseException:
+                self._depth -= 1
+                if not self._depth:
+                    self.conn.rollback()
+                    # cached documents may hold revisions which are gone
+                    self.storage.clear()
+                raise
+            else:
+                self._depth -= 1
+                if not self._depth:
+                    self.conn.commit()
+
+    def put(self, value, uid=None, rev=None):
+        with self.transaction():
+            return super(SqliteDB, self).put(value, uid, rev)
+
+    def put_bulk(self, results):
+        with self.transaction():
+            return super(SqliteDB, self).put_bulk(results)
+
+    def remove(self, uid, rev):
+        with self.transaction():
+            return super(SqliteDB, self).remove(uid, rev)
+
+    def compact_put(self, uid):
+        with self.transaction():
+            self.storage.replace(uid)
+
+    def blobs_put(self, blobs):
+        with self.transaction():
+            return super(SqliteDB, self).blobs_put(blobs)
+
+    def changes_put(self, uid):
+        with self.transaction() as conn:
+            self.storage.save(uid)
+            conn.execute('DELETE FROM changes WHERE uid = ?', (uid,))
+            seq = conn.execute('INSERT INTO changes (uid) VALUES (?)', (uid,)).lastrowid
+
+            self.changes_notify(uid, seq)
+        return seq
+
+    def changes_get(self, since=0, style='all_docs', chunk_size=1000):
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    'SELECT c.seq, c.uid, d.winner, d.conflicts'
+                    ' FROM changes c JOIN docs d ON d.uid = c.uid'
+                    ' WHERE c.seq > ? ORDER BY c.seq LIMIT ?',
+                    (since, chunk_size)
+                ).fetchall()
+
+            for seq, uid, winner, conflicts in rows:
+                yield Change(uid, winner, seq)
+                if style == 'all_docs':
+                    for rev in sorted(json.loads(conflicts)):
+                        yield Change(uid, rev, seq)
+
+            if len(rows) < chunk_size:
+                return
+            since = rows[-1][0]
+
+    def changes_get_size(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM changes').fetchone()[0]
+
+    def changes_get_seq(self):
+        with self.lock:
+            return self.conn.execute('SELECT COALESCE(MAX(seq), 0) FROM changes').fetchone()[0]
+
+    def changes_get_diff(self, grouped):
+        res = defaultdict(list)
+        with self.lock:
+            for uid, revs in grouped.iteritems():
+                known = set()
+                for i in range(0, len(revs), MAX_PARAMS):
+                    chunk = revs[i:i + MAX_PARAMS]
+                    known.update(rev for rev, in self.conn.execute(
+                        'SELECT rev FROM revs WHERE uid = ? AND rev IN ({})'.format(
+                            ', '.join('?' * len(chunk))),
+                        [uid] + chunk
+                    ))
+                for rev in revs:
+                    if rev not in known:
+                        res[uid].append(rev)
+        return res
+
+
+class SqliteStorage(CachedStorage):
+    def __init__(self, db, cache_size):
+        super(SqliteStorage, self).__init__(db.lock, cache_size)
+        self.db = db
+
+    def __contains__(self, uid):
+        with self.lock:
+            return self.db.conn.execute(
+                'SELECT 1 FROM docs WHERE uid = ?', (uid,)).fetchone() is not None
+
+    def __iter__(self):
+        with self.lock:
+            uids = self.db.conn.execute('SELECT uid FROM docs').fetchall()
+        return (uid for uid, in uids)
+
+    def __len__(self):
+        with self.lock:
+            return self.db.conn.execute('SELECT COUNT(*) FROM docs').fetchone()[0]
+
+    def load(self, uid):
+        document = Document()
+        rows = self.db.conn.execute(
+            'SELECT rev, value, deleted, parent, generation, stub'
+            ' FROM revs WHERE uid = ? ORDER BY id', (uid,))
+        for rev, value, deleted, parent, generation, stub in rows:
+            document[rev] = Revision(
+                value=json.loads(value),
+                deleted=bool(deleted),
+                parent=parent,
+                generation=generation,
+                stub=bool(stub)
+            )
+
+        row = self.db.conn.execute(
+            'SELECT winner, conflicts FROM docs WHERE uid = ?', (uid,)).fetchone()
+        if row is not None:
+            document.winner = row[0]
+            document.conflicts = set(json.loads(row[1]))
+        return document
+
+    def write(self, uid, document, revs, replace=False):
+        conn = self.db.conn
+        if replace:
+            conn.execute('DELETE FROM revs WHERE uid = ?', (uid,))
+        conn.executemany(
+            'INSERT INTO revs (uid, rev, parent, generation, deleted, stub, value)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [
+                (uid, rev, r.parent, r.generation, r.deleted, r.stub, json.dumps(r.value))
+                for rev, r in ((rev, document[rev]) for rev in revs)
+            ]
+        )
+        conn.execute(
+            'INSERT OR REPLACE INTO docs (uid, winner, conflicts, deleted, conflicted)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            (uid, document.winner, json.dumps(sorted(document.conflicts)), document.deleted,
+             bool(document.conflicts and document.open_conflicts))
+        )
+
+
+class SqliteIds(object):
+    """`DB.ids` replacement, the docs table indexed by deleted and uid."""
+
+    def __init__(self, db, chunk_size=1000):
+        self.db = db
+        self.chunk_size = chunk_size  # rows read at once
+
+    def __len__(self):
+        with self.db.lock:
+            return self.db.conn.execute(
+                'SELECT COUNT(*) FROM docs WHERE deleted = 0').fetchone()[0]
+
+    def range(self, startkey=None, endkey=None, inclusive_end=True, descending=False,
+              skip=0, limit=None):
+        after, before = ('<', '>') if descending else ('>', '<')
+        conditions = ['deleted = 0']
+        params = []
+        if startkey is not None:
+            conditions.append('uid {}= ?'.format(after))
+            params.append(startkey)
+        if endkey is not None:
+            conditions.append('uid {}{} ?'.format(before, '=' if inclusive_end else ''))
+            params.append(endkey)
+        query = 'SELECT uid, winner FROM docs WHERE {} ORDER BY uid {} LIMIT ? OFFSET ?'
+        order = 'DESC' if descending else 'ASC'
+
+        last = None
+        offset = skip
+        while limit is None or limit > 0:
+            size = self.chunk_size if limit is None else min(limit, self.chunk_size)
+            where = conditions
+            args = params
+            if last is not None:
+                # the next chunk starts past the last uid, not at an offset
+                where = conditions + ['uid {} ?'.format(after)]
+                args = params + [last]
+            with self.db.lock:
+                rows = self.db.conn.execute(
+                    query.format(' AND '.join(where), order), args + [size, offset]).fetchall()
+
+            for row in rows:
+                yield row
+            if len(rows) < size:
+                return
+            if limit is not None:
+                limit -= len(rows)
+            last = rows[-1][0]
+            offset = 0
+
+
+class SqliteConflicts(object):
+    """`DB.conflicted` replacement, the docs table indexed by conflicted."""
+
+    def __init__(self, db, chunk_size=1000):
+        self.db = db
+        self.chunk_size = chunk_size  # rows read at once
+
+    def __len__(self):
+        with self.db.lock:
+            return self.db.conn.execute(
+                'SELECT COUNT(*) FROM docs WHERE conflicted = 1').fetchone()[0]
+
+    def range(self, since=0):
+        while True:
+            with self.db.lock:
+                rows = self.db.conn.execute(
+                    'SELECT c.uid, c.seq FROM docs d JOIN changes c ON c.uid = d.uid'
+                    ' WHERE d.conflicted = 1 AND c.seq > ? ORDER BY c.seq LIMIT ?',
+                    (since, self.chunk_size)
+                ).fetchall()
+
+            for row in rows:
+                yield row
+            if len(rows) < self.chunk_size:
+                return
+            since = rows[-1][1]
+
+
+class SqliteLocal(MutableMapping):
+    """`DB.local` replacement, not replicated values of the database."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __getitem__(self, uid):
+        with self.db.lock:
+            row = self.db.conn.execute(
+                'SELECT value FROM local WHERE uid = ?', (uid,)).fetchone()
+        if row is None:
+            raise KeyError(uid)
+        return json.loads(row[0])
+
+    def __setitem__(self, uid, value):
+        with self.db.transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO local (uid, value) VALUES (?, ?)',
+                (uid, json.dumps(value)))
+
+    def __delitem__(self, uid):
+        with self.db.transaction() as conn:
+            if not conn.execute('DELETE FROM local WHERE uid = ?', (uid,)).rowcount:
+                raise KeyError(uid)
+
+    def __iter__(self):
+        with self.db.lock:
+            uids = self.db.conn.execute('SELECT uid FROM local').fetchall()
+        return (uid for uid, in uids)
+
+    def __len__(self):
+        with self.db.lock:
+            return self.db.conn.execute('SELECT COUNT(*) FROM local').fetchone()[0]
+
+
+class SqliteBlobs(MutableMapping):
+    """`DB.blobs` replacement, attachment bodies by digest."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __contains__(self, digest):
+        with self.db.lock:
+            return self.db.conn.execute(
+                'SELECT 1 FROM blobs WHERE digest = ?', (digest,)).fetchone() is not None
+
+    def __getitem__(self, digest):
+        with self.db.lock:
+            row = self.db.conn.execute(
+                'SELECT data FROM blobs WHERE digest = ?', (digest,)).fetchone()
+        if row is None:
+            raise KeyError(digest)
+        return str(row[0])
+
+    def __setitem__(self, digest, data):
+        with self.db.transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO blobs (digest, data) VALUES (?, ?)',
+                (digest, sqlite3.Binary(data)))
+
+    def __delitem__(self, digest):
+        with self.db.transaction() as conn:
+            if not conn.execute('DELETE FROM blobs WHERE digest = ?', (digest,)).rowcount:
+                raise KeyError(digest)
+
+    def __iter__(self):
+        with self.db.lock:
+            digests = self.db.conn.execute('SELECT digest FROM blobs').fetchall()
+        return (digest for digest, in digests)
+
+    def __len__(self):
+        with self.db.lock:
+            return self.db.conn.execute('SELECT COUNT(*) FROM blobs').fetchone()[0]
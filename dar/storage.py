@@ -0,0 +1,320 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import Mapping, OrderedDict
+from itertools import chain, islice
+
+from .doc import Document
+
+
+class Storage(dict):
+    """`DB.storage` of the memory engine, maps uids to `Document`.
+
+    An unknown uid gives a new empty document without storing it, `add`
+    stores it once it has revisions.
+    """
+
+    def __missing__(self, uid):
+        return Document()
+
+    def add(self, uid, document):
+        self[uid] = document
+
+
+class SortedList(object):
+    """Sorted items kept in blocks of `block_size` to twice as many.
+
+    Adding or removing an item moves the items of its block only, not
+    all the items past it as in a flat list. The block of an item is
+    found by a binary search of the last items of the blocks, the block
+    of a position by a Fenwick tree of their lengths, so finding an
+    item, a position and adding or removing one are logarithmic.
+    """
+
+    def __init__(self, items=(), block_size=1000):
+        self.block_size = block_size
+        items = sorted(items)
+        self._blocks = [items[i:i + block_size] for i in range(0, len(items), block_size)]
+        self._build()
+
+    def _build(self):
+        """Index the blocks after they were split or merged."""
+        self._maxes = [block[-1] for block in self._blocks]
+        self._len = sum(len(block) for block in self._blocks)
+        self._tree = tree = [0] * (len(self._blocks) + 1)  # 1-based
+        for i, block in enumerate(self._blocks, 1):
+            tree[i] += len(block)
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return chain.from_iterable(self._blocks)
+
+    def __getitem__(self, index):
+        """Item at a position, or a list of the items of a slice."""
+        if not isinstance(index, slice):
+            if index < 0:
+                index += self._len
+            if not 0 <= index < self._len:
+                raise IndexError('index out of range')
+            i, j = self._locate(index)
+            return self._blocks[i][j]
+
+        start, stop, step = index.indices(self._len)
+        if step != 1:
+            return self[start:stop][::step] if step > 0 else list(self)[index]
+        items = []
+        if start < stop:
+            i, j = self._locate(start)
+            while len(items) < stop - start:
+                items.extend(self._blocks[i][j:j + stop - start - len(items)])
+                i, j = i + 1, 0
+        return items
+
+    def add(self, item):
+        if not self._blocks:
+            self._blocks.append([item])
+            self._build()
+            return
+
+        i = min(bisect_right(self._maxes, item), len(self._blocks) - 1)
+        block = self._blocks[i]
+        insort(block, item)
+        self._maxes[i] = block[-1]
+        self._grow(i, 1)
+        if len(block) > 2 * self.block_size:
+            self._blocks[i:i + 1] = [block[:self.block_size], block[self.block_size:]]
+            self._build()
+
+    def remove(self, item):
+        i = bisect_left(self._maxes, item)
+        block = self._blocks[i] if i < len(self._blocks) else ()
+        j = bisect_left(block, item)
+        if j == len(block) or block[j] != item:
+            raise ValueError('{!r} not in list'.format(item))
+
+        del block[j]
+        if len(block) < self.block_size // 2 and len(self._blocks) > 1:
+            # merged with a neighbour, split again if that is too long
+            i = max(i - 1, 0)
+            merged = self._blocks[i] + self._blocks[i + 1]
+            if len(merged) > 2 * self.block_size:
+                half = len(merged) // 2
+                self._blocks[i:i + 2] = [merged[:half], merged[half:]]
+            else:
+                self._blocks[i:i + 2] = [merged]
+            self._build()
+        elif block:
+            self._maxes[i] = block[-1]
+            self._grow(i, -1)
+        else:
+            del self._blocks[i]
+            self._build()
+
+    def bisect_left(self, item):
+        """Position of the first item not less than `item`."""
+        i = bisect_left(self._maxes, item)
+        if i == len(self._blocks):
+            return self._len
+        return self._offset(i) + bisect_left(self._blocks[i], item)
+
+    def bisect_right(self, item):
+        """Position of the first item greater than `item`."""
+        i = bisect_right(self._maxes, item)
+        if i == len(self._blocks):
+            return self._len
+        return self._offset(i) + bisect_right(self._blocks[i], item)
+
+    def _grow(self, i, n):
+        """Add `n` to the length of the block `i`."""
+        self._len += n
+        tree = self._tree
+        i += 1
+        while i < len(tree):
+            tree[i] += n
+            i += i & -i
+
+    def _offset(self, i):
+        """Number of items in the blocks before the block `i`."""
+        tree = self._tree
+        total = 0
+        while i:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def _locate(self, index):
+        """Block of the position `index` and the position in it."""
+        tree = self._tree
+        i = 0
+        step = 1 << len(tree).bit_length()
+        while step:
+            if i + step < len(tree) and tree[i + step] <= index:
+                i += step
+                index -= tree[i]
+            step >>= 1
+        return i, index
+
+
+class IdIndex(object):
+    """Sorted uids of the documents which are not deleted, with the
+    winner and the deleted status of every document.
+
+    Listing a range of uids is a binary search and a slice, deleted
+    documents are not in the way.
+    """
+
+    def __init__(self, status=None):
+        self.status = status or {}  # uid -> (winner, deleted)
+        # deleted documents left out
+        self.uids = SortedList(uid for uid, (_, deleted) in self.status.iteritems() if not deleted)
+
+    def __len__(self):
+        return len(self.uids)
+
+    def put(self, uid, winner, deleted):
+        old = self.status.get(uid)
+        self.status[uid] = winner, deleted
+        listed = old is not None and not old[1]
+        if listed and deleted:
+            self.uids.remove(uid)
+        elif not listed and not deleted:
+            self.uids.add(uid)
+
+    def range(self, startkey=None, endkey=None, inclusive_end=True, descending=False,
+              skip=0, limit=None):
+        """`(uid, winner)` of the listed documents from `startkey` to
+        `endkey`, both ends are given in the order of the listing.
+        """
+        uids = self.uids
+        if descending:
+            end = uids.bisect_left if inclusive_end else uids.bisect_right
+            hi = len(uids) if startkey is None else uids.bisect_right(startkey)
+            lo = 0 if endkey is None else end(endkey)
+            start = hi - skip
+            stop = lo if limit is None else max(lo, start - limit)
+            selected = uids[stop:max(stop, start)][::-1]
+        else:
+            end = uids.bisect_right if inclusive_end else uids.bisect_left
+            lo = 0 if startkey is None else uids.bisect_left(startkey)
+            hi = len(uids) if endkey is None else end(endkey)
+            start = lo + skip
+            stop = hi if limit is None else min(hi, start + limit)
+            selected = uids[start:max(start, stop)]
+
+        # the page is copied at once, uids put meanwhile do not shift it
+        status = self.status
+        for uid in selected:
+            yield uid, status[uid][0]
+
+
+class ConflictIndex(object):
+    """Documents with open conflicts, ordered by their latest seq.
+
+    Listing the documents conflicted since a seq is a binary search and
+    a slice, it costs the number of conflicted documents, not of all.
+    """
+
+    def __init__(self, status=None):
+        self.status = status or {}  # uid -> seq
+        self.seqs = SortedList(self.status.itervalues())
+        self.uids = dict((seq, uid) for uid, seq in self.status.iteritems())  # seq -> uid
+
+    def __len__(self):
+        return len(self.seqs)
+
+    def put(self, uid, seq, conflicted):
+        old = self.status.pop(uid, None)
+        if old is not None:
+            self.seqs.remove(old)
+            del self.uids[old]
+        if conflicted:
+            self.seqs.add(seq)
+            self.uids[seq] = uid
+            self.status[uid] = seq
+
+    def range(self, since=0):
+        """`(uid, seq)` of the conflicted documents changed past `since`."""
+        # the slice is copied at once, like in `IdIndex.range`
+        seqs = self.seqs[self.seqs.bisect_right(since):]
+        uids = self.uids
+        for seq in seqs:
+            uid = uids.get(seq)
+            if uid is not None:  # else changed meanwhile, it comes at its new seq
+                yield uid, seq
+
+
+class CachedStorage(Mapping):
+    """Base of `DB.storage` for persistent engines, maps uids to `Document`.
+
+    Documents are loaded into a LRU cache, the revisions added to a cached
+    document are written by `save`. An unknown uid gives an empty document,
+    which is only cached.
+
+    Subclasses implement `load`, `write`, `__contains__`, `__iter__` and
+    `__len__`.
+    """
+
+    def __init__(self, lock, cache_size=1000):
+        self.lock = lock
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # uid -> (document, number of saved revisions)
+
+    def __getitem__(self, uid):
+        with self.lock:
+            if uid in self.cache:
+                item = self.cache.pop(uid)
+            else:
+                document = self.load(uid)
+                item = document, len(document)
+
+            self.cache[uid] = item
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+            return item[0]
+
+    def get(self, uid, default=None):
+        with self.lock:
+            if uid in self:
+                return self[uid]
+            return default
+
+    def add(self, uid, document):
+        """Nothing to do, a new document is cached and `save` writes it."""
+
+    def clear(self):
+        """Drop cached documents."""
+        with self.lock:
+            self.cache.clear()
+
+    def save(self, uid):
+        """Write the revisions added to a cached document since it was saved."""
+        with self.lock:
+            document, saved = self.cache[uid]
+            revs = list(islice(reversed(document), len(document) - saved))
+            revs.reverse()
+
+            self.write(uid, document, revs)
+            self.cache[uid] = document, len(document)
+
+    def replace(self, uid):
+        """Rewrite all the revisions of a cached document, e.g. once compacted."""
+        with self.lock:
+            document, _ = self.cache[uid]
+            self.write(uid, document, list(document), replace=True)
+            self.cache[uid] = document, len(document)
+
+    def load(self, uid):
+        """Read a document, an empty one if it does not exist."""
+        raise NotImplementedError
+
+    def write(self, uid, document, revs, replace=False):
+        """Write new revisions `revs` of a document, oldest first.
+
+        With `replace` the revisions written before are dropped and `revs`
+        are all the revisions of the document, its change keeps its seq.
+        """
+        raise NotImplementedError
@@ -1,13 +1,31 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+import base64
+import bisect
 import hashlib
+import httplib
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
 from uuid import uuid4
 import random
 
-from .db import DB, Res
-from .exceptions import DataError, NotFoundError
-from .doc import new_rev, Document, Revision
-from .repl import Repl
+from .db import blob_digest, DB, DocRow, Res, Result, Change
+from .exceptions import DataError, NotFoundError, RemoteError
+from .doc import canonical, new_rev, rev_generation, Document, Revision, HASHERS
+from .repl import FanoutRepl, Repl, PipelinedRepl
+from .sqlite import SqliteDB
+from .log import LogDB, Body
+from .client import RemoteDB
+from .selector import compile_selector
+from .server import result_to_json, Handler, HTTPError, Server
+from .shard import shard_of, ShardedDB
+from .storage import SortedList
+from .view import collate, Row, View
 
 
 class DocTest(unittest.TestCase):
@@ -147,6 +165,25 @@ class DocTest(unittest.TestCase):
         self.assertEqual(doc.winner, rev4)
         self.assertEqual(doc.conflicts, set([rev2, rev3]))
 
+    def test_update_winner_many_conflicts(self):
+        doc = Document()
+        rev, _ = doc.put('val')
+        leafs = set([rev])
+
+        for i in range(200):
+            parent = random.choice(sorted(leafs))
+            if random.randint(0, 4):
+                rev, _ = doc.put(str(uuid4()), parent)
+            else:
+                rev, _ = doc.remove(parent)
+            leafs.discard(parent)
+            leafs.add(rev)
+
+            expected = max(
+                (not doc[l].deleted, doc[l].generation, l) for l in leafs)[2]
+            self.assertEqual(doc.winner, expected)
+            self.assertEqual(doc.conflicts, leafs - set([expected]))
+
     def test_put_first(self):
         doc = Document()
         rev, _ = doc.put('val1')
@@ -175,14 +212,14 @@ class DocTest(unittest.TestCase):
         doc = Document()
         rev, _ = doc.put('val1')
         rev2, _ = doc.put('val2', rev)
-        rev31, _ = doc.put('val31', rev2)
-        rev32, _ = doc.put('val32', rev2)
+        rev3a, _ = doc.put('val3a', rev2)
+        rev3b, _ = doc.put('val3b', rev2)
 
-        self.assertTrue(rev31 < rev32)
-        self.assertEqual(doc.winner, rev32)
-        self.assertEqual(doc[rev32].value, 'val32')
-        self.assertEqual(doc[rev32].parent, rev2)
-        self.assertFalse(doc[rev32].deleted)
+        self.assertTrue(rev3a < rev3b)
+        self.assertEqual(doc.winner, rev3b)
+        self.assertEqual(doc[rev3b].value, 'val3b')
+        self.assertEqual(doc[rev3b].parent, rev2)
+        self.assertFalse(doc[rev3b].deleted)
 
     def test_get_winner(self):
         doc = Document()
@@ -212,36 +249,36 @@ class DocTest(unittest.TestCase):
         doc = Document()
         rev, _ = doc.put('val1')
         rev2, _ = doc.put('val2', rev)
-        rev31, _ = doc.put('val31', rev2)
-        rev32, _ = doc.put('val32', rev2)
+        rev3a, _ = doc.put('val3a', rev2)
+        rev3b, _ = doc.put('val3b', rev2)
 
-        self.assertEqual(doc.winner, rev32)
+        self.assertEqual(doc.winner, rev3b)
 
-        revd, _ = doc.remove(rev32)
+        revd, _ = doc.remove(rev3b)
         self.assertTrue(doc[revd].deleted)
-        self.assertEqual(doc[revd].parent, rev32)
-        self.assertEqual(doc.winner, rev31)
+        self.assertEqual(doc[revd].parent, rev3b)
+        self.assertEqual(doc.winner, rev3a)
 
     def test_remove_conflicted(self):
         doc = Document()
         rev, _ = doc.put('val1')
         rev2, _ = doc.put('val2', rev)
-        rev31, _ = doc.put('val31', rev2)
-        rev32, _ = doc.put('val32', rev2)
+        rev3a, _ = doc.put('val3a', rev2)
+        rev3b, _ = doc.put('val3b', rev2)
 
-        self.assertEqual(doc.winner, rev32)
+        self.assertEqual(doc.winner, rev3b)
 
-        revd, _ = doc.remove(rev31)
+        revd, _ = doc.remove(rev3a)
         self.assertTrue(doc[revd].deleted)
-        self.assertEqual(doc[revd].parent, rev31)
-        self.assertEqual(doc.winner, rev32)
+        self.assertEqual(doc[revd].parent, rev3a)
+        self.assertEqual(doc.winner, rev3b)
 
     def test_remove_not_leaf(self):
         doc = Document()
         rev, _ = doc.put('val1')
         rev2, _ = doc.put('val2', rev)
-        doc.put('val31', rev2)
-        doc.put('val32', rev2)
+        doc.put('val3a', rev2)
+        doc.put('val3b', rev2)
 
         with self.assertRaises(DataError):
             doc.remove(rev)
@@ -271,19 +308,178 @@ class DocTest(unittest.TestCase):
         doc = Document()
         rev, _ = doc.put('val1')
         rev2, _ = doc.put('val2', rev)
-        rev31, _ = doc.put('val31', rev2)
-        rev32, revision32 = doc.put('val32', rev2)
+        rev3a, _ = doc.put('val3a', rev2)
+        rev3b, revision3b = doc.put('val3b', rev2)
 
-        self.assertTrue(rev31 < rev32)
+        self.assertTrue(rev3a < rev3b)
 
         doc = Document()
         rev, _ = doc.put('val1')
         rev2, _ = doc.put('val2', rev)
-        rev31, _ = doc.put('val31', rev2)
-        doc.put_existing(rev32, revision32)
+        rev3a, _ = doc.put('val3a', rev2)
+        doc.put_existing(rev3b, revision3b)
+
+        self.assertEqual(doc.winner, rev3b)
+        self.assertEqual(doc[rev3b].value, 'val3b')
+
+    def test_put_existing_revs(self):
+        doc = Document()
+        rev1, _ = doc.put('val1')
+        rev2, _ = doc.put('val2', rev1)
+        rev3, revision3 = doc.put('val3', rev2)
+
+        doc2 = Document()
+        doc2.put_existing(rev1, doc[rev1])
+        doc2.put_existing(rev3, revision3, [rev3, rev2, rev1])
+
+        self.assertEqual(doc2.winner, rev3)
+        self.assertEqual(doc2.conflicts, set())
+        self.assertTrue(doc2[rev2].stub)
+        self.assertFalse(doc2[rev1].stub)
+        self.assertEqual(doc2[rev2].parent, rev1)
+
+    def test_put_existing_revs_broken(self):
+        doc = Document()
+        doc.put('val1')
+
+        with self.assertRaises(DataError):
+            doc.put_existing('2-bbb', Revision('val', False, '1-bbb'), ['2-bbb', '1-bbb'])
+
+        with self.assertRaises(DataError):
+            doc.put_existing('2-bbb', Revision('val', False, '1-bbb'), ['2-bbb', '1-ccc'])
+
+    def test_put_existing_stemmed(self):
+        doc = Document()
+        doc.put_existing('3-aaa', Revision('val3', False, '2-aaa'), ['3-aaa', '2-aaa'])
+
+        self.assertEqual(doc.winner, '3-aaa')
+        self.assertIsNone(doc['2-aaa'].parent)
+        self.assertEqual(doc['2-aaa'].generation, 2)
+        self.assertEqual(doc['3-aaa'].generation, 3)
+
+        # a stemmed root may join the tree, a true one may not
+        doc.put_existing('4-bbb', Revision('val4', False, '3-bbb'), ['4-bbb', '3-bbb'])
+        self.assertEqual(doc.winner, '4-bbb')
+        self.assertEqual(doc.conflicts, {'3-aaa'})
+
+        with self.assertRaises(DataError):
+            doc.put_existing('2-ccc', Revision('val2', False, '1-ccc'), ['2-ccc', '1-ccc'])
+
+    def test_compact(self):
+        doc = Document()
+        rev1, _ = doc.put('val1')
+        rev2, _ = doc.put('val2', rev1)
+        rev3a, _ = doc.put('val3a', rev2)
+        rev3b, _ = doc.put('val3b', rev2)
+
+        self.assertTrue(doc.compact())
+        self.assertFalse(doc.compact())
+
+        self.assertEqual(doc.conflicts, {rev3a})
+        self.assertTrue(doc[rev1].stub)
+        self.assertTrue(doc[rev2].stub)
+        self.assertIsNone(doc[rev2].value)
+        self.assertEqual(doc.get(rev3a)[1].value, 'val3a')
+        self.assertEqual(doc.get(rev3b)[1].value, 'val3b')
+        self.assertEqual(doc.revs(rev3b), [rev3b, rev2, rev1])
+
+    def test_compact_stem(self):
+        doc = Document()
+        rev = None
+        revs = []
+        for i in range(10):
+            rev, _ = doc.put(i, rev)
+            revs.append(rev)
+        rev_other, _ = doc.put('other', revs[2])
+
+        self.assertTrue(doc.compact(revs_limit=3))
+
+        self.assertEqual(doc.revs(rev), [revs[9], revs[8], revs[7]])
+        self.assertEqual(doc.revs(rev_other), [rev_other, revs[2], revs[1]])
+        self.assertEqual(len(doc), 6)
+        self.assertIsNone(doc[revs[7]].parent)
+        self.assertEqual(doc[revs[7]].generation, 8)
+        self.assertEqual(doc.winner, rev)
+
+        rev11, revision11 = doc.put('val11', rev)
+        self.assertEqual(revision11.generation, 11)
+
+    def test_revs_limit(self):
+        doc = Document()
+        rev1, _ = doc.put('val1')
+        rev2, _ = doc.put('val2', rev1)
+        rev3, _ = doc.put('val3', rev2)
+
+        self.assertEqual(doc.revs(rev3, 2), [rev3, rev2])
+        self.assertEqual(doc.revs(rev3, 5), [rev3, rev2, rev1])
 
-        self.assertEqual(doc.winner, rev32)
-        self.assertEqual(doc[rev32].value, 'val32')
+    def test_rev_ids(self):
+        doc = Document()
+        rev1, _ = doc.put('val1')
+        doc.put_existing('2-custom', Revision('val2', False, rev1))
+        doc.put_existing(u'3-\u044e', Revision('val3', False, '2-custom'))
+        rev4 = '4-' + 'A' * 32
+        doc.put_existing(rev4, Revision('val4', False, u'3-\u044e'))
+
+        self.assertEqual(list(doc), [rev1, '2-custom', u'3-\u044e', rev4])
+        self.assertEqual(doc.revs(rev4), [rev4, u'3-\u044e', '2-custom', rev1])
+        self.assertIn(unicode(rev1), doc)
+        self.assertNotIn('4-' + 'a' * 32, doc)
+        self.assertEqual(doc[rev4].generation, 4)
+
+    def test_many_revs(self):
+        doc = Document()
+        revs = []
+        rev = None
+        for i in range(20):
+            rev, _ = doc.put(i, rev)
+            revs.append(rev)
+
+        self.assertEqual(list(doc), revs)
+        self.assertEqual(list(reversed(doc)), revs[::-1])
+        self.assertEqual([r.value for r in doc.itervalues()], range(20))
+        self.assertEqual(doc[revs[10]].parent, revs[9])
+
+        del doc[revs[10]]
+        self.assertNotIn(revs[10], doc)
+        self.assertEqual(len(doc), 19)
+        self.assertIsNone(doc[revs[11]].parent)
+        self.assertEqual(doc[revs[11]].generation, 12)
+        self.assertEqual(doc.revs(rev), revs[:10:-1])
+
+    def test_setitem_unknown_parent(self):
+        doc = Document()
+        with self.assertRaises(DataError):
+            doc['2-aaa'] = Revision('val', False, '1-aaa')
+
+    def test_new_rev_canonical(self):
+        value1 = OrderedDict([('b', [1, {'y': 2, 'x': 1.5}]), ('a', u'\u044e')])
+        value2 = OrderedDict([('a', u'\u044e'), ('b', [1, {'x': 1.5, 'y': 2}])])
+
+        self.assertEqual(canonical(value1), canonical(value2))
+        self.assertEqual(canonical(value1), canonical(dict(value1)))
+        self.assertNotEqual(canonical({'a': 1}), canonical([['a', 1]]))
+        # subclasses of dict and list hash like the plain ones
+        nested = {'x': defaultdict(int, b=1, a=2), 'y': (1, [2])}
+        self.assertEqual(canonical(nested), canonical({'x': {'b': 1, 'a': 2}, 'y': [1, [2]]}))
+        self.assertEqual(canonical(defaultdict(int, b=1, a=2)), canonical({'a': 2, 'b': 1}))
+        self.assertEqual(new_rev(value1, '1-aaa'), new_rev(value2, '1-aaa'))
+        self.assertEqual(new_rev('val', None), new_rev(u'val', None))
+        self.assertNotEqual(new_rev('val', None), new_rev('val', '1-aaa'))
+        self.assertNotEqual(new_rev('1', None), new_rev(1, None))
+        # a big value is hashed in pieces, to the same digest
+        big = dict(('key%d' % i, [i, {'n': i}]) for i in range(3000))
+        self.assertEqual(new_rev(big, '1-aaa'), hashlib.md5(canonical(['1-aaa', big])).hexdigest())
+
+    @unittest.skipUnless('blake2b' in HASHERS, 'no BLAKE2')
+    def test_new_rev_blake2b(self):
+        doc = Document()
+        rev1, _ = doc.put('val1', hasher=HASHERS['blake2b'])
+        rev2, _ = doc.put('val2', rev1, hasher=HASHERS['blake2b'])
+
+        self.assertEqual(len(rev2), 34)
+        self.assertNotEqual(rev1, new_rev('val1', None, lambda: '1'))
+        self.assertEqual(doc.revs(rev2), [rev2, rev1])
 
     def test_rev_num(self):
         doc = Document()
@@ -294,17 +490,41 @@ class DocTest(unittest.TestCase):
         rev2, _ = doc.put('val2', rev1)
         self.assertEqual('2-', rev2[:2])
 
-        rev31, _ = doc.put('val31', rev2)
-        self.assertEqual('3-', rev31[:2])
-        rev32, _ = doc.put('val32', rev2)
-        self.assertEqual('3-', rev32[:2])
+        rev3a, _ = doc.put('val3a', rev2)
+        self.assertEqual('3-', rev3a[:2])
+        rev3b, _ = doc.put('val3b', rev2)
+        self.assertEqual('3-', rev3b[:2])
+
+    def test_generation(self):
+        doc = Document()
+
+        rev1, revision1 = doc.put('val1')
+        self.assertEqual(revision1.generation, 1)
+
+        rev2, revision2 = doc.put('val2', rev1)
+        self.assertEqual(revision2.generation, 2)
+
+        revd, revisiond = doc.remove(rev2)
+        self.assertEqual(revisiond.generation, 3)
+        self.assertEqual(doc[revd].generation, 3)
+
+    def test_generation_on_setitem(self):
+        doc = Document()
+
+        doc['1-aaa'] = Revision('0', False, None)
+        doc['2-aaa'] = Revision('1', False, '1-aaa')
+
+        self.assertEqual(doc['1-aaa'].generation, 1)
+        self.assertEqual(doc['2-aaa'].generation, 2)
 
 
 class DBTest(unittest.TestCase):
+    db_class = DB
+
     def setUp(self):
         super(DBTest, self).setUp()
 
-        self.db = DB(str(uuid4()))
+        self.db = self.db_class(str(uuid4()))
 
     def test_put_first(self):
         value = str(uuid4())
@@ -312,7 +532,7 @@ class DBTest(unittest.TestCase):
 
         self.assertEqual(len(self.db.storage), 1)
         self.assertEqual(res.value, value)
-        self.assertEqual(res.rev, '1-' + hashlib.md5('None' + str(value)).hexdigest())
+        self.assertEqual(res.rev, '1-' + hashlib.md5(canonical([None, value])).hexdigest())
         self.assertIsNotNone(res.uid)
 
     def test_put_first_broken_rev(self):
@@ -352,7 +572,7 @@ class DBTest(unittest.TestCase):
             self.assertEqual(len(self.db.storage), i + 1)
             self.assertEqual(len(self.db.storage[res.uid]), 1)
             self.assertEqual(res.value, value)
-            self.assertEqual(res.rev, '1-' + hashlib.md5('None' + str(value)).hexdigest())
+            self.assertEqual(res.rev, '1-' + hashlib.md5(canonical([None, value])).hexdigest())
             self.assertIsNotNone(res.uid)
 
     def test_put_bulk(self):
@@ -534,6 +754,30 @@ class DBTest(unittest.TestCase):
         with self.assertRaises(NotFoundError):
             self.db.get(res1.uid, 'wrong_rev')
 
+    def test_get_bulk(self):
+        res1 = self.db.put('val1')
+        res2 = self.db.put('val2', res1.uid, res1.rev)
+        res3 = self.db.put('val3')
+
+        results = self.db.get_bulk([
+            (res1.uid, res1.rev),
+            (res1.uid, 'wrong-rev'),
+            (res3.uid, res3.rev),
+            ('wrong-uid', res3.rev),
+            (res2.uid, res2.rev),
+        ])
+
+        self.assertEqual(results[0], res1)
+        self.assertIsInstance(results[1], NotFoundError)
+        self.assertEqual(results[2], res3)
+        self.assertIsInstance(results[3], NotFoundError)
+        self.assertEqual(results[4], res2)
+
+        results = self.db.get_bulk([(res2.uid, res2.rev)], revs=True)
+        self.assertEqual(results[0].revs, [res2.rev, res1.rev])
+
+        self.assertEqual(self.db.get_bulk([]), [])
+
     def test_remove(self):
         value = str(uuid4())
         res = self.db.put(value)
@@ -542,6 +786,12 @@ class DBTest(unittest.TestCase):
         with self.assertRaises(NotFoundError):
             res = self.db.get(res.uid)
 
+    def test_get_removed_with_rev(self):
+        res = self.db.put(str(uuid4()))
+        res = self.db.remove(res.uid, res.rev)
+
+        self.assertEqual(res, self.db.get(res.uid, res.rev))
+
     def test_remove_and_put(self):
         value = str(uuid4())
         res = self.db.put(value)
@@ -582,11 +832,10 @@ class DBTest(unittest.TestCase):
 
         changes = list(self.db.changes_get())
 
+        self.assertEqual(len(changes), 1)  # <----- superseded rev is gone
         self.assertEqual(changes[0][0], res1.uid)
-        self.assertEqual(changes[0][1], res1.rev)
-
-        self.assertEqual(changes[1][0], res1.uid)  # <----- the same UID
-        self.assertEqual(changes[1][1], res2.rev)
+        self.assertEqual(changes[0][1], res2.rev)
+        self.assertEqual(changes[0].seq, 2)
 
         changes = list(self.db.changes_get(1))
 
@@ -599,17 +848,345 @@ class DBTest(unittest.TestCase):
 
         changes = list(self.db.changes_get())
 
+        self.assertEqual(len(changes), 1)  # <----- superseded rev is gone
         self.assertEqual(changes[0][0], res1.uid)
-        self.assertEqual(changes[0][1], res1.rev)
-
-        self.assertEqual(changes[1][0], res1.uid)  # <----- the same UID
-        self.assertEqual(changes[1][1], res2.rev)
+        self.assertEqual(changes[0][1], res2.rev)
+        self.assertEqual(changes[0].seq, 2)
 
         changes = list(self.db.changes_get(1))
 
         self.assertEqual(changes[0][0], res1.uid)
         self.assertEqual(changes[0][1], res2.rev)
 
+    def test_changes_seq(self):
+        res1 = self.db.put('val1')
+        res2 = self.db.put('val2')
+        res3 = self.db.put('val3', res1.uid, res1.rev)
+
+        changes = list(self.db.changes_get())
+        self.assertEqual([c.seq for c in changes], [2, 3])
+        self.assertEqual(self.db.changes_get_seq(), 3)
+
+        changes = list(self.db.changes_get(2))
+        self.assertEqual(changes, [Change(res3.uid, res3.rev, 3)])
+
+        self.assertEqual(list(self.db.changes_get(3)), [])
+        self.assertEqual(list(self.db.changes_get(100)), [])
+
+        self.db.put_bulk([res2])
+        self.assertEqual(self.db.changes_get_seq(), 3)
+
+    def test_changes_conflicts(self):
+        res1 = self.db.put('val1')
+        res21 = self.db.put('val21', res1.uid, res1.rev)
+        res22 = self.db.put('val22', res1.uid, res1.rev)
+
+        changes = list(self.db.changes_get())
+        self.assertEqual(len(changes), 2)
+        self.assertEqual(set(c.rev for c in changes), set([res21.rev, res22.rev]))
+        self.assertEqual(set(c.seq for c in changes), set([3]))
+
+        changes = list(self.db.changes_get(style='main_only'))
+        self.assertEqual(changes, [Change(res1.uid, self.db.get(res1.uid).rev, 3)])
+
+    def _conflict(self, res, value='other'):
+        """Add a sibling of the revision `res`, give its rev."""
+        rev = '{}-{}'.format(rev_generation(res.rev), hashlib.md5(value).hexdigest())
+        self.assertEqual(self.db.put_bulk([Res(res.uid, rev, value, parent=res.parent)]), [
+            Res(res.uid, rev, value, parent=res.parent)])
+        return rev
+
+    def _put_twice(self, value, uid=None):
+        res = self.db.put(value, uid)
+        return self.db.put(value, res.uid, res.rev)
+
+    def test_conflicts_get(self):
+        res1 = self._put_twice('val1')
+        res2 = self._put_twice('val2')
+        self.assertEqual(list(self.db.conflicts_get()), [])
+
+        other1 = self._conflict(res1)
+        winner1 = self.db.get(res1.uid).rev
+        self.assertEqual(
+            list(self.db.conflicts_get()),
+            [Change(res1.uid, winner1, 5)] +
+            [Change(res1.uid, rev, 5) for rev in set([res1.rev, other1]) - set([winner1])])
+        self.assertEqual(list(self.db.conflicts_get(5)), [])
+
+        other2 = self._conflict(res2)
+        self.assertEqual([c.uid for c in self.db.conflicts_get(5)], [res2.uid, res2.uid])
+        self.assertEqual(len(self.db.conflicted), 2)
+
+        # resolved by deleting a leaf
+        self.db.remove(res1.uid, other1)
+        self.assertEqual([(c.uid, c.seq) for c in self.db.conflicts_get()], [(res2.uid, 6)] * 2)
+
+        # still conflicted after an update, listed at the new seq
+        winner2 = self.db.get(res2.uid).rev
+        res2 = self.db.put('val3', res2.uid, winner2)
+        loser2 = (set([res2.parent, other2]) - set([winner2])).pop()
+        self.assertEqual(list(self.db.conflicts_get(6)), [
+            Change(res2.uid, res2.rev, 8), Change(res2.uid, loser2, 8)])
+        self.assertEqual(len(self.db.conflicted), 1)
+
+    def test_changes_snapshot(self):
+        results = [self.db.put(i) for i in range(5)]
+        feed = self.db.changes_get()
+        self.assertEqual(next(feed).uid, results[0].uid)
+
+        self.db.put('new', results[0].uid, results[0].rev)  # listed already
+        self.db.put('new', results[3].uid, results[3].rev)  # ahead of the feed
+        self.db.put(5)  # past the snapshot
+        self.assertEqual([c.uid for c in feed], [r.uid for r in results[1:]])
+        self.assertEqual((self.db.snapshots, self.db.retired), ([], {}))
+
+        feed = self.db.changes_get(5)
+        self.assertEqual(len(list(feed)), 3)
+
+    def test_threads(self):
+        results = [self.db.put({'n': 0}) for _ in range(20)]
+        errors = []
+        writing = [True]
+
+        def write(mine):
+            try:
+                for n in range(1, 20):
+                    for i, res in enumerate(mine):
+                        mine[i] = self.db.put({'n': n}, res.uid, res.rev)
+                    self.db.put_bulk([
+                        Res(res.uid, '{}-{}'.format(n + 2, uuid4().hex), {}, parent=res.rev)
+                        for res in mine[:2]
+                    ])
+            except Exception as e:
+                errors.append(e)
+
+        def read():
+            try:
+                while writing[0]:
+                    seqs = {}
+                    for change in self.db.changes_get():
+                        self.assertEqual(seqs.setdefault(change.uid, change.seq), change.seq)
+                        self.assertIn(change.rev, self.db.storage[change.uid])
+                    self.assertEqual(len(seqs), len(results))
+                    self.assertEqual(len(list(self.db.all_docs())), len(results))
+            except Exception as e:
+                errors.append(e)
+
+        writers = [threading.Thread(target=write, args=(results[i::4],)) for i in range(4)]
+        readers = [threading.Thread(target=read) for _ in range(2)]
+        for thread in writers + readers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        writing[0] = False
+        for thread in readers:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(set(c.uid for c in self.db.changes_get()), set(r.uid for r in results))
+        self.assertEqual(self.db.changes_get_seq(), 20 + 20 * 19 + 8 * 19)
+        conflicted = set(res.uid for i in range(4) for res in results[i::4][:2])
+        for res in results:
+            if res.uid in conflicted:
+                # a branch off each update, the last one is the winner
+                self.assertEqual(len(self.db.storage[res.uid].conflicts), 18)
+            else:
+                self.assertEqual(self.db.get(res.uid).value, {'n': 19})
+
+    def test_changes_get_filtered(self):
+        res1 = self.db.put({'owner': 'bob', 'n': 1})
+        res2 = self.db.put({'owner': 'alice', 'n': 2})
+        res3 = self.db.put('val3')
+        res1 = self.db.put({'owner': 'bob', 'n': 3}, res1.uid, res1.rev)
+        res4 = self.db.remove(res2.uid, res2.rev)
+
+        def uids(filter, params=None, since=0):
+            return [c.uid for c in self.db.changes_get_filtered(since, filter=filter, params=params)]
+
+        self.assertEqual(uids('_doc_ids', {'doc_ids': [res3.uid, res2.uid]}), [res3.uid, res2.uid])
+        # the feed ends with the last seq when documents after the last one listed are left out
+        self.assertEqual(uids('_selector', {'selector': {'owner': 'bob'}}), [res1.uid, None])
+        self.assertEqual(uids('_selector', {'selector': {'_deleted': True}}), [res2.uid])
+        self.assertEqual(uids('_selector', {'selector': {'n': {'$gt': 1}}}, since=3), [res1.uid, None])
+        self.assertEqual(uids('_selector', {'selector': {'owner': 'carol'}}), [None])
+        self.assertEqual(uids('_selector', {'selector': {'owner': 'carol'}}, since=5), [])
+
+        self.db.filters['values'] = lambda result, params: result.value == params['value']
+        self.assertEqual(uids('values', {'value': 'val3'}), [res3.uid, None])
+        self.assertEqual(
+            list(self.db.changes_get_filtered(filter='values', params={'value': 'val3'}))[-1],
+            Change(None, None, 5))
+        self.assertEqual(
+            list(self.db.changes_get_filtered(filter='values', params={'value': None})),
+            [Change(res2.uid, res4.rev, 5)])
+
+        self.assertRaises(NotFoundError, uids, 'missing')
+        self.assertRaises(DataError, uids, '_doc_ids')
+        self.assertRaises(DataError, uids, '_selector', {'selector': {'n': {'$bad': 1}}})
+
+    def test_get_revs(self):
+        res1 = self.db.put('val1')
+        res2 = self.db.put('val2', res1.uid, res1.rev)
+        res3 = self.db.remove(res1.uid, res2.rev)
+
+        self.assertEqual(
+            self.db.get(res1.uid, res3.rev, revs=True).revs,
+            [res3.rev, res2.rev, res1.rev]
+        )
+        self.assertEqual(
+            self.db.get(res1.uid, res1.rev, revs=True).revs, [res1.rev])
+        self.assertIsNone(self.db.get(res1.uid, res1.rev).revs)
+
+    def test_put_bulk_revs(self):
+        source = DB(str(uuid4()))
+        res1 = source.put('val1')
+        res2 = source.put('val2', res1.uid, res1.rev)
+        res3 = source.put('val3', res1.uid, res2.rev)
+
+        self.db.put_bulk([source.get(res1.uid, revs=True)])
+
+        self.assertEqual(self.db.get(res1.uid), res3)
+        self.assertTrue(self.db.storage[res1.uid][res1.rev].stub)
+        self.assertEqual(self.db.storage[res1.uid][res2.rev].generation, 2)
+        with self.assertRaises(NotFoundError):
+            self.db.get(res1.uid, res2.rev)
+
+    def test_compact(self):
+        res1 = self.db.put('val1')
+        res2 = self.db.put('val2', res1.uid, res1.rev)
+        res3 = self.db.put('val3', res1.uid, res2.rev)
+        res4 = self.db.put('other')
+        seq = self.db.changes_get_seq()
+
+        self.db.revs_limit = 2
+        self.db.compact()
+
+        self.assertEqual(self.db.get(res1.uid), res3)
+        self.assertEqual(self.db.get(res4.uid), res4)
+        with self.assertRaises(NotFoundError):
+            self.db.get(res1.uid, res2.rev)
+        with self.assertRaises(NotFoundError):
+            self.db.get(res1.uid, res1.rev)
+        self.assertEqual(
+            self.db.get(res1.uid, revs=True).revs, [res3.rev, res2.rev])
+
+        self.assertEqual(self.db.changes_get_seq(), seq)
+        self.assertEqual(
+            list(self.db.changes_get()),
+            [Change(res1.uid, res3.rev, 3), Change(res4.uid, res4.rev, 4)]
+        )
+
+        res5 = self.db.put('val5', res1.uid, res3.rev)
+        self.assertEqual(self.db.get(res1.uid), res5)
+        self.assertEqual(res5.rev[:2], '4-')
+
+    def test_attachments(self):
+        data = '\x00\xff' * 1000
+        res1 = self.db.put({'key': 'val1', '_attachments': {
+            'a.bin': {'content_type': 'application/x-bin', 'data': data}}})
+        stub = res1.value['_attachments']['a.bin']
+        self.assertEqual(stub, {
+            'content_type': 'application/x-bin', 'digest': blob_digest(data),
+            'length': 2000, 'revpos': 1, 'stub': True,
+        })
+        self.assertEqual(self.db.get(res1.uid), res1)
+        self.assertEqual(self.db.attachment_get(res1.uid, 'a.bin'), (stub, data))
+
+        # the body is stored once, whatever the revisions referring to it
+        res = res1
+        for i in range(5):
+            value = dict(res.value, key=i)
+            res = self.db.put(value, res.uid, res.rev)
+        self.db.put({'_attachments': {'b.bin': {'data': data}}})
+        self.assertEqual(list(self.db.blobs), [blob_digest(data)])
+        self.assertEqual(self.db.get(res1.uid).value['_attachments']['a.bin'], stub)
+
+        res = self.db.attachment_put(res.uid, res.rev, 'c.txt', 'text', 'text/plain')
+        self.assertEqual(self.db.attachment_get(res.uid, 'c.txt')[0]['revpos'], 7)
+        self.assertEqual(self.db.attachment_get(res.uid, 'a.bin', res1.rev)[1], data)
+
+        res = self.db.attachment_remove(res.uid, res.rev, 'a.bin')
+        with self.assertRaises(NotFoundError):
+            self.db.attachment_get(res.uid, 'a.bin')
+        self.assertEqual(sorted(self.db.get(res.uid).value['_attachments']), ['c.txt'])
+
+    def test_attachments_missing(self):
+        stub = {'digest': blob_digest('data'), 'length': 4, 'revpos': 1, 'stub': True}
+        with self.assertRaises(DataError):
+            self.db.put({'_attachments': {'a': stub}})
+
+        results = self.db.put_bulk([Res('doc1', '1-' + 'a' * 32, {'_attachments': {'a': stub}}, parent=None)])
+        self.assertIsInstance(results[0], DataError)
+        self.assertNotIn('doc1', self.db.storage)
+
+        self.assertEqual(self.db.blobs_get_diff([stub['digest']]), [stub['digest']])
+        self.db.blobs_put({stub['digest']: 'data'})
+        self.assertEqual(self.db.blobs_get_diff([stub['digest']]), [])
+        self.assertEqual(self.db.blobs_get([stub['digest'], 'other']), {stub['digest']: 'data'})
+        with self.assertRaises(DataError):
+            self.db.blobs_put({stub['digest']: 'other'})
+
+        res = self.db.put_bulk([Res('doc1', '1-' + 'a' * 32, {'_attachments': {'a': stub}}, parent=None)])[0]
+        self.assertEqual(self.db.get('doc1'), res)
+
+    def test_all_docs(self):
+        uids = ['doc{:02}'.format(i) for i in range(20)]
+        shuffled = list(uids)
+        random.shuffle(shuffled)
+        results = dict((uid, self.db.put(uid, uid)) for uid in shuffled)
+        removed = dict((uid, self.db.remove(uid, results[uid].rev)) for uid in ('doc03', 'doc10'))
+        listed = [uid for uid in uids if uid not in ('doc03', 'doc10')]
+
+        def all_docs(**kwargs):
+            return [row.uid for row in self.db.all_docs(**kwargs)]
+
+        self.assertEqual(all_docs(), listed)
+        self.assertEqual(
+            list(self.db.all_docs(limit=1)), [DocRow('doc00', results['doc00'].rev, None)])
+        self.assertEqual(all_docs(startkey='doc02', endkey='doc05'), ['doc02', 'doc04', 'doc05'])
+        self.assertEqual(all_docs(startkey='doc02', endkey='doc05', inclusive_end=False),
+                         ['doc02', 'doc04'])
+        self.assertEqual(all_docs(startkey='doc1', limit=2), ['doc11', 'doc12'])
+        self.assertEqual(all_docs(skip=2, limit=2), ['doc02', 'doc04'])
+        self.assertEqual(all_docs(descending=True, limit=3), ['doc19', 'doc18', 'doc17'])
+        self.assertEqual(all_docs(descending=True, startkey='doc05', endkey='doc02'),
+                         ['doc05', 'doc04', 'doc02'])
+        self.assertEqual(all_docs(descending=True, startkey='doc05', endkey='doc02',
+                                  inclusive_end=False), ['doc05', 'doc04'])
+        self.assertEqual(all_docs(descending=True, skip=17), ['doc00'])
+        self.assertEqual(all_docs(startkey='doc20'), [])
+        self.assertEqual(len(self.db.ids), 18)
+
+        rows = list(self.db.all_docs(startkey='doc09', limit=2, include_docs=True))
+        self.assertEqual([row.doc for row in rows], [results['doc09'], results['doc11']])
+
+        # a document is listed again once it is put back
+        res = self.db.put('back', 'doc03', removed['doc03'].rev)
+        self.db.put_bulk([Res('doc01', '2-' + 'b' * 32, 'conflict', parent=results['doc01'].rev)])
+        self.assertEqual(all_docs(startkey='doc01', limit=3), ['doc01', 'doc02', 'doc03'])
+        rows = list(self.db.all_docs(startkey='doc01', limit=3))
+        self.assertEqual(rows[0].rev, self.db.get('doc01').rev)
+        self.assertEqual(rows[2].rev, res.rev)
+
+    def test_storage_unknown(self):
+        self.assertEqual(len(self.db.storage['missing']), 0)
+        with self.assertRaises(DataError):
+            self.db.put('val', 'missing', '1-' + 'a' * 32)
+        with self.assertRaises(NotFoundError):
+            self.db.get('missing')
+        self.assertNotIn('missing', self.db.storage)
+        self.assertEqual(len(self.db.storage), 0)
+
+    def test_compact_attachments(self):
+        res1 = self.db.put({'_attachments': {'a': {'data': 'data1'}}})
+        res2 = self.db.put({'_attachments': {'a': {'data': 'data2'}}}, res1.uid, res1.rev)
+        self.db.put({'_attachments': {'a': {'data': 'data2'}}})
+        self.assertEqual(len(self.db.blobs), 2)
+
+        self.db.compact()
+        self.assertEqual(list(self.db.blobs), [blob_digest('data2')])
+        self.assertEqual(self.db.attachment_get(res2.uid, 'a')[1], 'data2')
+
     def test_changes_grouped(self):
         res1 = self.db.put('val1')
         res2 = self.db.put('val2')
@@ -621,8 +1198,7 @@ class DBTest(unittest.TestCase):
         self.assertIn(res1.uid, grouped)
         self.assertIn(res2.uid, grouped)
 
-        self.assertIn(res1.rev, grouped[res1.uid])
-        self.assertIn(res3.rev, grouped[res1.uid])
+        self.assertEqual([res3.rev], grouped[res1.uid])
 
         self.assertIn(res2.rev, grouped[res2.uid])
 
@@ -648,6 +1224,17 @@ class DBTest(unittest.TestCase):
 
         self.assertEqual(expected, self.db.changes_get_diff(grouped))
 
+    def test_hasher(self):
+        self.assertIs(self.db.hasher, hashlib.md5)
+        with self.assertRaises(ValueError):
+            self.db_class(str(uuid4()), hasher='crc32')
+
+        for name, hasher in HASHERS.items():
+            db = self.db_class(str(uuid4()), hasher=name)
+            res = db.put('val')
+            self.assertEqual(res.rev, new_rev('val', None, lambda: '1', hasher))
+            self.assertEqual(db.remove(res.uid, res.rev).rev, new_rev(None, res.rev, lambda: '2', hasher))
+
     def test_seq(self):
         self.assertEqual(self.db.changes_get_size(), 0)
 
@@ -655,7 +1242,34 @@ class DBTest(unittest.TestCase):
         self.db.put('val2')
         self.db.put('val3', res1.uid, res1.rev)
 
-        self.assertEqual(self.db.changes_get_size(), 3)
+        self.assertEqual(self.db.changes_get_size(), 2)
+
+    def test_changes_subscribe(self):
+        calls = []
+
+        def callback(uid, seq):
+            calls.append((uid, seq))
+
+        self.db.changes_subscribe(callback)
+        res1 = self.db.put('val1')
+        res2 = self.db.put('val2', res1.uid, res1.rev)
+        self.db.changes_unsubscribe(callback)
+        self.db.put('val3')
+
+        self.assertEqual(calls, [(res1.uid, 1), (res2.uid, 2)])
+
+        # unsubscribed during a notification, the others are still called
+        def once(uid, seq):
+            calls.append(('once', seq))
+            self.db.changes_unsubscribe(once)
+
+        del calls[:]
+        self.db.changes_subscribe(once)
+        self.db.changes_subscribe(callback)
+        res4 = self.db.put('val4')
+        self.db.put('val5', res4.uid, res4.rev)
+        self.db.changes_unsubscribe(callback)
+        self.assertEqual(calls, [('once', 4), (res4.uid, 4), (res4.uid, 5)])
 
     def test_local_put(self):
         r = random.randint(1, 1000)
@@ -674,11 +1288,15 @@ class DBTest(unittest.TestCase):
 
 
 class ReplTest(unittest.TestCase):
+    db_class = DB
+    repl_class = Repl
+    put_bulk_error = IOError
+
     def setUp(self):
         super(ReplTest, self).setUp()
-        self.source = DB(str(uuid4()))
-        self.target = DB(str(uuid4()))
-        self.repl = Repl(self.source, self.target)
+        self.source = self.db_class(str(uuid4()))
+        self.target = self.db_class(str(uuid4()))
+        self.repl = self.repl_class(self.source, self.target)
 
     def test_uid(self):
         source = DB(str(uuid4()))
@@ -696,7 +1314,7 @@ class ReplTest(unittest.TestCase):
 
         diff_docs = list(self.repl.get_diff_docs(d))
 
-        self.assertEqual([s_res1], diff_docs)
+        self.assertEqual([s_res1._replace(revs=[s_res1.rev])], diff_docs)
 
     def test_get_diff_docs_two(self):
         s_res1 = self.source.put('val1')
@@ -709,8 +1327,8 @@ class ReplTest(unittest.TestCase):
 
         diff_docs = list(self.repl.get_diff_docs(d))
 
-        self.assertIn(s_res1, diff_docs)
-        self.assertIn(s_res2, diff_docs)
+        self.assertIn(s_res1._replace(revs=[s_res1.rev]), diff_docs)
+        self.assertIn(s_res2._replace(revs=[s_res2.rev]), diff_docs)
         self.assertEqual(2, len(diff_docs))
 
     def test_get_diff_docs_empty(self):
@@ -737,6 +1355,133 @@ class ReplTest(unittest.TestCase):
         self.assertEqual(self.source.storage, self.target.storage)
         self.assertEqual(self.target.get(s_res1.uid), s_res1)
 
+    def test_replicate_checkpoint(self):
+        self._change_db(self.source, 10)
+        self.repl.replicate()
+        self.assertEqual(
+            self.target.local_get(self.repl.uid),
+            self.source.changes_get_seq()
+        )
+
+        self.repl.replicate()
+        self.assertEqual(
+            self.target.local_get(self.repl.uid),
+            self.source.changes_get_seq()
+        )
+
+    def test_replicate_batches(self):
+        self._change_db(self.source, 35)
+        repl = self.repl_class(self.source, self.target, batch_size=10)
+
+        batches = list(repl.get_batches(self.source.changes_get()))
+        self.assertEqual([len(b) for b in batches], [10, 10, 10, 5])
+
+        calls = []
+        put_bulk = self.target.put_bulk
+
+        def broken_put_bulk(results):
+            if len(calls) == 2:
+                raise IOError
+            calls.append(None)
+            return put_bulk(results)
+
+        self.target.put_bulk = broken_put_bulk
+        with self.assertRaises(self.put_bulk_error):
+            repl.replicate()
+
+        self.assertEqual(self.target.local_get(repl.uid), batches[1][-1].seq)
+        self.assertEqual(len(self.target.storage), 20)
+
+        self.target.put_bulk = put_bulk
+        repl.replicate()
+
+        self._assert_db_equal(self.source, self.target)
+
+    def test_replicate_compacted_blobs(self):
+        self.source.put({'_attachments': {'a': {'data': 'body'}}})
+        put_bulk = self.repl.target.put_bulk
+        compacted = []
+
+        def compacting_put_bulk(results):
+            if not compacted:
+                # the body copied for the batch is dropped before it is used
+                compacted.append(self.target.compact())
+            return put_bulk(results)
+
+        self.repl.target.put_bulk = compacting_put_bulk
+        self.repl.replicate()
+        self.assertEqual(compacted, [None])
+        self.assertEqual(self.repl.doc_write_failures, 0)
+        self._assert_db_equal(self.source, self.target)
+
+    def test_replicate_write_failures(self):
+        self.source.put({'x': 1}, 'doc')
+        self.target.put({'x': 2}, 'doc')
+        res = self.source.put('val', 'other')
+
+        # a second root of `doc` is refused, the rest goes on
+        self.repl.replicate()
+        self.assertEqual(self.repl.doc_write_failures, 1)
+        self.assertEqual(self.target.get('other'), res)
+        self.assertEqual(self.target.local_get(self.repl.uid), self.source.changes_get_seq())
+
+        self.repl.replicate()
+        self.assertEqual(self.repl.doc_write_failures, 1)
+
+    def test_replicate_batches_same_seq(self):
+        res = self.source.put('val')
+        for i in range(5):
+            self.source.put(i, res.uid, res.rev)
+        self.source.put('val2')
+
+        repl = self.repl_class(self.source, self.target, batch_size=2)
+        batches = list(repl.get_batches(self.source.changes_get()))
+        self.assertEqual([len(b) for b in batches], [5, 1])
+
+    def test_replicate_continuous(self):
+        self._change_db(self.source, 10)
+        self.repl.start(max_delay=0.01)
+        try:
+            self._wait(lambda: len(self.target.storage) == 10)
+
+            res = self.source.put('val')
+            self._wait(lambda: res.uid in self.target.storage)
+
+            res = self.source.put('val2', res.uid, res.rev)
+            self._wait(lambda: self.target.get(res.uid) == res)
+        finally:
+            self.repl.stop()
+
+        self._assert_db_equal(self.source, self.target)
+        self._wait(lambda: not self.source.subscribers)
+
+        self.source.put('val')
+        time.sleep(0.05)
+        self.assertEqual(len(self.target.storage), 11)
+
+    def test_replicate_continuous_errors(self):
+        self._change_db(self.source, 10)
+        put_bulk = self.repl.target.put_bulk
+        errors = []
+
+        def failing_put_bulk(results):
+            if len(errors) < 2:
+                errors.append(IOError('disk full'))
+                raise errors[-1]
+            return put_bulk(results)
+
+        self.repl.target.put_bulk = failing_put_bulk
+        self.repl.start(max_delay=0.01, backoff=0.01)
+        try:
+            # retried until it succeeds, then it goes on
+            self._wait(lambda: len(self.target.storage) == 10)
+            self.assertEqual(len(errors), 2)
+            res = self.source.put('val')
+            self._wait(lambda: res.uid in self.target.storage)
+            self.assertIsNone(self.repl.error)
+        finally:
+            self.repl.stop()
+
     def test_replicate_several(self):
         res = self.source.put(str(uuid4()))
         rev = res.rev
@@ -749,7 +1494,158 @@ class ReplTest(unittest.TestCase):
 
         self.repl.replicate()
 
+        self._assert_tree_equal(self.source, self.target)
+        self.assertEqual(self.target.get(uid), res)
+
+        # only the leaf body is transferred
+        self.assertEqual(
+            sum(1 for r in self.target.storage[uid].itervalues() if not r.stub), 1)
+
+    def test_replicate_stemmed(self):
+        res = self.source.put('val1')
+        for i in range(5):
+            res = self.source.put(i, res.uid, res.rev)
+        self.repl.replicate()
+
+        self.source.revs_limit = 3
+        self.source.compact()
+        for i in range(2):
+            res = self.source.put(i, res.uid, res.rev)
+        self.repl.replicate()
+
+        self.assertEqual(self.target.get(res.uid), res)
+        self.assertEqual(self.target.storage[res.uid].conflicts, set())
+        self.assertEqual(len(self.target.storage[res.uid]), 8)
+
+        # the target compacts on its own
+        self.target.revs_limit = 2
+        self.target.compact()
+        res = self.source.put('val9', res.uid, res.rev)
+        self.repl.replicate()
+        self.assertEqual(self.target.get(res.uid), res)
+        self.assertEqual(self.target.storage[res.uid].conflicts, set())
+        self.assertEqual(len(self.target.storage[res.uid].revs(res.rev)), 3)
+
+    def test_replicate_stemmed_behind(self):
+        res1 = self.source.put('val1')
+        self.repl.replicate()
+
+        res = res1
+        for i in range(5):
+            res = self.source.put(i, res.uid, res.rev)
+        self.source.revs_limit = 3
+        self.source.compact()
+        self.repl.replicate()
+
+        # the target lags more than `revs_limit` behind, like in CouchDB
+        # its old leaf can't be linked and stays as a conflict
+        self.assertEqual(self.target.get(res.uid), res)
+        self.assertEqual(self.target.storage[res.uid].conflicts, {res1.rev})
+        self.assertEqual(
+            self.target.get(res.uid, revs=True).revs, self.source.get(res.uid, revs=True).revs)
+
+    def test_replicate_attachments(self):
+        data = 'x' * 10000
+        res = self.source.put({'_attachments': {'a': {'data': data}}})
+        self.source.put({'_attachments': {'b': {'data': data}}})
+
+        copied = []
+        blobs_put = self.target.blobs_put
+
+        def counting_blobs_put(blobs):
+            copied.extend(blobs)
+            return blobs_put(blobs)
+
+        self.target.blobs_put = counting_blobs_put
+        self.repl.replicate()
+        self.assertEqual(copied, [blob_digest(data)])
+        self.assertEqual(self.target.attachment_get(res.uid, 'a')[1], data)
+
+        # unchanged attachments are not copied again
+        for i in range(3):
+            res = self.source.put(dict(res.value, key=i), res.uid, res.rev)
+        self.repl.replicate()
+        self.assertEqual(copied, [blob_digest(data)])
+        self.assertEqual(self.target.get(res.uid), res)
+
+        res = self.source.attachment_put(res.uid, res.rev, 'c', 'other')
+        self.repl.replicate()
+        self.assertEqual(copied, [blob_digest(data), blob_digest('other')])
+        self.assertEqual(self.target.attachment_get(res.uid, 'c')[1], 'other')
+
+    def test_replicate_filtered(self):
+        bob = [self.source.put({'owner': 'bob', 'n': i}) for i in range(3)]
+        for i in range(3):
+            self.source.put({'owner': 'alice', 'n': i})
+
+        diffed = []
+        changes_get_diff = self.target.changes_get_diff
+
+        def recording_changes_get_diff(grouped):
+            diffed.extend(grouped)
+            return changes_get_diff(grouped)
+
+        self.target.changes_get_diff = recording_changes_get_diff
+        repl = self.repl_class(
+            self.source, self.target, filter='_selector', params={'selector': {'owner': 'bob'}})
+        self.assertNotEqual(repl.uid, self.repl.uid)
+        repl.replicate()
+        self.assertEqual(sorted(diffed), sorted(res.uid for res in bob))
+        self.assertEqual(sorted(self.target.storage), sorted(res.uid for res in bob))
+
+        # filtered replications keep their own checkpoints
+        self.source.filters['even'] = lambda result, params: result.value['n'] % params['by'] == 0
+        repl = self.repl_class(self.source, self.target, filter='even', params={'by': 2})
+        self.assertNotEqual(
+            repl.uid, self.repl_class(self.source, self.target, filter='even', params={'by': 3}).uid)
+        repl.replicate()
+        self.assertEqual(len(self.target.storage), 5)
+
+        self.repl.replicate()
+        self.assertEqual(len(self.target.storage), 6)
+
+    def test_replicate_filtered_checkpoint(self):
+        for owner in ['alice'] * 5 + ['bob'] + ['alice'] * 5:
+            self.source.put({'owner': owner})
+        filtered = []
+        self.source.filters['owner'] = lambda result, params: (
+            filtered.append(result.uid) or result.value['owner'] == params['owner'])
+
+        repl = self.repl_class(self.source, self.target, filter='owner', params={'owner': 'bob'})
+        repl.replicate()
+        self.assertEqual(len(self.target.storage), 1)
+        self.assertEqual(len(filtered), 11)
+        # the documents left out after bob are not filtered again
+        self.assertEqual(self.target.local_get(repl.uid), 11)
+        repl.replicate()
+        self.assertEqual(len(filtered), 11)
+
+    def test_replicate_remove(self):
+        res = self.source.put('val1')
+        self.repl.replicate()
+
+        self.source.remove(res.uid, res.rev)
+        self.repl.replicate()
+
         self.assertEqual(self.source.storage, self.target.storage)
+        with self.assertRaises(NotFoundError):
+            self.target.get(res.uid)
+
+    def test_replicate_conflicts(self):
+        res = self.source.put('val1')
+        self.repl.replicate()
+
+        self.source.put('val21', res.uid, res.rev)
+        self.target.put('val22', res.uid, res.rev)
+        self.repl.replicate()
+        self.repl_class(self.target, self.source).replicate()
+
+        self.assertEqual(self.source.get(res.uid), self.target.get(res.uid))
+        self.assertEqual(
+            self.source.storage[res.uid].conflicts,
+            self.target.storage[res.uid].conflicts
+        )
+        self.assertEqual(len(self.target.storage[res.uid].conflicts), 1)
 
     def test_replicate_sequence(self):
         self._change_db(self.source, 1000)
@@ -770,7 +1666,7 @@ class ReplTest(unittest.TestCase):
         self.assertEqual(len(self.source.storage), 3000)
 
     def test_replicate_bidirect(self):
-        rrepl = Repl(self.target, self.source)
+        rrepl = self.repl_class(self.target, self.source)
         n = 100
         c = 50
         for i in range(10):
@@ -782,6 +1678,23 @@ class ReplTest(unittest.TestCase):
 
             self._assert_db_equal(self.source, self.target)
 
+    def _wait(self, predicate, timeout=5):
+        deadline = time.time() + timeout
+        while not predicate():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.001)
+
+    def _assert_tree_equal(self, db1, db2):
+        def tree(db, uid):
+            return set(
+                (rev, r.parent, r.deleted, r.generation)
+                for rev, r in db.storage[uid].iteritems()
+            )
+
+        self.assertEqual(len(db1.storage), len(db2.storage))
+        for k in db1.storage.iterkeys():
+            self.assertEqual(tree(db1, k), tree(db2, k))
+
     def _assert_db_equal(self, db1, db2):
         self.assertEqual(len(db1.storage), len(db2.storage))
         for k in db1.storage.iterkeys():
@@ -797,5 +1710,1360 @@ class ReplTest(unittest.TestCase):
             db.put(str(uuid4()), res.uid, res.rev)
 
 
+class PipelinedReplTest(ReplTest):
+    repl_class = PipelinedRepl
+
+    def test_replicate_slow_steps(self):
+        self._change_db(self.source, 100)
+        repl = PipelinedRepl(self.source, self.target, batch_size=10)
+
+        get_bulk, put_bulk = self.source.get_bulk, self.target.put_bulk
+        writing, fetched = threading.Event(), threading.Event()
+        overlaps = []
+
+        def watched_get_bulk(*args, **kwargs):
+            if writing.is_set():
+                fetched.set()
+            return get_bulk(*args, **kwargs)
+
+        def slow_put_bulk(results):
+            # the next batch is fetched while this one is being written
+            writing.set()
+            overlaps.append(fetched.wait(5))
+            return put_bulk(results)
+
+        self.source.get_bulk = watched_get_bulk
+        self.target.put_bulk = slow_put_bulk
+        repl.replicate()
+
+        self._assert_db_equal(self.source, self.target)
+        self.assertTrue(overlaps[0])
+
+
+class FanoutReplTest(unittest.TestCase):
+    db_class = DB
+
+    def setUp(self):
+        super(FanoutReplTest, self).setUp()
+        self.source = self.db_class(str(uuid4()))
+        self.targets = [self.db_class(str(uuid4())) for _ in range(3)]
+        self.calls = defaultdict(int)
+
+        for name in ('changes_get', 'get_bulk', 'blobs_get'):
+            self._count(self.source, name)
+
+    def _count(self, db, name):
+        func = getattr(db, name)
+
+        def counting(*args, **kwargs):
+            self.calls[name] += 1
+            return func(*args, **kwargs)
+
+        setattr(db, name, counting)
+
+    def _assert_replicated(self, *targets):
+        for target in targets or self.targets:
+            self.assertEqual(sorted(target.storage), sorted(self.source.storage))
+            for uid in self.source.storage:
+                self.assertEqual(target.get(uid), self.source.get(uid))
+
+    def test_replicate(self):
+        data = 'x' * 1000
+        for i in range(25):
+            self.source.put({'n': i, '_attachments': {'a': {'data': data}}})
+        repl = FanoutRepl(self.source, self.targets, batch_size=10)
+        repl.replicate()
+        self._assert_replicated()
+
+        # read and fetched once per batch for all the targets
+        self.assertEqual(self.calls, {'changes_get': 1, 'get_bulk': 3, 'blobs_get': 1})
+        for target in self.targets:
+            self.assertEqual(target.local_get(Repl(self.source, target).uid), 25)
+
+        self.calls.clear()
+        repl.replicate()
+        self.assertEqual(self.calls, {'changes_get': 1})
+
+    def test_replicate_filtered_checkpoint(self):
+        for i in range(6):
+            self.source.put({'n': i})
+        fanout = FanoutRepl(self.source, self.targets, filter='_selector',
+                            params={'selector': {'n': {'$lt': 2}}})
+        fanout.replicate()
+        for repl in fanout.repls:
+            self.assertEqual(len(repl.target.storage), 2)
+            self.assertEqual(repl.target.local_get(repl.uid), 6)
+
+    def test_replicate_checkpoints(self):
+        res = self.source.put('val1')
+        Repl(self.source, self.targets[0]).replicate()
+        self.source.put('val2', res.uid, res.rev)
+        for i in range(5):
+            self.source.put(i)
+        Repl(self.source, self.targets[1]).replicate()
+
+        diffed = []
+        for target in self.targets:
+            changes_get_diff = target.changes_get_diff
+            target.changes_get_diff = lambda grouped, target=target, func=changes_get_diff: (
+                diffed.append((target.name, sorted(grouped))) or func(grouped))
+
+        FanoutRepl(self.source, self.targets).replicate()
+        self._assert_replicated()
+        # each target is only asked about the changes past its checkpoint
+        self.assertEqual(sorted(diffed), sorted([
+            (self.targets[0].name, sorted(self.source.storage)),
+            (self.targets[2].name, sorted(self.source.storage)),
+        ]))
+
+    def test_replicate_target_error(self):
+        for i in range(20):
+            self.source.put(i)
+
+        failing = self.targets[1]
+        put_bulk = failing.put_bulk
+
+        def failing_put_bulk(results):
+            if len(failing.storage) >= 10:
+                raise IOError('disk full')
+            return put_bulk(results)
+
+        failing.put_bulk = failing_put_bulk
+        repl = FanoutRepl(self.source, self.targets, batch_size=10)
+        self.assertRaises(IOError, repl.replicate)
+        self._assert_replicated(self.targets[0], self.targets[2])
+        self.assertEqual(len(failing.storage), 10)
+
+        failing.put_bulk = put_bulk
+        repl.replicate()
+        self._assert_replicated()
+
+    def test_replicate_write_failures(self):
+        self.source.put({'x': 1}, 'doc')
+        self.targets[1].put({'x': 2}, 'doc')
+        res = self.source.put('val', 'other')
+
+        repl = FanoutRepl(self.source, self.targets)
+        repl.replicate()
+        self.assertEqual([r.doc_write_failures for r in repl.repls], [0, 1, 0])
+        for target, r in zip(self.targets, repl.repls):
+            self.assertEqual(target.get('other'), res)
+            self.assertEqual(target.local_get(r.uid), self.source.changes_get_seq())
+
+    def test_replicate_continuous(self):
+        repl = FanoutRepl(self.source, self.targets)
+        repl.start(max_delay=0.01)
+        try:
+            res = self.source.put('val')
+            deadline = time.time() + 5
+            while not all(res.uid in target.storage for target in self.targets):
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.001)
+        finally:
+            repl.stop()
+        self._assert_replicated()
+
+
+class RemoteReplTest(ReplTest):
+    """Replicate from and to databases served over HTTP."""
+    put_bulk_error = RemoteError
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), {})
+        self.server.start()
+        self.remotes = []
+        super(RemoteReplTest, self).setUp()
+
+    def tearDown(self):
+        for remote in self.remotes:
+            remote.close()
+        self.server.stop()
+        super(RemoteReplTest, self).tearDown()
+
+    def repl_class(self, source, target, **kwargs):
+        return Repl(self._remote(source), self._remote(target), **kwargs)
+
+    def _remote(self, db):
+        self.server.dbs[db.name] = db
+        remote = RemoteDB(self.server.url + '/' + db.name, retries=1, backoff=0.001)
+        self.remotes.append(remote)
+        return remote
+
+
+class RemoteDBTest(unittest.TestCase):
+    def setUp(self):
+        self.db = DB('db')
+        self.server = Server(('127.0.0.1', 0), {'db': self.db})
+        self.server.start()
+        self.remote = RemoteDB(self.server.url + '/db', backoff=0.001)
+
+    def tearDown(self):
+        self.remote.close()
+        self.server.stop()
+
+    def test_document(self):
+        res1 = self.remote.put({'key': 'val1'}, 'doc1')
+        self.assertEqual(self.db.get('doc1'), res1)
+        res2 = self.remote.put({'key': 'val2'}, 'doc1', res1.rev)
+        self.assertEqual(self.remote.get('doc1'), res2)
+        self.assertEqual(self.remote.get('doc1', revs=True).revs, [res2.rev, res1.rev])
+
+        with self.assertRaises(DataError):
+            self.remote.put({'key': 'val3'}, 'doc1', res1.rev)
+
+        self.remote.remove('doc1', res2.rev)
+        with self.assertRaises(NotFoundError):
+            self.remote.get('doc1')
+
+    def test_get_bulk_pipelined(self):
+        results = [self.db.put(i) for i in range(250)]
+        self.remote.pipeline_depth = 16
+        self.remote.bulk_get = False
+        pairs = [(r.uid, r.rev) for r in results] + [('missing', None)]
+
+        got = self.remote.get_bulk(pairs)
+        self.assertEqual(got[:-1], results)
+        self.assertIsInstance(got[-1], NotFoundError)
+        # a single connection was used
+        self.assertEqual(len(self.remote.pool), 1)
+
+    def test_get_bulk(self):
+        results = [self.db.put(i) for i in range(25)]
+        results.append(self.db.put('val', results[0].uid, results[0].rev))
+        self.remote.chunk_size = 10
+        pairs = [(r.uid, r.rev) for r in results] + [('missing', None)]
+
+        got = self.remote.get_bulk(pairs, revs=True)
+        self.assertTrue(self.remote.bulk_get)
+        self.assertEqual(got[:-1], self.db.get_bulk(pairs[:-1], revs=True))
+        self.assertIsInstance(got[-1], NotFoundError)
+        self.assertEqual(self.remote.get_bulk(pairs[:2]), results[:2])
+
+    def test_get_bulk_fallback(self):
+        results = [self.db.put(i) for i in range(5)]
+        pairs = [(r.uid, r.rev) for r in results]
+
+        def bulk_get(handler, db):
+            raise HTTPError(404, 'not_found', 'missing')
+
+        original, Handler.bulk_get = Handler.bulk_get, bulk_get
+        try:
+            self.assertEqual(self.remote.get_bulk(pairs), results)
+            self.assertIs(self.remote.bulk_get, False)
+        finally:
+            Handler.bulk_get = original
+        self.assertEqual(self.remote.get_bulk(pairs), results)
+
+    def test_put_bulk_gzip(self):
+        value = 'x' * 10000
+        results = [Result(str(i), '1-' + 'a' * 32, value, False, None) for i in range(5)]
+        results.append(Result('bad', None, value, False, None))
+
+        res = self.remote.put_bulk(results)
+        self.assertEqual(res[:-1], results[:-1])
+        self.assertIsInstance(res[-1], DataError)
+        self.assertEqual(self.db.get('0').value, value)
+        self.assertEqual(self.remote.get('0').value, value)
+
+    def test_changes(self):
+        results = [self.db.put(i) for i in range(5)]
+        self.remote.chunk_size = 2
+        self.assertEqual(
+            [(c.uid, c.rev) for c in self.remote.changes_get()],
+            [(r.uid, r.rev) for r in results]
+        )
+        self.assertEqual(self.remote.changes_get_seq(), 5)
+        self.assertEqual(self.remote.changes_get_size(), 5)
+        self.assertEqual(
+            self.remote.changes_get_diff({results[0].uid: [results[0].rev, 'x']}),
+            {results[0].uid: ['x']}
+        )
+
+        calls = []
+        callback = lambda uid, seq: calls.append((uid, seq))
+        self.remote.changes_subscribe(callback)
+        try:
+            res = self.db.put('val')
+            deadline = time.time() + 5
+            while not calls:
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.001)
+            self.assertEqual(calls, [(res.uid, 6)])
+        finally:
+            self.remote.changes_unsubscribe(callback)
+
+    def test_local(self):
+        self.assertEqual(self.remote.local_get('repl'), 0)
+        self.remote.local_put('repl', 10)
+        self.assertEqual(self.remote.local_get('repl'), 10)
+        self.assertEqual(self.db.local_get('repl'), 10)
+
+    def test_retry(self):
+        self.remote.put('val', 'doc1')
+        # the pooled connection is dropped, the request goes over a new one
+        self.remote.pool[0].sock.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(self.remote.get('doc1').value, 'val')
+
+        port = self.server.server_address[1]
+        self.server.stop()
+        remote = RemoteDB('http://127.0.0.1:{}/db'.format(port), retries=2, backoff=0.001)
+        with self.assertRaises(RemoteError):
+            remote.get('doc1')
+
+
+class FileTestMixin(object):
+    """Run tests against databases kept in a temporary directory."""
+    engine = None
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dbs = []
+        super(FileTestMixin, self).setUp()
+
+    def tearDown(self):
+        super(FileTestMixin, self).tearDown()
+        for db in self.dbs:
+            db.close()
+        shutil.rmtree(self.tmp)
+
+    def db_class(self, name, **kwargs):
+        db = self.engine(name, os.path.join(self.tmp, name), **kwargs)
+        self.dbs.append(db)
+        return db
+
+
+class SqliteDBTest(FileTestMixin, DBTest):
+    engine = SqliteDB
+
+    def test_wal(self):
+        mode = self.db.conn.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(mode, 'wal')
+
+    def test_all_docs_chunks(self):
+        for i in range(10):
+            self.db.put(i, 'doc{}'.format(i))
+        self.db.ids.chunk_size = 3
+        self.assertEqual(
+            [row.uid for row in self.db.all_docs(skip=1, limit=7)],
+            ['doc{}'.format(i) for i in range(1, 8)])
+        self.assertEqual(
+            [row.uid for row in self.db.all_docs(startkey='doc8', descending=True)],
+            ['doc{}'.format(i) for i in range(8, -1, -1)])
+
+    def test_reopen(self):
+        res1 = self.db.put('val1')
+        res2 = self.db.put('val2', res1.uid, res1.rev)
+        res3 = self.db.put({'key': [1, 2]})
+        self.db.local_put('checkpoint', 10)
+        self.db.close()
+
+        db = self.db_class(self.db.name)
+        self.assertEqual(db.get(res1.uid), res2)
+        self.assertEqual(db.get(res3.uid), res3)
+        self.assertEqual(db.get(res1.uid, res1.rev), res1)
+        self.assertEqual(db.local_get('checkpoint'), 10)
+        self.assertEqual(db.changes_get_seq(), 3)
+        self.assertEqual(
+            list(db.changes_get()),
+            [Change(res1.uid, res2.rev, 2), Change(res3.uid, res3.rev, 3)]
+        )
+
+        res4 = db.put('val4', res1.uid, res2.rev)
+        self.assertEqual(db.changes_get_seq(), 4)
+        self.assertEqual(db.get(res1.uid), res4)
+
+    def test_cache(self):
+        db = self.db_class(self.db.name, cache_size=1)
+
+        res1 = db.put('val1')
+        res2 = db.put('val2')
+        res3 = db.put('val3', res1.uid, res1.rev)
+        self.assertEqual(len(db.storage.cache), 1)
+        self.assertEqual(db.get(res1.uid), res3)
+        self.assertEqual(db.get(res2.uid), res2)
+
+    def test_put_bulk_rollback(self):
+        res = self.db.put('val1')
+
+        def broken_changes_put(uid):
+            raise IOError
+
+        self.db.changes_put = broken_changes_put
+        with self.assertRaises(IOError):
+            self.db.put_bulk([Res(
+                uid=res.uid, value='val2', rev='2-aaa', parent=res.rev)])
+
+        self.assertEqual(self.db.get(res.uid), res)
+        with self.assertRaises(NotFoundError):
+            self.db.get(res.uid, '2-aaa')
+
+
+class SqliteReplTest(FileTestMixin, ReplTest):
+    engine = SqliteDB
+
+
+class LogDBTest(FileTestMixin, DBTest):
+    engine = LogDB
+
+    def test_reopen(self):
+        res1 = self.db.put('val1')
+        res2 = self.db.put('val2', res1.uid, res1.rev)
+        res3 = self.db.put({'key': [1, 2]})
+        self.db.local_put('checkpoint', 10)
+        self.db.close()
+
+        db = self.db_class(self.db.name)
+        self.assertEqual(db.get(res1.uid), res2)
+        self.assertEqual(db.get(res3.uid), res3)
+        self.assertEqual(db.get(res1.uid, res1.rev), res1)
+        self.assertEqual(db.local_get('checkpoint'), 10)
+        self.assertEqual(db.changes_get_seq(), 3)
+        self.assertEqual(
+            list(db.changes_get()),
+            [Change(res1.uid, res2.rev, 2), Change(res3.uid, res3.rev, 3)]
+        )
+
+        res4 = db.put('val4', res1.uid, res2.rev)
+        self.assertEqual(db.changes_get_seq(), 4)
+        self.assertEqual(db.get(res1.uid), res4)
+
+    def test_conflicts_reopen(self):
+        results = [self._put_twice(i, 'doc{}'.format(i)) for i in range(3)]
+        self.db.remove('doc0', self._conflict(results[0]))
+        self._conflict(results[2])
+        self.db.close()
+
+        self.db = self.db_class(self.db.name)
+        self.assertEqual([c.uid for c in self.db.conflicts_get()], ['doc2', 'doc2'])
+        self._conflict(results[1])
+        self.assertEqual([c.uid for c in self.db.conflicts_get(9)], ['doc1', 'doc1'])
+        self.assertEqual(len(self.db.conflicted), 2)
+
+    def test_all_docs_reopen(self):
+        results = [self.db.put(i, 'doc{}'.format(i)) for i in range(5)]
+        self.db.remove('doc1', results[1].rev)
+        self.db.close()
+
+        self.db = self.db_class(self.db.name)
+        self.assertEqual([row.uid for row in self.db.all_docs()], ['doc0', 'doc2', 'doc3', 'doc4'])
+        self.db.remove('doc2', results[2].rev)
+        self.db.put(5, 'doc5')
+        self.assertEqual([row.uid for row in self.db.all_docs(startkey='doc2')], ['doc3', 'doc4', 'doc5'])
+
+    def test_docs_reopen(self):
+        results = [self._put_twice(i, 'doc{}'.format(i)) for i in range(5)]
+        self.db.remove('doc1', results[1].rev)
+        self._conflict(results[3])
+        self.db.close()
+        reads = []
+
+        class CountingLogDB(LogDB):
+            def read(self, offset):
+                reads.append(offset)
+                return super(CountingLogDB, self).read(offset)
+
+        # the saved indexes are read back, not the document states
+        db = CountingLogDB(self.db.name, self.db.path)
+        self.dbs.append(db)
+        self.assertEqual([row.uid for row in db.all_docs()], ['doc0', 'doc2', 'doc3', 'doc4'])
+        self.assertEqual(reads, [])
+        self.assertEqual([c.uid for c in db.conflicts_get()], ['doc3', 'doc3'])
+
+    def test_docs_behind(self):
+        results = [self._put_twice(i, 'doc{}'.format(i)) for i in range(3)]
+        self.db.close()
+        shutil.copy(self.db.path + '.docs', self.db.path + '.docs.bak')
+
+        self.db = self.db_class(self.db.name)
+        self.db.remove('doc0', results[0].rev)
+        self._conflict(results[1])
+        self.db.put(3, 'doc3')
+        self.db.close()
+        os.rename(self.db.path + '.docs.bak', self.db.path + '.docs')
+
+        # the document states logged after the saved indexes are replayed
+        self.db = self.db_class(self.db.name)
+        self.assertEqual([row.uid for row in self.db.all_docs()], ['doc1', 'doc2', 'doc3'])
+        self.assertEqual([c.uid for c in self.db.conflicts_get()], ['doc1', 'doc1'])
+
+        self.db.close()
+        with open(self.db.path + '.docs', 'wb') as f:
+            f.write('{"s":')
+        self.db = self.db_class(self.db.name)
+        self.assertEqual([row.uid for row in self.db.all_docs()], ['doc1', 'doc2', 'doc3'])
+        self.assertEqual([c.uid for c in self.db.conflicts_get()], ['doc1', 'doc1'])
+
+    def test_lazy_bodies(self):
+        res = self.db.put('val1')
+        self.db.close()
+
+        db = self.db_class(self.db.name)
+        self.assertIsInstance(db.storage[res.uid][res.rev].value, Body)
+        self.assertEqual(db.get(res.uid).value, 'val1')
+
+    def test_torn_tail(self):
+        res1 = self.db.put('val1')
+        size = self.db.size
+        res2 = self.db.put('val2', res1.uid, res1.rev)
+        self.db.close()
+
+        with open(self.db.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.db.path) - 3)
+
+        db = self.db_class(self.db.name)
+        # the records before the torn one are kept, but not indexed
+        self.assertLess(size, db.size)
+        self.assertEqual(os.path.getsize(self.db.path), db.size)
+        self.assertEqual(db.get(res1.uid), res1)
+        self.assertEqual(db.changes_get_seq(), 1)
+
+        self.assertEqual(db.put('val2', res1.uid, res1.rev), res2)
+        self.assertEqual(db.changes_get_seq(), 2)
+
+    def test_index_behind(self):
+        res1 = self.db.put('val1')
+        self.db.close()
+        shutil.copy(self.db.path + '.idx', self.db.path + '.idx.bak')
+        shutil.copy(self.db.path + '.seq', self.db.path + '.seq.bak')
+
+        db = self.db_class(self.db.name)
+        res2 = db.put('val2', res1.uid, res1.rev)
+        res3 = db.put('val3')
+        db.close()
+        os.rename(self.db.path + '.idx.bak', self.db.path + '.idx')
+        os.rename(self.db.path + '.seq.bak', self.db.path + '.seq')
+
+        db = self.db_class(self.db.name)
+        self.assertEqual(db.get(res1.uid), res2)
+        self.assertEqual(db.get(res3.uid), res3)
+        self.assertEqual(db.changes_get_size(), 2)
+        self.assertEqual(db.changes_get_seq(), 3)
+
+    def test_index_lost(self):
+        for i in range(1000):
+            self.db.put(i, str(i))
+        res = self.db.put('val', '1', self.db.get('1').rev)
+        self.db.local_put('checkpoint', 10)
+        self.db.close()
+        os.remove(self.db.path + '.idx')
+
+        db = self.db_class(self.db.name)
+        self.assertEqual(len(db.storage), 1000)
+        self.assertEqual(db.get('1'), res)
+        self.assertEqual(db.get('999').value, 999)
+        self.assertEqual(db.local_get('checkpoint'), 10)
+        self.assertEqual(db.changes_get_seq(), 1001)
+
+
+class LogReplTest(FileTestMixin, ReplTest):
+    engine = LogDB
+
+
+
+class ViewTest(unittest.TestCase):
+    db_class = DB
+
+    def setUp(self):
+        super(ViewTest, self).setUp()
+        self.db = self.db_class(str(uuid4()))
+        self.mapped = []
+
+    def _by_type(self, result):
+        self.mapped.append(result.uid)
+        if isinstance(result.value, dict) and 'type' in result.value:
+            yield result.value['type'], result.value.get('n', 0)
+
+    def _put(self, uid, type, n=0):
+        return self.db.put({'type': type, 'n': n}, uid)
+
+    def test_collate(self):
+        keys = [None, False, True, -1, 0, 1.5, 2, 'A', 'a', u'b', [], [1], [1, 'a'], ['a'], {}, {'a': 1}]
+        shuffled = list(keys)
+        random.shuffle(shuffled)
+        self.assertEqual(sorted(shuffled, key=collate), keys)
+
+    def test_query(self):
+        for i, type in enumerate(['b', 'a', 'c', 'b', None, 'd']):
+            self._put('doc{}'.format(i), type, i)
+        view = View(self.db, 'by_type', self._by_type)
+
+        def keys(**kwargs):
+            return [(row.key, row.uid) for row in view.query(**kwargs)]
+
+        self.assertEqual(keys(), [
+            (None, 'doc4'), ('a', 'doc1'), ('b', 'doc0'), ('b', 'doc3'), ('c', 'doc2'), ('d', 'doc5')])
+        self.assertEqual(view.query(key='b'), [Row('b', 0, 'doc0'), Row('b', 3, 'doc3')])
+        self.assertEqual(view.query(key='x'), [])
+        self.assertEqual(keys(key=None), [(None, 'doc4')])
+
+        self.assertEqual(keys(startkey='b', endkey='c'), [('b', 'doc0'), ('b', 'doc3'), ('c', 'doc2')])
+        self.assertEqual(keys(startkey='b', endkey='c', inclusive_end=False), [('b', 'doc0'), ('b', 'doc3')])
+        self.assertEqual(keys(startkey='b', startkey_docid='doc1', endkey='c', endkey_docid='doc1'),
+                         [('b', 'doc3')])
+        self.assertEqual(keys(startkey='bb'), [('c', 'doc2'), ('d', 'doc5')])
+        self.assertEqual(keys(endkey='a'), [(None, 'doc4'), ('a', 'doc1')])
+        self.assertEqual(keys(startkey='c', endkey='b'), [])
+
+        self.assertEqual(keys(descending=True, startkey='c', endkey='b'),
+                         [('c', 'doc2'), ('b', 'doc3'), ('b', 'doc0')])
+        self.assertEqual(keys(descending=True, startkey='c', endkey='b', inclusive_end=False),
+                         [('c', 'doc2')])
+        self.assertEqual(keys(descending=True, skip=1, limit=2), [('c', 'doc2'), ('b', 'doc3')])
+        self.assertEqual(keys(skip=2, limit=2), [('b', 'doc0'), ('b', 'doc3')])
+        self.assertEqual(keys(skip=10), [])
+
+    def test_update(self):
+        for i in range(10):
+            self._put('doc{}'.format(i), 'a', i)
+        view = View(self.db, 'by_type', self._by_type)
+        self.assertEqual(len(view.query()), 10)
+        self.assertEqual(len(self.mapped), 10)
+
+        # only the changed documents are mapped again
+        self.mapped = []
+        res = self.db.get('doc1')
+        self.db.put({'type': 'b'}, 'doc1', res.rev)
+        self.db.remove('doc2', self.db.get('doc2').rev)
+        self._put('doc10', 'c')
+        self.assertEqual(len(view.query(key='a', stale=True)), 10)
+        self.assertEqual([r.uid for r in view.query(key='b')], ['doc1'])
+        self.assertEqual(sorted(self.mapped), ['doc1', 'doc10'])
+        self.assertEqual(len(view.query(key='a')), 8)
+        self.assertEqual(self.db.local_get(view.uid), self.db.changes_get_seq())
+
+        # the index is picked up from `local`
+        self.mapped = []
+        view = View(self.db, 'by_type', self._by_type)
+        self.assertEqual(len(view.query()), 10)
+        self.assertEqual(self.mapped, [])
+
+    def test_reduce(self):
+        for i, type in enumerate(['a', 'b', 'a', 'c']):
+            self._put('doc{}'.format(i), type, i)
+        view = View(self.db, 'by_type', self._by_type, '_sum')
+
+        self.assertEqual(view.query(), [Row(None, 6, None)])
+        self.assertEqual(view.query(startkey='b'), [Row(None, 4, None)])
+        self.assertEqual(view.query(key='x'), [])
+        self.assertEqual(view.query(group=True), [Row('a', 2, None), Row('b', 1, None), Row('c', 3, None)])
+        self.assertEqual(view.query(group=True, descending=True, limit=1), [Row('c', 3, None)])
+        self.assertEqual(len(view.query(reduce=False)), 4)
+
+        view = View(self.db, 'stats', self._by_type, '_stats')
+        self.assertEqual(view.query(key='a')[0].value, {'sum': 2, 'count': 2, 'min': 0, 'max': 2, 'sumsqr': 4})
+
+        def by_path(result):
+            yield result.value['type'].split('/'), 1
+
+        self.db.put({'type': 'x/y'})
+        self.db.put({'type': 'x/z'})
+        self.db.put({'type': 'x/z'})
+        view = View(self.db, 'by_path', by_path, lambda keys, values: len(keys))
+        self.assertEqual(view.query(startkey=['x'], group_level=1), [Row(['x'], 3, None)])
+        self.assertEqual(view.query(startkey=['x'], group_level=2),
+                         [Row(['x', 'y'], 1, None), Row(['x', 'z'], 2, None)])
+
+
+class LogViewTest(FileTestMixin, ViewTest):
+    engine = LogDB
+
+    def test_reopen(self):
+        for i in range(5):
+            self._put('doc{}'.format(i), 'a', i)
+        view = View(self.db, 'by_type', self._by_type, '_count')
+        self.assertEqual(view.query(), [Row(None, 5, None)])
+
+        self.db.close()
+        self.db = self.db_class(self.db.name)
+        self._put('doc5', 'b')
+        self.mapped = []
+        view = View(self.db, 'by_type', self._by_type, '_count')
+        self.assertEqual(view.query(group=True), [Row('a', 5, None), Row('b', 1, None)])
+        self.assertEqual(self.mapped, ['doc5'])
+
+
+class SqliteViewTest(LogViewTest):
+    engine = SqliteDB
+
+
+class SortedListTest(unittest.TestCase):
+    def test_sorted_list(self):
+        rand = random.Random(1)
+        items = [rand.randrange(100) for _ in range(50)]
+        sorted_list = SortedList(items, block_size=4)
+        items.sort()
+
+        for _ in range(2000):
+            if items and rand.random() < 0.45:
+                item = rand.choice(items)
+                items.remove(item)
+                sorted_list.remove(item)
+            else:
+                item = rand.randrange(100)
+                bisect.insort(items, item)
+                sorted_list.add(item)
+
+            self.assertEqual(len(sorted_list), len(items))
+            item = rand.randrange(-1, 101)
+            self.assertEqual(sorted_list.bisect_left(item), bisect.bisect_left(items, item))
+            self.assertEqual(sorted_list.bisect_right(item), bisect.bisect_right(items, item))
+            start = rand.randrange(-5, len(items) + 5)
+            stop = rand.randrange(-5, len(items) + 5)
+            self.assertEqual(sorted_list[start:stop], items[start:stop])
+            if items:
+                index = rand.randrange(-len(items), len(items))
+                self.assertEqual(sorted_list[index], items[index])
+
+        self.assertEqual(list(sorted_list), items)
+        self.assertEqual(sorted_list[::-2], items[::-2])
+        self.assertRaises(ValueError, sorted_list.remove, 100)
+        self.assertRaises(IndexError, lambda: sorted_list[len(items)])
+
+        for item in rand.sample(items, len(items)):
+            sorted_list.remove(item)
+        self.assertEqual((len(sorted_list), list(sorted_list), sorted_list[0:5]), (0, [], []))
+        sorted_list.add(1)
+        self.assertEqual(list(sorted_list), [1])
+
+
+class ShardedDBTest(unittest.TestCase):
+    processes = False
+
+    def setUp(self):
+        super(ShardedDBTest, self).setUp()
+        self.db = ShardedDB(str(uuid4()), 3, processes=self.processes)
+
+    def tearDown(self):
+        self.db.close()
+        super(ShardedDBTest, self).tearDown()
+
+    def test_shard_of(self):
+        uids = [str(i) for i in range(300)]
+        self.assertEqual([shard_of(uid, 3) for uid in uids], [shard_of(uid, 3) for uid in uids])
+        self.assertEqual(shard_of(u'\u00e9', 3), shard_of(u'\u00e9'.encode('utf-8'), 3))
+        counts = defaultdict(int)
+        for uid in uids:
+            counts[shard_of(uid, 3)] += 1
+        self.assertEqual(sorted(counts), [0, 1, 2])
+        self.assertGreater(min(counts.values()), 50)
+
+    def test_put_get(self):
+        res1 = self.db.put('val1')
+        res2 = self.db.put('val2', res1.uid, res1.rev)
+        self.assertEqual(self.db.get(res1.uid), res2)
+        self.assertEqual(self.db.get(res1.uid, res1.rev, revs=True).revs, [res1.rev])
+
+        res3 = self.db.remove(res1.uid, res2.rev)
+        self.assertRaises(NotFoundError, self.db.get, res1.uid)
+        self.assertTrue(self.db.get(res1.uid, res3.rev).deleted)
+        self.assertRaises(DataError, self.db.put, 'val', 'missing', res1.rev)
+
+
+    def test_conflicts_get(self):
+        uids = [str(i) for i in range(10)]
+        for uid in uids:
+            res = self.db.put('val', uid)
+            res = self.db.put('val2', uid, res.rev)
+            rev = '2-' + hashlib.md5(uid).hexdigest()
+            other = Res(uid, rev, 'other', parent=res.parent)
+            self.assertEqual(self.db.put_bulk([other]), [other])
+        self.db.put('val', 'clean')
+
+        conflicts = list(self.db.conflicts_get())
+        self.assertEqual(sorted(set(c.uid for c in conflicts)), uids)
+        self.assertEqual(len(conflicts), 20)
+        self.assertEqual(list(self.db.conflicts_get(conflicts[-1].seq)), [])
+
+    def test_bulk(self):
+        results = [Res(str(i), '1-{}'.format(i), i, parent=None) for i in range(20)]
+        results.append(Res('0', '2-a', 'x', parent='1-b'))
+        res = self.db.put_bulk(results)
+        self.assertEqual(res[:20], results[:20])
+        self.assertIsInstance(res[20], DataError)
+
+        pairs = [(str(i), '1-{}'.format(i)) for i in range(19, -1, -1)] + [('x', '1-x')]
+        res = self.db.get_bulk(pairs)
+        self.assertEqual([r.value for r in res[:20]], range(19, -1, -1))
+        self.assertIsInstance(res[20], NotFoundError)
+
+        self.assertEqual(dict(self.db.changes_get_diff({'0': ['1-0', '1-x'], 'y': ['1-y']})),
+                         {'0': ['1-x'], 'y': ['1-y']})
+        self.assertEqual(self.db.changes_get_size(), 20)
+        self.assertEqual(sum(self.db.changes_get_seq()), 20)
+
+    def test_changes(self):
+        results = [self.db.put({'n': i}) for i in range(10)]
+        changes = list(self.db.changes_get(chunk_size=2))
+        self.assertEqual(sorted(c.uid for c in changes), sorted(r.uid for r in results))
+        self.assertEqual(changes[-1].seq, self.db.changes_get_seq())
+        self.assertEqual([c.seq for c in changes], sorted(c.seq for c in changes))
+
+        # resumed from any seq, the feed gives the rest of it
+        def revs(changes):
+            return sorted((c.uid, c.rev) for c in changes)
+
+        for i, change in enumerate(changes):
+            self.assertEqual(revs(self.db.changes_get(change.seq, chunk_size=3)), revs(changes[i + 1:]))
+
+        res = self.db.put('new', results[0].uid, results[0].rev)
+        self.assertEqual([(c.uid, c.rev) for c in self.db.changes_get(changes[-1].seq)],
+                         [(res.uid, res.rev)])
+        self.assertRaises(DataError, list, self.db.changes_get([1, 2]))
+
+        changes = list(self.db.changes_get_filtered(
+            filter='_selector', params={'selector': {'n': {'$gte': 1, '$lt': 3}}}))
+        self.assertEqual(sorted(c.uid for c in changes if c.uid is not None),
+                         sorted([results[1].uid, results[2].uid]))
+        self.assertEqual(changes[-1].seq, self.db.changes_get_seq())
+        self.assertEqual(
+            sorted(c.uid for c in self.db.changes_get_filtered(
+                filter='_doc_ids', params={'doc_ids': [results[1].uid, results[2].uid]})
+                   if c.uid is not None),
+            sorted([results[1].uid, results[2].uid]))
+
+    def test_all_docs(self):
+        uids = sorted(self.db.put(i, 'doc{:02}'.format(i)).uid for i in range(20))
+        self.assertEqual([row.uid for row in self.db.all_docs()], uids)
+        self.assertEqual([row.uid for row in self.db.all_docs('doc05', limit=3, skip=1)], uids[6:9])
+        rows = list(self.db.all_docs(descending=True, limit=2, include_docs=True))
+        self.assertEqual([row.doc.value for row in rows], [19, 18])
+
+    def test_replicate(self):
+        source = DB(str(uuid4()))
+        data = 'x' * 100
+        for i in range(30):
+            source.put({'n': i, '_attachments': {'a': {'data': data}}})
+        Repl(source, self.db, batch_size=7).replicate()
+        self.assertEqual(self.db.changes_get_size(), 30)
+        self.assertEqual(self.db.blobs_get_diff([blob_digest(data)]), [])
+
+        target = DB(str(uuid4()))
+        repl = Repl(self.db, target, batch_size=7)
+        repl.replicate()
+        self.assertEqual(sorted(target.storage), sorted(source.storage))
+        self.assertEqual(target.local_get(repl.uid), self.db.changes_get_seq())
+
+        # resumed from the checkpoint
+        res = self.db.put('new')
+        changes_get = self.db.changes_get
+        since = []
+        self.db.changes_get = lambda seq, *args: since.append(seq) or changes_get(seq, *args)
+        repl.replicate()
+        self.assertEqual(target.get(res.uid), res)
+        self.assertEqual(len(since), 1)
+        self.assertEqual(len(list(changes_get(since[0]))), 1)
+
+    def test_fanout_checkpoints(self):
+        uids = [[], [], []]
+        for i in range(30):
+            uid = 'doc{}'.format(i)
+            uids[self.db.shard_of(uid)].append(uid)
+        for uid in uids[0][:8] + uids[1][:2]:
+            self.db.put('val', uid)
+
+        targets = [DB(str(uuid4())) for _ in range(2)]
+        Repl(self.db, targets[0]).replicate()
+        checkpoint = targets[0].local_get(Repl(self.db, targets[0]).uid)
+        self.assertEqual(checkpoint, [8, 2, 0])
+        for uid in uids[1][2:4]:
+            self.db.put('val', uid)
+
+        # ahead of the other target on shard 0, behind on shard 1
+        self.assertEqual(self.db.seq_min([checkpoint, 0]), [0, 0, 0])
+        self.assertEqual(self.db.seq_min([checkpoint, [4, 4, 0]]), [4, 2, 0])
+        self.assertFalse(self.db.change_newer(Change(uids[0][0], None, [5, 0, 0]), checkpoint))
+        self.assertTrue(self.db.change_newer(Change(uids[1][0], None, [4, 3, 0]), checkpoint))
+
+        # pages of 2 changes, the shard 1 changes come before shard 0 is done
+        changes_get = self.db.changes_get
+        self.db.changes_get = lambda since=0, style='all_docs': changes_get(
+            since, style, chunk_size=2)
+        FanoutRepl(self.db, targets).replicate()
+        for target in targets:
+            self.assertEqual(sorted(target.storage), sorted(uids[0][:8] + uids[1][:4]))
+
+    def test_replicate_continuous(self):
+        target = DB(str(uuid4()))
+        repl = Repl(self.db, target)
+        repl.start(max_delay=0.01)
+        try:
+            res = self.db.put('val')
+            deadline = time.time() + 5
+            while res.uid not in target.storage:
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.001)
+        finally:
+            repl.stop()
+        self.assertFalse(self.db.subscribers)
+
+
+class ShardedDBProcessTest(ShardedDBTest):
+    processes = True
+
+    def test_sqlite_shards(self):
+        path = tempfile.mkdtemp()
+        try:
+            db = ShardedDB(os.path.join(path, 'db'), 2, db_class=SqliteDB)
+            res = db.put('val', 'doc')
+            db.close()
+
+            db = ShardedDB(os.path.join(path, 'db'), 2, db_class=SqliteDB)
+            self.assertEqual(db.get('doc'), res)
+            db.close()
+        finally:
+            shutil.rmtree(path)
+
+
+class SelectorTest(unittest.TestCase):
+    doc = {
+        '_id': 'doc',
+        'name': 'bob',
+        'age': 42,
+        'admin': False,
+        'tags': ['a', 'b'],
+        'address': {'city': 'Paris', 'zip': '75001'},
+        'scores': [{'n': 1}, {'n': 5}],
+    }
+
+    def assertMatches(self, selector, matches=True):
+        self.assertEqual(compile_selector(selector)(self.doc), matches, selector)
+
+    def test_fields(self):
+        self.assertMatches({'name': 'bob'})
+        self.assertMatches({'name': u'bob', 'age': 42})
+        self.assertMatches({'name': 'bob', 'age': 41}, False)
+        self.assertMatches({'address.city': 'Paris'})
+        self.assertMatches({'address': {'city': 'Paris', 'zip': '75001'}})
+        # an object holds conditions of sub-fields, like in Mango
+        self.assertMatches({'address': {'city': 'Paris'}})
+        self.assertMatches({'address': {'city': {'$regex': '^P'}, 'zip': {'$gt': '7'}}})
+        self.assertMatches({'address': {'city': 'Lyon'}}, False)
+        self.assertMatches({'name': {'first': 'bob'}}, False)
+        self.assertMatches({'address': {'$eq': {'city': 'Paris'}}}, False)
+        self.assertMatches({'address': {'$eq': {'city': 'Paris', 'zip': '75001'}}})
+        self.assertMatches({'address.city.name': 'Paris'}, False)
+        self.assertMatches({'admin': 0}, False)
+        self.assertMatches({'missing': None}, False)
+
+    def test_operators(self):
+        self.assertMatches({'age': {'$gt': 40, '$lte': 42}})
+        self.assertMatches({'age': {'$lt': 42}}, False)
+        self.assertMatches({'age': {'$gte': 'a'}}, False)
+        self.assertMatches({'name': {'$ne': 'alice'}})
+        self.assertMatches({'missing': {'$ne': 'alice'}}, False)
+        self.assertMatches({'name': {'$in': ['alice', 'bob']}})
+        self.assertMatches({'name': {'$nin': ['alice', 'bob']}}, False)
+        self.assertMatches({'tags': {'$all': ['b', 'a']}})
+        self.assertMatches({'tags': {'$all': ['a', 'c']}}, False)
+        self.assertMatches({'tags': {'$size': 2}})
+        self.assertMatches({'scores': {'$elemMatch': {'n': {'$gt': 4}}}})
+        self.assertMatches({'tags': {'$elemMatch': {'$eq': 'c'}}}, False)
+        self.assertMatches({'name': {'$regex': '^b.b$'}})
+        self.assertMatches({'age': {'$regex': '4'}}, False)
+        self.assertMatches({'address.zip': {'$exists': True}, 'phone': {'$exists': False}})
+        self.assertMatches({'age': {'$not': {'$gt': 50}}})
+
+    def test_combinations(self):
+        self.assertMatches({'$or': [{'name': 'alice'}, {'age': 42}]})
+        self.assertMatches({'$and': [{'name': 'bob'}, {'age': 41}]}, False)
+        self.assertMatches({'$nor': [{'name': 'alice'}, {'age': 41}]})
+        self.assertMatches({'$not': {'name': 'bob'}}, False)
+        self.assertMatches({})
+
+    def test_invalid(self):
+        for selector in [
+            [], {'$or': {}}, {'$where': 1}, {'age': {'$gt': 1, '$bad': 2}},
+            {'name': {'$regex': '('}}, {'age': {'$in': 1}}, {'age': {'$eq': object()}},
+        ]:
+            self.assertRaises(DataError, compile_selector, selector)
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.db = DB('db')
+        self.server = Server(('127.0.0.1', 0), {'db': self.db})
+        self.server.start()
+        self.conn = httplib.HTTPConnection(*self.server.server_address[:2])
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.stop()
+
+    def _request(self, method, path, body=None, conn=None):
+        conn = conn or self.conn
+        conn.request(method, path, json.dumps(body) if body is not None else None)
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+
+    def test_root(self):
+        status, body = self._request('GET', '/')
+        self.assertEqual(status, 200)
+        self.assertEqual(body['couchdb'], 'Welcome')
+
+        self.assertEqual(self._request('GET', '/nodb')[0], 404)
+
+    def test_db_info(self):
+        self.db.put('val')
+        status, body = self._request('GET', '/db')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, {'db_name': 'db', 'doc_count': 1, 'update_seq': 1})
+
+    def test_document(self):
+        status, body = self._request('PUT', '/db/doc1', {'key': 'val1'})
+        self.assertEqual(status, 201)
+        rev1 = body['rev']
+        self.assertEqual(self.db.get('doc1').value, {'key': 'val1'})
+
+        # the connection is kept alive
+        status, body = self._request('GET', '/db/doc1')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, {'_id': 'doc1', '_rev': rev1, 'key': 'val1'})
+
+        status, body = self._request('PUT', '/db/doc1', {'_rev': rev1, 'key': 'val2'})
+        self.assertEqual(status, 201)
+        rev2 = body['rev']
+
+        status, body = self._request('GET', '/db/doc1?revs=true&rev=' + rev2)
+        self.assertEqual(body['_revisions'], {'start': 2, 'ids': [rev2[2:], rev1[2:]]})
+
+        status, body = self._request('DELETE', '/db/doc1?rev=' + rev2)
+        self.assertEqual(status, 200)
+        self.assertEqual(self._request('GET', '/db/doc1')[0], 404)
+
+        status, body = self._request('GET', '/db/doc1?rev=' + body['rev'])
+        self.assertEqual(status, 200)
+        self.assertTrue(body['_deleted'])
+
+        # a deleted document can be created again
+        self.assertEqual(self._request('PUT', '/db/doc1', {'key': 'val3'})[0], 201)
+        self.assertEqual(self.db.get('doc1').value, {'key': 'val3'})
+
+    def test_document_errors(self):
+        rev1 = self._request('PUT', '/db/doc1', {'key': 'val1'})[1]['rev']
+        self._request('PUT', '/db/doc1', {'_rev': rev1, 'key': 'val2'})
+
+        status, body = self._request('PUT', '/db/doc1', {'_rev': rev1, 'key': 'val3'})
+        self.assertEqual((status, body['error']), (409, 'conflict'))
+        self.assertEqual(self._request('PUT', '/db/doc1', {'key': 'val3'})[0], 409)
+        self.assertEqual(self._request('PUT', '/db/doc2', {'_rev': rev1})[0], 409)
+        self.assertEqual(self._request('DELETE', '/db/doc1?rev=' + rev1)[0], 409)
+        self.assertEqual(self._request('DELETE', '/db/doc2?rev=' + rev1)[0], 404)
+        self.assertEqual(self._request('PUT', '/db/doc2', [1])[0], 400)
+        self.assertEqual(self._request('GET', '/db/doc1?rev=1-x')[0], 404)
+        self.assertEqual(self._request('POST', '/db')[0], 405)
+
+    def test_document_conflicts(self):
+        res = self.db.put('val1', 'doc1')
+        res2a = self.db.put('val2a', 'doc1', res.rev)
+        res2b = self.db.put('val2b', 'doc1', res.rev)
+        winner = self.db.storage['doc1'].winner
+        loser = res2a.rev if winner == res2b.rev else res2b.rev
+
+        # a losing leaf is updated or removed like the winner
+        status, body = self._request('PUT', '/db/doc1', {'_rev': loser, 'key': 'val3'})
+        self.assertEqual(status, 201)
+        loser = body['rev']
+        self.assertEqual(self.db.get('doc1', loser).value, {'key': 'val3'})
+
+        # the conflict is resolved by removing the losing leaf
+        status, body = self._request('DELETE', '/db/doc1?rev=' + loser)
+        self.assertEqual(status, 200)
+        self.assertEqual(self.db.storage['doc1'].open_conflicts, set())
+        self.assertEqual(self.db.get('doc1').rev, winner)
+
+        self.assertEqual(self._request('DELETE', '/db/doc1?rev=' + body['rev'])[0], 409)
+        self.assertEqual(self._request('DELETE', '/db/doc1?rev=' + loser)[0], 409)
+        self.assertEqual(self._request('PUT', '/db/doc1', {'_rev': res.rev})[0], 409)
+        self.assertEqual(self._request('PUT', '/db/doc1', {'_rev': '9-x'})[0], 409)
+
+    def test_document_concurrent(self):
+        rev = self._request('PUT', '/db/doc1', {'key': 'val1'})[1]['rev']
+        put = self.db.put
+
+        def slow_put(*args):
+            time.sleep(0.02)
+            return put(*args)
+
+        self.db.put = slow_put
+        for path in ('/db/doc1?rev={}', '/db/doc1/att?rev={}'):
+            statuses = []
+
+            def client():
+                conn = httplib.HTTPConnection(*self.server.server_address[:2])
+                statuses.append(self._request('PUT', path.format(rev), {'key': 'val2'}, conn)[0])
+                conn.close()
+
+            threads = [threading.Thread(target=client) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            # one update of the rev wins, like in CouchDB
+            self.assertEqual(sorted(statuses), [201, 409, 409, 409, 409])
+            self.assertEqual(self.db.get('doc1', revs=True).revs[1], rev)
+            self.assertFalse(self.db.storage['doc1'].conflicts)
+            rev = self.db.get('doc1').rev
+
+    def test_document_value(self):
+        res = self.db.put([1, 2])
+        status, body = self._request('GET', '/db/' + res.uid)
+        self.assertEqual(body, {'_id': res.uid, '_rev': res.rev, '_value': [1, 2]})
+
+        self._request('PUT', '/db/doc', {'_value': 'val'})
+        self.assertEqual(self.db.get('doc').value, 'val')
+
+    def test_bulk_docs(self):
+        source = DB('source')
+        res1 = source.put('val1')
+        res2 = source.put('val2', res1.uid, res1.rev)
+        res3 = source.put({'key': 'val'})
+        docs = [result_to_json(source.get(res.uid, revs=True)) for res in (res2, res3)]
+        docs.append({'_id': 'bad', '_rev': '2-aaa', '_revisions': {'start': 2, 'ids': ['aaa', 'bbb']}})
+        self.db.put('other', 'bad')
+
+        status, body = self._request('POST', '/db/_bulk_docs', {'docs': docs, 'new_edits': False})
+        self.assertEqual(status, 201)
+        self.assertEqual([error['id'] for error in body], ['bad'])
+        self.assertEqual(self.db.get(res1.uid), res2)
+        self.assertEqual(self.db.get(res3.uid).value, {'key': 'val'})
+        self.assertTrue(self.db.storage[res1.uid][res1.rev].stub)
+
+        status, body = self._request('POST', '/db/_bulk_docs', {'docs': [
+            {'_id': res1.uid, '_rev': res2.rev, 'key': 'new'},
+            {'_id': res1.uid, '_rev': res1.rev},
+            {'key': 'created'},
+        ]})
+        self.assertEqual(status, 201)
+        self.assertTrue(body[0]['ok'])
+        self.assertEqual(body[1]['error'], 'conflict')
+        self.assertEqual(self.db.get(body[2]['id']).value, {'key': 'created'})
+
+    def test_revs_diff(self):
+        res = self.db.put('val')
+        status, body = self._request('POST', '/db/_revs_diff', {
+            res.uid: [res.rev, '2-aaa'],
+            'other': ['1-bbb'],
+        })
+        self.assertEqual(status, 200)
+        self.assertEqual(body, {res.uid: {'missing': ['2-aaa']}, 'other': {'missing': ['1-bbb']}})
+
+    def test_bulk_get(self):
+        res1 = self.db.put({'key': 'val1'}, 'doc1')
+        res2 = self.db.put({'key': 'val2'}, 'doc1', res1.rev)
+        body = {'docs': [
+            {'id': 'doc1', 'rev': res1.rev},
+            {'id': 'doc1'},
+            {'id': 'doc2'},
+        ]}
+
+        status, body = self._request('POST', '/db/_bulk_get?revs=true', body)
+        self.assertEqual(status, 200)
+        results = body['results']
+        self.assertEqual([r['id'] for r in results], ['doc1', 'doc2'])
+        self.assertEqual(results[0]['docs'], [
+            {'ok': result_to_json(self.db.get('doc1', res1.rev, revs=True))},
+            {'ok': result_to_json(self.db.get('doc1', revs=True))},
+        ])
+        self.assertEqual(results[0]['docs'][1]['ok']['_revisions']['start'], 2)
+        self.assertEqual(results[1]['docs'][0]['error']['error'], 'not_found')
+
+        # each revision on a line of its own
+        self.conn.request('POST', '/db/_bulk_get', json.dumps({'docs': [{'id': 'doc1'}]}),
+                          {'Accept': 'application/x-ndjson'})
+        response = self.conn.getresponse()
+        self.assertEqual(response.getheader('content-type'), 'application/x-ndjson')
+        self.assertEqual(
+            [json.loads(line) for line in response.read().splitlines()],
+            [{'ok': result_to_json(res2)}]
+        )
+
+        self.assertEqual(self._request('POST', '/db/_bulk_get', {'docs': [{}]})[0], 400)
+
+    def test_all_docs(self):
+        results = [self.db.put({'n': i}, 'doc{}'.format(i)) for i in range(5)]
+        self.db.remove('doc1', results[1].rev)
+
+        status, body = self._request('GET', '/db/_all_docs')
+        self.assertEqual(status, 200)
+        self.assertEqual(body['total_rows'], 4)
+        self.assertEqual(body['rows'][0], {'id': 'doc0', 'key': 'doc0', 'value': {'rev': results[0].rev}})
+        self.assertEqual([row['id'] for row in body['rows']], ['doc0', 'doc2', 'doc3', 'doc4'])
+
+        body = self._request(
+            'GET', '/db/_all_docs?startkey="doc3"&endkey="doc0"&descending=true&limit=2&include_docs=true')[1]
+        self.assertEqual([row['id'] for row in body['rows']], ['doc3', 'doc2'])
+        self.assertEqual(body['rows'][0]['doc'], {'_id': 'doc3', '_rev': results[3].rev, 'n': 3})
+
+        body = self._request('GET', '/db/_all_docs?key="doc2"')[1]
+        self.assertEqual([row['id'] for row in body['rows']], ['doc2'])
+        self.assertEqual(self._request('GET', '/db/_all_docs?startkey=doc2')[0], 400)
+
+    def test_attachment(self):
+        self.conn.request('PUT', '/db/doc1/a.txt', 'text', {'Content-Type': 'text/plain'})
+        response = self.conn.getresponse()
+        self.assertEqual(response.status, 201)
+        rev1 = json.loads(response.read())['rev']
+
+        self.conn.request('GET', '/db/doc1/a.txt')
+        response = self.conn.getresponse()
+        self.assertEqual(response.getheader('content-type'), 'text/plain')
+        self.assertEqual(response.read(), 'text')
+
+        status, body = self._request('GET', '/db/doc1')
+        self.assertEqual(body['_attachments'], {'a.txt': {
+            'content_type': 'text/plain', 'digest': blob_digest('text'),
+            'length': 4, 'revpos': 1, 'stub': True,
+        }})
+
+        # inline base64 bodies, like CouchDB
+        body['_attachments']['b.bin'] = {'data': base64.b64encode('\x00\x01')}
+        status, body = self._request('PUT', '/db/doc1', body)
+        self.assertEqual(status, 201)
+        self.assertEqual(self.db.attachment_get('doc1', 'b.bin')[1], '\x00\x01')
+
+        self.assertEqual(self._request('PUT', '/db/doc1/c?rev=' + rev1, {})[0], 409)
+        status, body = self._request('DELETE', '/db/doc1/a.txt?rev=' + body['rev'])
+        self.assertEqual(status, 200)
+        self.assertEqual(self._request('GET', '/db/doc1/a.txt')[0], 404)
+
+        digest = blob_digest('blob')
+        self.assertEqual(
+            self._request('POST', '/db/_blobs_diff', {'digests': [digest]})[1], {'missing': [digest]})
+        self.assertEqual(
+            self._request('POST', '/db/_blobs', {'blobs': {digest: base64.b64encode('blob')}})[0], 201)
+        self.assertEqual(
+            self._request('POST', '/db/_blobs_get', {'digests': [digest]})[1],
+            {'blobs': {digest: base64.b64encode('blob')}})
+
+    def test_changes(self):
+        res1 = self.db.put('val1')
+        res2 = self.db.put('val2')
+        self.db.put('val2', res1.uid, res1.rev)
+        self.db.put_bulk([Res(res1.uid, '2-aaa', 'val', parent=res1.rev)])
+
+        status, body = self._request('GET', '/db/_changes?style=all_docs')
+        self.assertEqual(status, 200)
+        self.assertEqual(body['last_seq'], 4)
+        self.assertEqual([r['seq'] for r in body['results']], [2, 4])
+        self.assertEqual(body['results'][1]['id'], res1.uid)
+        self.assertEqual(len(body['results'][1]['changes']), 2)
+
+        body = self._request('GET', '/db/_changes?since=2&limit=1')[1]
+        self.assertEqual(body['results'], [
+            {'seq': 4, 'id': res1.uid, 'changes': [{'rev': self.db.get(res1.uid).rev}]}])
+
+        body = self._request('GET', '/db/_changes?since=4')[1]
+        self.assertEqual(body, {'results': [], 'last_seq': 4})
+        self.assertEqual(res2.uid, self._request('GET', '/db/_changes?limit=1')[1]['results'][0]['id'])
+
+    def test_changes_streamed(self):
+        for i in range(1500):
+            self.db.put(i)
+        changes_get = self.db.changes_get
+        release, waited = threading.Event(), []
+
+        def blocking_changes_get(*args):
+            for i, change in enumerate(changes_get(*args)):
+                if i == 1200:
+                    waited.append(release.wait(5))
+                yield change
+
+        self.db.changes_get = blocking_changes_get
+        self.conn.request('GET', '/db/_changes')
+        response = self.conn.getresponse()
+        # the first page is sent while the rest of the feed is being read
+        first = response.read(100)
+        release.set()
+        body = json.loads(first + response.read())
+        self.assertEqual(waited, [True])
+        self.assertEqual(len(body['results']), 1500)
+        self.assertEqual(body['last_seq'], 1500)
+
+    def test_changes_filter(self):
+        res1 = self.db.put({'owner': 'bob'})
+        res2 = self.db.put({'owner': 'alice'})
+        self.db.put('val3')
+
+        body = self._request('POST', '/db/_changes?filter=_doc_ids', {'doc_ids': [res2.uid]})[1]
+        self.assertEqual(body['results'], [{'seq': 2, 'id': res2.uid, 'changes': [{'rev': res2.rev}]}])
+
+        body = self._request('POST', '/db/_changes?filter=_selector', {'selector': {'owner': 'bob'}})[1]
+        self.assertEqual([r['id'] for r in body['results']], [res1.uid])
+        self.assertEqual(body['last_seq'], 3)
+
+        self.db.filters['owner'] = lambda result, params: (
+            isinstance(result.value, dict) and result.value.get('owner') == params['owner'])
+        body = self._request('GET', '/db/_changes?filter=owner&owner=alice')[1]
+        self.assertEqual([r['id'] for r in body['results']], [res2.uid])
+
+        self.assertEqual(self._request('GET', '/db/_changes?filter=missing')[0], 404)
+        self.assertEqual(self._request('POST', '/db/_changes?filter=_selector', [])[0], 400)
+        self.assertEqual(
+            self._request('POST', '/db/_changes?filter=_selector', {'selector': {'a': {'$x': 1}}})[0], 400)
+
+    def test_changes_longpoll(self):
+        self.db.put('val1')
+        timer = threading.Timer(0.1, self.db.put, ['val2'])
+        timer.start()
+
+        t = time.time()
+        body = self._request('GET', '/db/_changes?feed=longpoll&since=1')[1]
+        self.assertGreater(time.time() - t, 0.05)
+        self.assertEqual(body['last_seq'], 2)
+        self.assertEqual(len(body['results']), 1)
+
+        body = self._request('GET', '/db/_changes?feed=longpoll&since=now&timeout=50')[1]
+        self.assertEqual(body, {'results': [], 'last_seq': 2})
+
+    def test_changes_continuous(self):
+        self.db.put('val1')
+        timer = threading.Timer(0.1, self.db.put, ['val2'])
+        timer.start()
+
+        self.conn.request('GET', '/db/_changes?feed=continuous&timeout=300&heartbeat=50')
+        response = self.conn.getresponse()
+        lines = response.read().split('\n')
+
+        results = [json.loads(line) for line in lines if line]
+        self.assertEqual([r.get('seq') for r in results], [1, 2, None])
+        self.assertEqual(results[-1], {'last_seq': 2})
+        self.assertIn('', lines[:-1])  # heartbeats
+
+        self.conn.request('GET', '/db/_changes?feed=continuous&limit=1')
+        lines = self.conn.getresponse().read().splitlines()
+        self.assertEqual([json.loads(line) for line in lines][1], {'last_seq': 1})
+
+    def test_local(self):
+        self.assertEqual(self._request('GET', '/db/_local/check')[0], 404)
+
+        status, body = self._request('PUT', '/db/_local/check', {'_value': 10})
+        self.assertEqual(status, 201)
+        self.assertEqual(self.db.local_get('check'), 10)
+
+        status, body = self._request('GET', '/db/_local/check')
+        self.assertEqual(body['_value'], 10)
+        self.assertEqual(body['_id'], '_local/check')
+
+        self.assertEqual(self._request('DELETE', '/db/_local/check')[0], 200)
+        self.assertEqual(self._request('GET', '/db/_local/check')[0], 404)
+
+    def test_concurrent_clients(self):
+        def client(i):
+            conn = httplib.HTTPConnection(*self.server.server_address[:2])
+            for j in range(10):
+                self._request('PUT', '/db/doc{}-{}'.format(i, j), {'n': j}, conn)
+            conn.close()
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.db.storage), 100)
+        self.assertEqual(self.db.changes_get_seq(), 100)
+
+
 if __name__ == '__main__':
     unittest.main()
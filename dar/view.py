@@ -0,0 +1,225 @@
+"""Views, sorted indexes of what a map function emits for each document.
+
+Similar to CouchDB views: `map_func` is called with the `Result` of the
+winner of a document and yields `(key, value)` pairs, which are kept
+sorted by key in the collation order of CouchDB. The index follows the
+changes feed of the database, only the documents changed since its
+checkpoint are mapped again. The rows of each document and the checkpoint
+are kept in `local` of the database, so the index of a persistent
+database is picked up where it was left.
+"""
+from collections import namedtuple
+from itertools import groupby
+
+from .exceptions import NotFoundError
+from .storage import SortedList
+
+Row = namedtuple('Row', 'key value uid')
+
+
+def collate(key):
+    """Sort key of a JSON value, in the order of CouchDB views: null,
+    false, true, numbers, strings, arrays and objects.
+    """
+    if key is None:
+        return (0,)
+    if key is False:
+        return (1,)
+    if key is True:
+        return (2,)
+    if isinstance(key, (int, long, float)):
+        return (3, key)
+    if isinstance(key, basestring):
+        return (4, key.decode('utf-8') if isinstance(key, str) else key)
+    if isinstance(key, (list, tuple)):
+        return (5, tuple(collate(k) for k in key))
+    if isinstance(key, dict):
+        return (6, tuple((collate(k), collate(v)) for k, v in sorted(key.iteritems())))
+    raise TypeError('not a JSON value: {!r}'.format(key))
+
+
+def reduce_sum(keys, values):
+    return sum(values)
+
+
+def reduce_count(keys, values):
+    return len(values)
+
+
+def reduce_stats(keys, values):
+    return {
+        'sum': sum(values),
+        'count': len(values),
+        'min': min(values),
+        'max': max(values),
+        'sumsqr': sum(v * v for v in values),
+    }
+
+
+# built-in reduce functions of CouchDB
+REDUCERS = {
+    '_sum': reduce_sum,
+    '_count': reduce_count,
+    '_stats': reduce_stats,
+}
+
+
+class _Max(object):
+    """Greater than anything, closes a range of index rows."""
+
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+    def __eq__(self, other):
+        return other is self
+
+    def __ne__(self, other):
+        return other is not self
+
+    __le__ = __eq__
+    __ge__ = __gt__
+
+
+_MAX = _Max()
+_ANY = object()  # a bound which is not given, `None` is the null key
+
+
+class View(object):
+    """Index of the rows emitted by `map_func`, reduced by `reduce_func`.
+
+    `reduce_func(keys, values)` is given the `[key, uid]` pairs and the
+    values of the rows in a range or a group, it may be the name of a
+    built-in: `'_sum'`, `'_count'` or `'_stats'`. The index is stored
+    under `name`, a view of another map function needs another name.
+    """
+
+    def __init__(self, db, name, map_func, reduce_func=None):
+        self.db = db
+        self.name = name
+        self.map = map_func
+        self.reduce = REDUCERS.get(reduce_func, reduce_func)
+        self.uid = '_view/' + name  # checkpoint in `local`, rows under `uid/<doc uid>`
+
+        self.rows = SortedList()  # (collate(key), uid, position, key, value)
+        self.emitted = {}  # uid -> rows of the document
+        self.seq = db.local_get(self.uid, 0)
+
+        prefix = self.uid + '/'
+        for uid in list(db.local):
+            if uid.startswith(prefix):
+                self._insert(uid[len(prefix):], db.local[uid])
+
+    def update(self):
+        """Map the documents changed since the checkpoint."""
+        db = self.db
+        seq = self.seq
+        for change in db.changes_get(self.seq, style='main_only'):
+            try:
+                emitted = [[key, value] for key, value in self.map(db.get(change.uid))]
+            except NotFoundError:
+                emitted = []  # deleted
+
+            self._remove(change.uid)
+            self._insert(change.uid, emitted)
+            uid = self.uid + '/' + change.uid
+            if emitted:
+                db.local[uid] = emitted
+            elif uid in db.local:
+                del db.local[uid]
+            seq = change.seq
+
+        if seq != self.seq:
+            self.seq = seq
+            db.local_put(self.uid, seq)
+
+    def query(self, key=_ANY, startkey=_ANY, endkey=_ANY, startkey_docid=None,
+              endkey_docid=None, inclusive_end=True, descending=False, skip=0,
+              limit=None, reduce=True, group=False, group_level=None, stale=False):
+        """Rows of a key or a range of keys, like a CouchDB view query.
+
+        Finding a range is a binary search, so a query costs the log of
+        the index size plus the rows it goes through. A reduced query
+        goes through all the rows of its range. Unless `stale` the index
+        is updated first.
+        """
+        if not stale:
+            self.update()
+
+        if key is not _ANY:
+            startkey = endkey = key
+        if descending:
+            # the range is walked from `startkey` down to `endkey`
+            low, low_uid, low_after = endkey, endkey_docid, not inclusive_end
+            high, high_uid, high_after = startkey, startkey_docid, True
+        else:
+            low, low_uid, low_after = startkey, startkey_docid, False
+            high, high_uid, high_after = endkey, endkey_docid, inclusive_end
+
+        rows = self.rows
+        lo = 0 if low is _ANY else self._bound(low, low_uid, low_after)
+        hi = len(rows) if high is _ANY else self._bound(high, high_uid, high_after)
+        hi = max(lo, hi)
+
+        if self.reduce is not None and reduce:
+            selected = rows[lo:hi]
+            if descending:
+                selected.reverse()
+            res = self._reduce(selected, group, group_level)
+            return res[skip:None if limit is None else skip + limit]
+
+        if descending:
+            start = hi - skip
+            stop = lo if limit is None else max(lo, start - limit)
+            selected = rows[stop:max(stop, start)]
+            selected.reverse()
+        else:
+            start = lo + skip
+            stop = hi if limit is None else min(hi, start + limit)
+            selected = rows[start:max(start, stop)]
+        return [Row(row[3], row[4], row[1]) for row in selected]
+
+    def _reduce(self, rows, group, group_level):
+        if not rows:
+            return []
+        if not group and group_level is None:
+            return [Row(None, self._reduce_rows(rows), None)]
+
+        def group_key(row):
+            key = row[3]
+            if group_level is not None and isinstance(key, list):
+                return key[:group_level]
+            return key
+
+        return [
+            Row(key, self._reduce_rows(list(grouped)), None)
+            for key, grouped in groupby(rows, group_key)
+        ]
+
+    def _reduce_rows(self, rows):
+        return self.reduce([[row[3], row[1]] for row in rows], [row[4] for row in rows])
+
+    def _bound(self, key, uid, after):
+        """Position of the first row with `key` (and `uid`), or of the
+        first one past them if `after`.
+        """
+        bound = (collate(key),) if uid is None else (collate(key), uid)
+        if after:
+            return self.rows.bisect_right(bound + (_MAX,))
+        return self.rows.bisect_left(bound)
+
+    def _insert(self, uid, emitted):
+        rows = [
+            (collate(key), uid, position, key, value)
+            for position, (key, value) in enumerate(emitted)
+        ]
+        for row in rows:
+            self.rows.add(row)
+        if rows:
+            self.emitted[uid] = rows
+
+    def _remove(self, uid):
+        for row in self.emitted.pop(uid, ()):
+            self.rows.remove(row)